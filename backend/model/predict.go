@@ -6,6 +6,7 @@ import (
 	"encoding/json"
 	"fmt"
 	"io"
+	"mime/multipart"
 	"net/http"
 	"sort"
 )
@@ -41,6 +42,49 @@ func Predict(filePath string, predictionServiceUrl string, ctx *types.Connection
 	return predictionResponse, nil
 }
 
+// PredictBatch sends all file paths in a single multipart request to the batch endpoint of prediction service
+// so that the images are fetched concurrently and classified together instead of one request per file
+func PredictBatch(filePaths []string, predictionServiceUrl string, ctx *types.ConnectionContext) ([]PredictionResponse, error) {
+	var requestBody bytes.Buffer
+	writer := multipart.NewWriter(&requestBody)
+
+	for _, filePath := range filePaths {
+		if err := writer.WriteField("filePaths", filePath); err != nil {
+			return nil, fmt.Errorf("failed to write multipart field: %w", err)
+		}
+	}
+
+	if err := writer.Close(); err != nil {
+		return nil, fmt.Errorf("failed to close multipart writer: %w", err)
+	}
+
+	res, err := http.Post(predictionServiceUrl, writer.FormDataContentType(), &requestBody)
+	if err != nil {
+		return nil, fmt.Errorf("failed to make POST request: %w", err)
+	}
+	defer res.Body.Close()
+
+	body, err := io.ReadAll(res.Body)
+	if err != nil {
+		return nil, fmt.Errorf("failed to read response body: %w", err)
+	}
+
+	var batchResponse BatchPredictionResponse
+	if err := json.Unmarshal(body, &batchResponse); err != nil {
+		return nil, fmt.Errorf("failed to unmarshal response JSON: %w", err)
+	}
+
+	predictionResponses := make([]PredictionResponse, 0, len(batchResponse.Results))
+	for _, result := range batchResponse.Results {
+		if result.Error != nil {
+			return nil, fmt.Errorf("failed to predict file %s: %s", result.Source, *result.Error)
+		}
+		predictionResponses = append(predictionResponses, PredictionResponse{Predictions: result.Predictions})
+	}
+
+	return predictionResponses, nil
+}
+
 func MapToPredictionFile(productName string, predictionResponse map[string]float64, filePaths []string) types.PredictionFile {
 	var predictedClasses []types.PredictedClass
 
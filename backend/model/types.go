@@ -7,3 +7,13 @@ type PredictBody struct {
 type PredictionResponse struct {
 	Predictions map[string]float64 `json:"predictions"`
 }
+
+type BatchPredictionResult struct {
+	Source      string             `json:"source"`
+	Predictions map[string]float64 `json:"predictions"`
+	Error       *string            `json:"error"`
+}
+
+type BatchPredictionResponse struct {
+	Results []BatchPredictionResult `json:"results"`
+}
@@ -13,21 +13,24 @@ func HandlePrediction(ctx *types.ConnectionContext) {
 
 	var predictionServiceUrl string
 	if url, ok := os.LookupEnv("PREDICTION_SERVICE_URL"); ok {
-		predictionServiceUrl = url + "/predict"
+		predictionServiceUrl = url + "/predict/batch"
 	} else {
-		predictionServiceUrl = "http://localhost:8000/predict"
+		predictionServiceUrl = "http://localhost:8000/predict/batch"
 	}
 
 	for productName, paths := range ctx.FilesToPredict {
 
 		predictions := make(map[string]float64)
-		for _, path := range paths {
-			prediction, err := model.Predict(path, predictionServiceUrl, ctx)
+
+		// all photos of a product are classified in a single request
+		batchPredictions, err := model.PredictBatch(paths, predictionServiceUrl, ctx)
+		if err != nil {
+			fmt.Println("Error predicting files:", err)
+			return
+		}
+
+		for _, prediction := range batchPredictions {
 			fmt.Println("Prediction:", prediction)
-			if err != nil {
-				fmt.Println("Error predicting file:", err)
-				return
-			}
 			for class, weight := range prediction.Predictions {
 				predictions[class] += weight
 			}
@@ -0,0 +1,42 @@
+import io
+import time
+from typing import Callable, Optional
+
+import numpy as np
+from PIL import Image
+
+
+def time_call(fn: Callable[[], object], n_repeats: int, n_warmup: int = 1, synchronize: Optional[Callable[[], None]] = None) -> float:
+    """
+    Mean seconds of a call of `fn` over `n_repeats` calls after `n_warmup` untimed ones,
+    `synchronize` waits for asynchronous work (e.g. torch.cuda.synchronize) before the clock is read
+    """
+    for _ in range(n_warmup):
+        fn()
+    if synchronize is not None:
+        synchronize()
+
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        fn()
+    if synchronize is not None:
+        synchronize()
+    return (time.perf_counter() - start) / n_repeats
+
+
+def create_photo(width: int, height: int, seed: int = 0, noise: float = 12.0) -> Image.Image:
+    # smooth gradients with noise resemble photos better than flat colors, which compress (and decode) trivially
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.stack([
+        127 + 100 * np.sin(x / (50 + 10 * c) + seed) * np.cos(y / (70 + 5 * c))
+        for c in range(3)], axis=-1)
+    pixels += rng.normal(0, noise, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def encode_photo(image: Image.Image, image_format: str = "JPEG", quality: int = 90) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, quality=quality) if image_format == "JPEG" else image.save(
+        buffer, image_format)
+    return buffer.getvalue()
@@ -0,0 +1,46 @@
+import click
+import torch
+
+from ml.benchmarks import time_call
+from ml.utils.batch_augmentations import BatchAugmentations
+from ml.utils.data_loader import ImageDataset
+
+
+@click.command()
+@click.option("--batch-size", "-b", type=int, default=64)
+@click.option("--size", "-s", type=int, default=224)
+@click.option("--n-repeats", "-r", type=int, default=3)
+@click.option("--device", "-d", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+def augmentation_benchmark(batch_size: int, size: int, n_repeats: int, device: str):
+    """
+    Samples per second of the per sample train augmentations of ImageDataset (what every DataLoader worker runs)
+    and of BatchAugmentations on whole batches on `device` (what PrefetchLoader runs with batched augmentations)
+    """
+    device = torch.device(device)
+    mean = [0.5, 0.5, 0.5]
+
+    # the augmentations do not depend on the data, an empty validation dataset only provides them
+    dataset = ImageDataset(".", {}, "val", dataset_mean=mean)
+    batched = BatchAugmentations(mean)
+
+    images = torch.randint(0, 256, (batch_size, 3, size, size), dtype=torch.uint8)
+    pixels = images.to(device).float() / 255
+
+    def synchronize():
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+
+    timings = {
+        "per sample float32": time_call(lambda: [dataset.train_augmentations(image) for image in images.float() / 255],
+                                        n_repeats, synchronize=synchronize),
+        "per sample uint8": time_call(lambda: [dataset.uint8_train_augmentations(image) for image in images],
+                                      n_repeats, synchronize=synchronize),
+        f"batched {device.type}": time_call(lambda: batched(pixels), n_repeats, synchronize=synchronize),
+    }
+
+    for name, elapsed in timings.items():
+        print(f"{name:>18}: {batch_size / elapsed:8.0f} samples/s")
+
+
+if __name__ == "__main__":
+    augmentation_benchmark()
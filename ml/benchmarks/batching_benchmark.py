@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import click
+import numpy as np
+import torch
+
+from ml.inference.batching import MicroBatcher
+from ml.models import HierarchyModel
+from ml.utils.hierarchy import Hierarchy
+
+
+async def __run_load(batcher: MicroBatcher, images: torch.Tensor, concurrency: int) -> np.ndarray:
+    latencies = []
+    next_image = 0
+
+    async def client():
+        nonlocal next_image
+        while next_image < len(images):
+            image = images[next_image]
+            next_image += 1
+
+            start = time.perf_counter()
+            await batcher.submit(image)
+            latencies.append(time.perf_counter() - start)
+
+    await batcher.start()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    await batcher.stop()
+
+    return np.array(latencies)
+
+
+@click.command()
+@click.option("--n-requests", "-n", type=int, default=512)
+@click.option("--concurrency", "-c", type=int, default=64)
+@click.option("--max-wait-ms", "-w", type=float, default=5.0)
+@click.option("--batch-sizes", "-b", type=str, default="1,4,8,16,32")
+def batching_benchmark(n_requests: int, concurrency: int, max_wait_ms: float, batch_sizes: str):
+    """
+    Simulates many concurrent /predict callers and reports throughput and latency percentiles per max batch size
+    """
+    model = HierarchyModel(hierarchy=Hierarchy())
+    height, width = model.config["min_size"]
+    images = torch.randn(n_requests, 3, height, width)
+
+    # warmup so that the first measured configuration does not pay for lazy initialization
+    model.predict(images[:2])
+
+    for max_batch_size in [int(size) for size in batch_sizes.split(",")]:
+        batcher = MicroBatcher(
+            model.predict, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+        start = time.perf_counter()
+        latencies = asyncio.run(__run_load(batcher, images, concurrency))
+        elapsed = time.perf_counter() - start
+
+        stats = batcher.get_stats()
+        print(
+            f"max_batch_size={max_batch_size:>3} "
+            f"throughput={n_requests / elapsed:8.1f} img/s "
+            f"avg_batch={stats['avg_batch_size']:5.1f} "
+            f"p50={np.percentile(latencies, 50) * 1000:7.1f}ms "
+            f"p99={np.percentile(latencies, 99) * 1000:7.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    batching_benchmark()
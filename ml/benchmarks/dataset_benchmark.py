@@ -0,0 +1,46 @@
+import os
+
+import click
+from torch.utils.data import DataLoader
+
+from ml.benchmarks import time_call
+from ml.utils.constants import PROCESSED_IMAGES_PATH, SHARDED_IMAGES_PATH
+from ml.utils.data_loader import ImageDataset, ShardedImageDataset
+
+
+@click.command()
+@click.option("--split", "-s", type=str, default="val", help="val and test splits are read without augmentations and rebalancing")
+@click.option("--batch-size", "-b", type=int, default=64)
+@click.option("--num-workers", "-w", type=int, default=0)
+@click.option("--n-repeats", "-r", type=int, default=3)
+def dataset_benchmark(split: str, batch_size: int, num_workers: int, n_repeats: int):
+    """
+    Samples per second of reading every leaf of the processed images through a DataLoader,
+    from one .pt file per image and from the shards written by ml.scripts.shard_images
+    """
+    leaves = [leaf for leaf in os.listdir(PROCESSED_IMAGES_PATH)
+              if leaf != "tmp" and os.path.isdir(os.path.join(PROCESSED_IMAGES_PATH, leaf))]
+    categories = {leaf: [leaf] for leaf in leaves}
+
+    datasets = {
+        "files": ImageDataset(PROCESSED_IMAGES_PATH, categories, split),
+        "shards": ShardedImageDataset(SHARDED_IMAGES_PATH, categories, split),
+    }
+
+    for name, dataset in datasets.items():
+        loader = DataLoader(dataset, batch_size=batch_size,
+                            shuffle=True, num_workers=num_workers)
+
+        # warmup pass fills the page cache, both layouts are then measured from memory
+        elapsed = time_call(lambda: [None for _ in loader], n_repeats)
+        print(f"{name:>6}: {len(dataset) / elapsed:8.0f} samples/s ({len(dataset)} samples)")
+
+    files_size = sum(os.path.getsize(os.path.join(PROCESSED_IMAGES_PATH, leaf, file))
+                     for leaf in leaves for file in os.listdir(os.path.join(PROCESSED_IMAGES_PATH, leaf)))
+    shards_size = sum(os.path.getsize(os.path.join(SHARDED_IMAGES_PATH, file))
+                      for file in os.listdir(SHARDED_IMAGES_PATH) if file.endswith(".bin"))
+    print(f"disk: files={files_size / 1024 ** 2:.1f}MB shards={shards_size / 1024 ** 2:.1f}MB")
+
+
+if __name__ == "__main__":
+    dataset_benchmark()
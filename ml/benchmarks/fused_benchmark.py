@@ -0,0 +1,49 @@
+import click
+import torch
+import torch.nn.functional as F
+
+from ml.benchmarks import time_call
+from ml.models import HierarchyNodeModel
+from ml.models.stacked_node_models import StackedNodeModels
+
+
+@click.command()
+@click.option("--n-nodes", "-n", type=int, default=32)
+@click.option("--batch-size", "-b", type=int, default=8)
+@click.option("--n-repeats", "-r", type=int, default=5)
+@click.option("--chunk-size", "-c", type=int, default=None)
+def fused_benchmark(n_nodes: int, batch_size: int, n_repeats: int, chunk_size: int):
+    """
+    Compares the python loop over node models with the stacked vmapped forward on synthetic node models
+    """
+    torch.manual_seed(0)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    # node models in real hierarchies have a varying number of children
+    models = {f"node_{i}": HierarchyNodeModel(2 + i % 7).to(device).eval()
+              for i in range(n_nodes)}
+    stacked = StackedNodeModels(models, device, chunk_size)
+
+    tensor = torch.randn(batch_size, 3, 100, 100, device=device)
+
+    @torch.no_grad()
+    def loop():
+        return [F.softmax(model(tensor), dim=-1) for model in models.values()]
+
+    loop_time = time_call(loop, n_repeats)
+    fused_time = time_call(lambda: stacked(tensor), n_repeats)
+
+    fused_probs = stacked(tensor)
+    max_diff = max(
+        (fused_probs[stacked.node_index[node_id], :, :probs.shape[1]] - probs).abs().max().item()
+        for node_id, probs in zip(models.keys(), loop())
+    )
+
+    print(f"nodes={n_nodes} batch_size={batch_size}")
+    print(f"loop:  {loop_time * 1000:8.1f}ms")
+    print(f"fused: {fused_time * 1000:8.1f}ms ({loop_time / fused_time:.2f}x)")
+    print(f"max abs difference: {max_diff:.2e}")
+
+
+if __name__ == "__main__":
+    fused_benchmark()
@@ -0,0 +1,75 @@
+import os
+import random
+import tempfile
+import time
+
+import click
+import pandas as pd
+
+from ml.utils.hierarchy import Hierarchy
+
+
+def create_synthetic_hierarchy(n_nodes: int, max_children: int = 12, seed: int = 0) -> pd.DataFrame:
+    """
+    Random taxonomy with `n_nodes` nodes, every internal node gets between 2 and `max_children` children
+    """
+    rng = random.Random(seed)
+
+    rows = [("n0", "node 0", None)]
+    queue = ["n0"]
+
+    while len(rows) < n_nodes:
+        parent_id = queue.pop(0)
+        n_children = min(rng.randint(2, max_children), n_nodes - len(rows))
+
+        for _ in range(n_children):
+            node_id = f"n{len(rows)}"
+            rows.append((node_id, f"node {len(rows)}", parent_id))
+            queue.append(node_id)
+
+    return pd.DataFrame(rows, columns=["<ID>", "<Name>", "<Parent ID>"])
+
+
+def __time(name: str, fn):
+    start = time.perf_counter()
+    result = fn()
+    print(f"{name:<40} {(time.perf_counter() - start) * 1000:10.1f}ms")
+    return result
+
+
+@click.command()
+@click.option("--n-nodes", "-n", type=int, default=50_000)
+@click.option("--max-mask-mb", "-m", type=int, default=2048)
+def hierarchy_benchmark(n_nodes: int, max_mask_mb: int):
+    """
+    Times building the hierarchy index and the queries used by training, evaluation and inference
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "hierarchy.csv")
+        create_synthetic_hierarchy(n_nodes).to_csv(path, index=False)
+
+        hierarchy = __time("load + build index", lambda: Hierarchy(path))
+
+    internal_nodes = [node_id for node_id in hierarchy.bfs_order
+                      if not hierarchy.is_leaf(node_id)]
+    print(
+        f"nodes={n_nodes} internal={len(internal_nodes)} leaves={len(hierarchy.leaf_order)}")
+
+    __time("get_categories_list", hierarchy.get_categories_list)
+    __time("get_children + get_parent (all nodes)", lambda: [
+        (hierarchy.get_children(node_id), hierarchy.get_parent(node_id)) for node_id in hierarchy.bfs_order])
+    __time("get_leaf_nodes (all internal nodes)", lambda: [
+        hierarchy.get_leaf_nodes(node_id) for node_id in internal_nodes])
+
+    # the dense mask has one float32 per (leaf, edge) pair
+    mask_mb = len(hierarchy.leaf_order) * \
+        len(hierarchy.edge_index) * 4 / 1024 ** 2
+    if mask_mb <= max_mask_mb:
+        __time("create_matrix_mask", hierarchy.create_matrix_mask)
+    else:
+        print(
+            f"create_matrix_mask skipped, dense mask would take {mask_mb:.0f}MB (limit {max_mask_mb}MB)")
+
+
+if __name__ == "__main__":
+    hierarchy_benchmark()
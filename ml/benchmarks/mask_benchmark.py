@@ -0,0 +1,69 @@
+import os
+import tempfile
+
+import click
+import numpy as np
+
+from ml.benchmarks import time_call
+from ml.benchmarks.hierarchy_benchmark import create_synthetic_hierarchy
+from ml.utils.hierarchy import Hierarchy
+
+
+def __load_synthetic_hierarchy(n_leaves: int) -> Hierarchy:
+    # with 2-12 children per node roughly 6 out of 7 nodes are leaves
+    n_nodes = int(n_leaves * 7 / 6)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "hierarchy.csv")
+        create_synthetic_hierarchy(n_nodes).to_csv(path, index=False)
+        return Hierarchy(path)
+
+
+@click.command()
+@click.option("--leaves", "-l", type=str, default="1000,10000,100000")
+@click.option("--batch-size", "-b", type=int, default=16)
+@click.option("--n-repeats", "-r", type=int, default=5)
+@click.option("--max-mask-mb", "-m", type=int, default=2048)
+def mask_benchmark(leaves: str, batch_size: int, n_repeats: int, max_mask_mb: int):
+    """
+    Compares the dense matrix mask product with the sparse gather + segment sum leaf aggregation
+    """
+    rng = np.random.default_rng(0)
+
+    for target_leaves in [int(n) for n in leaves.split(",")]:
+        hierarchy = __load_synthetic_hierarchy(target_leaves)
+        n_leaves, n_edges = len(hierarchy.leaf_order), len(
+            hierarchy.edge_index)
+
+        log_probs = np.log(rng.random((batch_size, n_edges)) + 1e-10)
+
+        indices, indptr, depths = hierarchy.create_sparse_mask()
+        sparse_mb = (indices.nbytes + indptr.nbytes + depths.nbytes) / 1024 ** 2
+
+        def sparse():
+            return np.add.reduceat(log_probs[:, indices], indptr[:-1], axis=1) / depths
+
+        sparse_time = time_call(sparse, n_repeats)
+
+        print(f"leaves={n_leaves} edges={n_edges} sum of leaf depths={len(indices)}")
+        print(
+            f"  sparse: {sparse_time * 1000:9.2f}ms {sparse_mb:10.2f}MB {len(indices) * batch_size:>14} adds")
+
+        dense_mb = n_leaves * n_edges * 4 / 1024 ** 2
+        if dense_mb > max_mask_mb:
+            print(
+                f"  dense:  skipped, mask would take {dense_mb:.0f}MB (limit {max_mask_mb}MB)")
+            continue
+
+        mask = hierarchy.create_matrix_mask()
+        dense_time = time_call(lambda: log_probs @ mask.T, n_repeats)
+
+        max_diff = np.abs(log_probs @ mask.T - sparse()).max()
+
+        print(
+            f"  dense:  {dense_time * 1000:9.2f}ms {dense_mb:10.2f}MB {n_leaves * n_edges * batch_size:>14} mults "
+            f"({dense_time / sparse_time:.1f}x slower, max abs difference {max_diff:.1e})")
+
+
+if __name__ == "__main__":
+    mask_benchmark()
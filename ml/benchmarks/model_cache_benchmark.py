@@ -0,0 +1,59 @@
+import time
+
+import click
+import torch
+
+from ml.models import HierarchyModel
+from ml.utils.hierarchy import Hierarchy
+
+
+@click.command()
+@click.option("--batch-size", "-b", type=int, default=8)
+@click.option("--n-batches", "-n", type=int, default=20)
+@click.option("--beam-width", "-w", type=int, default=3)
+@click.option("--max-models", "-m", type=str, default="1,2,4")
+def model_cache_benchmark(batch_size: int, n_batches: int, beam_width: int, max_models: str):
+    """
+    Startup time and resident weights of eagerly and lazily loaded node models,
+    followed by pruned inference traffic through lazy models with different cache budgets
+    """
+    hierarchy = Hierarchy()
+
+    start = time.perf_counter()
+    eager_model = HierarchyModel(hierarchy, device=torch.device("cpu"))
+    eager_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    lazy_model = HierarchyModel(
+        hierarchy, device=torch.device("cpu"), lazy=True)
+    lazy_time = time.perf_counter() - start
+
+    print(
+        f"startup: eager={eager_time * 1000:.1f}ms ({len(eager_model.models)} models) "
+        f"lazy={lazy_time * 1000:.1f}ms ({lazy_model.get_model_cache_stats()['memory_mb']:.2f}MB pinned)")
+
+    height, width = eager_model.config["min_size"]
+    torch.manual_seed(0)
+    batches = [torch.randn(batch_size, 3, height, width)
+               for _ in range(n_batches)]
+
+    for budget in [int(size) for size in max_models.split(",")]:
+        model = HierarchyModel(hierarchy, device=torch.device("cpu"),
+                               lazy=True, cache_max_models=budget)
+
+        start = time.perf_counter()
+        for tensor in batches:
+            model.predict_pruned(tensor, beam_width)
+        elapsed = time.perf_counter() - start
+
+        stats = model.get_model_cache_stats()
+        print(
+            f"max_models={budget:>3} "
+            f"{elapsed * 1000 / n_batches:7.2f}ms/batch "
+            f"hit_rate={stats['hit_rate']:.2%} "
+            f"misses={stats['misses']} evictions={stats['evictions']} "
+            f"memory={stats['memory_mb']:.2f}MB")
+
+
+if __name__ == "__main__":
+    model_cache_benchmark()
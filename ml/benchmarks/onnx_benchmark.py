@@ -0,0 +1,118 @@
+import json
+import os
+import tempfile
+
+import click
+import numpy as np
+import torch
+
+from ml.benchmarks import time_call
+from ml.benchmarks.hierarchy_benchmark import create_synthetic_hierarchy
+from ml.models import HierarchyModel, HierarchyNodeModel
+from ml.models.onnx_hierarchy_model import OnnxHierarchyModel
+from ml.scripts.export_onnx import export_hierarchy
+from ml.utils.constants import DATA_DIR, MODELS_REGISTRY_PATH
+from ml.utils.hierarchy import Hierarchy
+
+
+def __create_synthetic_registry(n_nodes: int, min_size: int) -> Hierarchy:
+    """
+    Randomly initialised node models of a synthetic hierarchy written to the registry of the working directory
+    """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    os.makedirs(MODELS_REGISTRY_PATH, exist_ok=True)
+
+    path = os.path.join(DATA_DIR, "hierarchy.csv")
+    create_synthetic_hierarchy(n_nodes, max_children=4).to_csv(path, index=False)
+    hierarchy = Hierarchy(path)
+
+    with open(os.path.join(DATA_DIR, "config.json"), "w") as f:
+        json.dump({"min_size": [min_size, min_size], "mean": [0.5, 0.5, 0.5], "std": [0.25, 0.25, 0.25]}, f)
+
+    queue = [hierarchy.get_root_id()]
+    while len(queue) > 0:
+        node_id = queue.pop(0)
+        children = hierarchy.get_children(node_id)
+        queue.extend(children)
+
+        if len(children) == 0:
+            continue
+
+        if len(children) > 1:
+            model = HierarchyNodeModel(len(children))
+            # default batch norm statistics make every layer an identity, random ones exercise them in the export
+            for module in model.modules():
+                if isinstance(module, torch.nn.BatchNorm2d):
+                    module.running_mean.uniform_(-0.2, 0.2)
+                    module.running_var.uniform_(0.5, 2.0)
+            torch.save(model.state_dict(), os.path.join(MODELS_REGISTRY_PATH, f"{node_id}.pth"))
+
+        with open(os.path.join(MODELS_REGISTRY_PATH, f"{node_id}.json"), "w") as f:
+            json.dump({"n_classes": len(children), "is_single_label": len(children) == 1, "children": children}, f)
+
+    return hierarchy
+
+
+def __compare(torch_model: HierarchyModel, onnx_model: OnnxHierarchyModel, batch_sizes: str, n_repeats: int, tolerance: float):
+    height, width = torch_model.config["min_size"]
+    torch.manual_seed(0)
+
+    for batch_size in [int(size) for size in batch_sizes.split(",")]:
+        tensor = torch.randn(batch_size, 3, height, width)
+
+        max_diff = np.abs(torch_model.predict(tensor) -
+                          onnx_model.predict(tensor)).max()
+        assert max_diff < tolerance, f"Onnx predictions differ by {max_diff}"
+
+        if n_repeats == 0:
+            print(f"batch_size={batch_size:>3} max abs difference={max_diff:.1e}")
+            continue
+
+        torch_time = time_call(lambda: torch_model.predict(tensor), n_repeats)
+        onnx_time = time_call(lambda: onnx_model.predict(tensor), n_repeats)
+
+        print(
+            f"batch_size={batch_size:>3} "
+            f"torch={torch_time * 1000 / batch_size:7.2f}ms/img "
+            f"onnx={onnx_time * 1000 / batch_size:7.2f}ms/img "
+            f"speedup={torch_time / onnx_time:5.2f}x "
+            f"max abs difference={max_diff:.1e}"
+        )
+
+
+@click.command()
+@click.option("--batch-sizes", "-b", type=str, default="1,8,32")
+@click.option("--n-repeats", "-r", type=int, default=10)
+@click.option("--tolerance", "-t", type=float, default=1e-4)
+@click.option("--synthetic-nodes", "-s", type=int, default=0,
+              help="Check a temporary registry of random node models of a synthetic hierarchy with this many nodes instead of the trained one")
+def onnx_benchmark(batch_sizes: str, n_repeats: int, tolerance: float, synthetic_nodes: int):
+    """
+    Checks that onnxruntime backend predicts the same leaf probabilities as eager pytorch and compares their latency
+    """
+    if synthetic_nodes == 0:
+        hierarchy = Hierarchy()
+        __compare(HierarchyModel(hierarchy, device=torch.device("cpu")),
+                  OnnxHierarchyModel(hierarchy), batch_sizes, n_repeats, tolerance)
+        return
+
+    # registry paths are relative to the working directory, the synthetic one never touches the trained registry
+    working_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            torch.manual_seed(0)
+            hierarchy = __create_synthetic_registry(synthetic_nodes, min_size=64)
+            torch_model = HierarchyModel(hierarchy, device=torch.device("cpu"))
+
+            # per node sessions and the fused graph compute the edge probabilities differently, both are checked
+            for fused in [False, True]:
+                export_hierarchy(torch_model, fused)
+                print(f"{'fused graph' if fused else 'per node sessions'}:")
+                __compare(torch_model, OnnxHierarchyModel(hierarchy), batch_sizes, n_repeats, tolerance)
+        finally:
+            os.chdir(working_dir)
+
+
+if __name__ == "__main__":
+    onnx_benchmark()
@@ -0,0 +1,62 @@
+import click
+import numpy as np
+import torch
+
+from ml.benchmarks import time_call
+from ml.models import HierarchyModel
+from ml.models.optimization import COMPILE_MODES, optimize_for_inference
+from ml.utils.hierarchy import Hierarchy
+
+
+@click.command()
+@click.option("--batch-size", "-b", type=int, default=16)
+@click.option("--n-repeats", "-r", type=int, default=10)
+@click.option("--compile-mode", "-c", type=click.Choice(COMPILE_MODES), default="freeze")
+def optimization_benchmark(batch_size: int, n_repeats: int, compile_mode: str):
+    """
+    Speedup of inference graph optimizations (folded batch norms, stripped dropout, channels_last, compilation)
+    for every node model and for the whole hierarchy
+    """
+    hierarchy = Hierarchy()
+    model = HierarchyModel(hierarchy, device=torch.device("cpu"))
+    optimized_model = HierarchyModel(
+        hierarchy, device=torch.device("cpu"), optimized=True, compile_mode=compile_mode)
+
+    height, width = model.config["min_size"]
+    torch.manual_seed(0)
+    tensor = torch.randn(batch_size, 3, height, width)
+    channels_last_tensor = tensor.contiguous(memory_format=torch.channels_last)
+
+    with torch.no_grad():
+        for step in model.plan:
+            variants = {
+                "eager": (step.model, tensor),
+                "folded": (optimize_for_inference(step.model, tensor[:1], channels_last=False), tensor),
+                "channels_last": (optimize_for_inference(step.model, tensor[:1]), channels_last_tensor),
+                compile_mode: (optimize_for_inference(step.model, tensor[:1], compile_mode=compile_mode), channels_last_tensor),
+            }
+
+            # two warmup calls, so that profiling jit executors settle
+            times = {name: time_call(lambda: node_model(inputs), n_repeats, n_warmup=2)
+                     for name, (node_model, inputs) in variants.items()}
+
+            print(f"node {step.node_id}: " + " ".join(
+                f"{name}={times[name] * 1000:7.2f}ms ({times['eager'] / times[name]:4.2f}x)" for name in times))
+
+    probs = model.predict(tensor)
+    optimized_probs = optimized_model.predict(tensor)
+
+    model_time = time_call(lambda: model.predict(tensor), n_repeats, n_warmup=2)
+    optimized_time = time_call(lambda: optimized_model.predict(tensor), n_repeats, n_warmup=2)
+
+    print(
+        f"hierarchy batch_size={batch_size}: "
+        f"eager={model_time * 1000:.2f}ms "
+        f"optimized={optimized_time * 1000:.2f}ms "
+        f"speedup={model_time / optimized_time:.2f}x "
+        f"max abs difference={np.abs(probs - optimized_probs).max():.1e}"
+    )
+
+
+if __name__ == "__main__":
+    optimization_benchmark()
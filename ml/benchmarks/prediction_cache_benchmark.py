@@ -0,0 +1,61 @@
+import asyncio
+import random
+import time
+
+import click
+import httpx
+
+from ml.benchmarks import create_photo, encode_photo
+from ml.inference.app import app
+from ml.inference.prediction_cache import PredictionCache
+
+
+def __create_images(n_images: int):
+    return [encode_photo(create_photo(640, 480, seed)) for seed in range(n_images)]
+
+
+async def __run(images, n_requests: int, concurrency: int) -> float:
+    # same request sequence for every cache configuration
+    rng = random.Random(0)
+    requests = [rng.choice(images) for _ in range(n_requests)]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+        async def request(data: bytes):
+            async with semaphore:
+                response = await client.post("/predict/batch", files=[("files", ("image.jpg", data, "image/jpeg"))])
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*[request(data) for data in requests])
+        return time.perf_counter() - start
+
+
+@click.command()
+@click.option("--n-images", "-i", type=int, default=8)
+@click.option("--n-requests", "-n", type=int, default=64)
+@click.option("--concurrency", "-c", type=int, default=4)
+def prediction_cache_benchmark(n_images: int, n_requests: int, concurrency: int):
+    """
+    Throughput of /predict/batch for traffic that repeats `n_images` distinct photos,
+    without stored predictions (only in flight requests are shared) and with the prediction cache
+    """
+    images = __create_images(n_images)
+
+    async def main():
+        async with app.router.lifespan_context(app):
+            for name, max_entries in [("no cache", 0), ("cache", 1024)]:
+                app.prediction_cache = PredictionCache(
+                    "benchmark", max_entries=max_entries)
+                elapsed = await __run(images, n_requests, concurrency)
+                stats = app.prediction_cache.get_stats()
+
+                print(
+                    f"{name:>8}: {elapsed * 1000 / n_requests:7.2f}ms/request "
+                    f"hit_ratio={stats['hit_ratio']:.2%} bytes_saved={stats['bytes_saved'] / 1024:.0f}KB")
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    prediction_cache_benchmark()
@@ -0,0 +1,57 @@
+import os
+
+import click
+import numpy as np
+import torch
+
+from ml.benchmarks import time_call
+from ml.models import HierarchyModel
+from ml.utils.constants import MODELS_REGISTRY_PATH
+from ml.utils.hierarchy import Hierarchy
+
+
+def __registry_size_mb(model: HierarchyModel, suffix: str) -> float:
+    return sum(os.path.getsize(os.path.join(MODELS_REGISTRY_PATH, f"{step.node_id}{suffix}"))
+               for step in model.plan) / 1024 ** 2
+
+
+@click.command()
+@click.option("--batch-sizes", "-b", type=str, default="1,8,32")
+@click.option("--n-repeats", "-r", type=int, default=10)
+def quantization_benchmark(batch_sizes: str, n_repeats: int):
+    """
+    Compares latency, size of node weights and prediction agreement of float and int8 node models on cpu.
+    Accuracy delta on the test split is reported by `python -m ml.scripts.evaluate_model [--quantized]`.
+    """
+    hierarchy = Hierarchy()
+    float_model = HierarchyModel(hierarchy, device=torch.device("cpu"))
+    int8_model = HierarchyModel(hierarchy, quantized=True)
+
+    print(
+        f"weights: float={__registry_size_mb(float_model, '.pth'):.2f}MB int8={__registry_size_mb(int8_model, '.int8.pt'):.2f}MB")
+
+    height, width = float_model.config["min_size"]
+    torch.manual_seed(0)
+
+    for batch_size in [int(size) for size in batch_sizes.split(",")]:
+        tensor = torch.randn(batch_size, 3, height, width)
+
+        float_probs = float_model.predict(tensor)
+        int8_probs = int8_model.predict(tensor)
+        top1_agreement = (float_probs.argmax(1) == int8_probs.argmax(1)).mean()
+
+        float_time = time_call(lambda: float_model.predict(tensor), n_repeats)
+        int8_time = time_call(lambda: int8_model.predict(tensor), n_repeats)
+
+        print(
+            f"batch_size={batch_size:>3} "
+            f"float={float_time * 1000 / batch_size:7.2f}ms/img "
+            f"int8={int8_time * 1000 / batch_size:7.2f}ms/img "
+            f"speedup={float_time / int8_time:5.2f}x "
+            f"top1 agreement={top1_agreement:.2%} "
+            f"max abs difference={np.abs(float_probs - int8_probs).max():.1e}"
+        )
+
+
+if __name__ == "__main__":
+    quantization_benchmark()
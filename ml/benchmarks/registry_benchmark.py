@@ -0,0 +1,60 @@
+import json
+import os
+from glob import glob
+
+import click
+import torch
+
+from ml.benchmarks import time_call
+from ml.models import HierarchyModel
+from ml.utils.constants import MODELS_REGISTRY_PATH, PACKED_REGISTRY_PATH
+from ml.utils.hierarchy import Hierarchy
+from ml.utils.packed_registry import PackedRegistry
+
+
+def __load_files() -> int:
+    # what loading the registry amounts to without the packed file: one json and one torch.load per node
+    n_tensors = 0
+    for file in glob(os.path.join(MODELS_REGISTRY_PATH, "*.json")):
+        with open(file, "r") as f:
+            json.load(f)
+
+    for file in glob(os.path.join(MODELS_REGISTRY_PATH, "*.pth")):
+        n_tensors += len(torch.load(file, map_location="cpu", weights_only=True))
+
+    return n_tensors
+
+
+def __load_packed() -> int:
+    registry = PackedRegistry(PACKED_REGISTRY_PATH)
+    registry.get_json("nodes")
+
+    return sum(len(registry.get_state_dict(node_id)) for node_id in registry.get_json("weights"))
+
+
+@click.command()
+@click.option("--n-repeats", "-r", type=int, default=5)
+def registry_benchmark(n_repeats: int):
+    """
+    Time to get every node's weights and metadata from separate registry files and from the packed registry
+    (pack it first with `python -m ml.scripts.pack_registry`), page cache is warm in both cases
+    """
+    if not os.path.exists(PACKED_REGISTRY_PATH):
+        raise FileNotFoundError(
+            f"{PACKED_REGISTRY_PATH} does not exist, create it with ml.scripts.pack_registry")
+
+    files_time = time_call(__load_files, n_repeats, n_warmup=0)
+    packed_time = time_call(__load_packed, n_repeats, n_warmup=0)
+
+    print(
+        f"weights: files={files_time * 1000:.1f}ms packed={packed_time * 1000:.1f}ms "
+        f"speedup={files_time / packed_time:.1f}x ({__load_packed()} tensors)")
+
+    hierarchy = Hierarchy()
+    model_time = time_call(lambda: HierarchyModel(
+        hierarchy, device=torch.device("cpu")), n_repeats, n_warmup=0)
+    print(f"HierarchyModel from packed registry: {model_time * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    registry_benchmark()
@@ -0,0 +1,70 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import click
+import numpy as np
+
+# runs in a fresh interpreter, so that import time is part of the measurement
+CHILD_SCRIPT = """
+import json, time
+start = time.perf_counter()
+
+from fastapi.testclient import TestClient
+from ml.inference.app import app
+
+imported = time.perf_counter()
+
+from ml.benchmarks import create_photo, encode_photo
+image = encode_photo(create_photo(320, 240))
+
+with TestClient(app) as client:
+    ready = time.perf_counter()
+    response = client.post("/predict/batch", files=[("files", ("image.jpg", image, "image/jpeg"))])
+    response.raise_for_status()
+    predicted = time.perf_counter()
+
+print(json.dumps({
+    "import": imported - start,
+    "ready": ready - start,
+    "first_prediction": predicted - start,
+    "phases": app.startup_times,
+}))
+"""
+
+
+@click.command()
+@click.option("--n-runs", "-n", type=int, default=3)
+@click.option("--load-workers", "-w", type=str, default="1,4")
+def startup_benchmark(n_runs: int, load_workers: str):
+    """
+    Time from starting a new inference server process to its first answered prediction,
+    split into startup phases, for different numbers of model loading threads
+    """
+    for workers in load_workers.split(","):
+        env = {**os.environ, "MODEL_LOAD_WORKERS": workers}
+        runs = []
+
+        for _ in range(n_runs):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, "-c", CHILD_SCRIPT],
+                                    env=env, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            result["process"] = time.perf_counter() - start
+            runs.append(result)
+
+        phases = {phase: np.mean([run["phases"][phase] for run in runs])
+                  for phase in runs[0]["phases"]}
+
+        print(
+            f"load_workers={workers:>2} "
+            f"first prediction={np.mean([run['process'] for run in runs]):.2f}s "
+            f"(imports={np.mean([run['import'] for run in runs]):.2f}s, "
+            + ", ".join(f"{phase}={seconds:.2f}s" for phase, seconds in phases.items())
+            + f", request={np.mean([run['first_prediction'] - run['ready'] for run in runs]):.2f}s)")
+
+
+if __name__ == "__main__":
+    startup_benchmark()
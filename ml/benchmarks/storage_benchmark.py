@@ -0,0 +1,83 @@
+import asyncio
+import os
+import socket
+import tempfile
+import threading
+import time
+
+import click
+import httpx
+import uvicorn
+from PIL import Image
+
+from ml.inference.file_server import create_file_server
+from ml.inference.utils import StorageClient, decode_image
+
+
+def __free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def __start_server(directory: str, latency_ms: float) -> str:
+    port = __free_port()
+    server = uvicorn.Server(uvicorn.Config(
+        create_file_server(directory, latency_ms), host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+
+    while not server.started:
+        time.sleep(0.05)
+
+    return f"http://127.0.0.1:{port}"
+
+
+def __fetch_blocking(server_url: str, file_paths) -> float:
+    # previous behaviour: one blocking request with a new connection per image, one image after another
+    start = time.perf_counter()
+    for file_path in file_paths:
+        response = httpx.get(f"{server_url}/uploads/{file_path}")
+        response.raise_for_status()
+        decode_image(response.content)
+    return time.perf_counter() - start
+
+
+async def __fetch_async(file_paths, max_concurrency: int) -> float:
+    client = StorageClient(max_concurrency=max_concurrency)
+    start = time.perf_counter()
+    await asyncio.gather(*[client.get_image(file_path) for file_path in file_paths])
+    elapsed = time.perf_counter() - start
+    await client.close()
+    return elapsed
+
+
+@click.command()
+@click.option("--n-images", "-n", type=int, default=64)
+@click.option("--latency-ms", "-l", type=float, default=20.0)
+@click.option("--concurrency", "-c", type=str, default="1,8,32")
+def storage_benchmark(n_images: int, latency_ms: float, concurrency: str):
+    """
+    Fetching and decoding images from the local stand-in file server with simulated storage latency,
+    blocking one by one (previous StorageClient) and with the pooled asynchronous StorageClient
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        file_paths = [f"image_{i}.jpg" for i in range(n_images)]
+        for i, file_path in enumerate(file_paths):
+            Image.new("RGB", (640, 480), (i % 256, 30, 30)).save(
+                os.path.join(directory, file_path), "JPEG")
+
+        server_url = __start_server(directory, latency_ms)
+        os.environ["GO_SERVER_URL"] = server_url
+
+        blocking_time = __fetch_blocking(server_url, file_paths)
+        print(f"blocking: {blocking_time * 1000 / n_images:.2f}ms/img")
+
+        for max_concurrency in [int(c) for c in concurrency.split(",")]:
+            async_time = asyncio.run(__fetch_async(file_paths, max_concurrency))
+            print(
+                f"async max_concurrency={max_concurrency:>3}: {async_time * 1000 / n_images:.2f}ms/img "
+                f"speedup={blocking_time / async_time:.1f}x")
+
+
+if __name__ == "__main__":
+    storage_benchmark()
@@ -0,0 +1,75 @@
+import logging
+
+import click
+import torch
+
+from ml.benchmarks import time_call
+from ml.models.hierarchy_node_model import HierarchyNodeModel
+from ml.scripts import train_single
+
+
+@click.command()
+@click.option("--n-batches", "-n", type=int, default=20)
+@click.option("--batch-size", "-b", type=int, default=16)
+@click.option("--size", "-s", type=int, default=100)
+@click.option("--n-classes", "-c", type=int, default=5)
+@click.option("--device", "-d", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+def train_epoch_benchmark(n_batches: int, batch_size: int, size: int, n_classes: int, device: str):
+    """
+    Time of a training epoch (with train accuracy measured on every batch and on every 10th one)
+    and of a validation epoch of a node model over `n_batches` random batches already on `device`,
+    then of both with channels last and mixed precision
+    """
+    device = torch.device(device)
+    torch.manual_seed(0)
+
+    batches = [(torch.randn(batch_size, 3, size, size, device=device),
+                torch.randint(0, n_classes, (batch_size,), device=device)) for _ in range(n_batches)]
+    logger = logging.getLogger("train_epoch_benchmark")
+
+    def synchronize():
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+
+    for interval in [1, 10]:
+        model = HierarchyNodeModel(num_classes=n_classes).to(device)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+        scheduler = torch.optim.lr_scheduler.OneCycleLR(
+            optimizer, max_lr=1e-3, total_steps=2 * n_batches)
+
+        def train():
+            train_single.__train_epoch(model=model, loader=batches, optimizer=optimizer, scheduler=scheduler,
+                                       logger=logger, train_accuracy_interval=interval)
+
+        # first epoch warms up the allocator and kernels
+        elapsed = time_call(train, 1, synchronize=synchronize)
+        print(f"train epoch, accuracy every {interval:>2} batches: {elapsed * 1000 / n_batches:7.2f}ms/batch")
+
+    elapsed = time_call(lambda: train_single.__validate(model, batches), 1, n_warmup=0, synchronize=synchronize)
+    print(f"validation epoch: {elapsed * 1000 / n_batches:7.2f}ms/batch")
+
+    for mixed_precision, channels_last in [(False, True), (True, False), (True, True)]:
+        autocast_dtype, scaler = train_single.__create_mixed_precision(
+            device) if mixed_precision else (None, None)
+        memory_format = torch.channels_last if channels_last else torch.contiguous_format
+
+        model = HierarchyNodeModel(num_classes=n_classes).to(device, memory_format=memory_format)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+        scheduler = torch.optim.lr_scheduler.OneCycleLR(
+            optimizer, max_lr=1e-3, total_steps=2 * n_batches)
+
+        def train():
+            train_single.__train_epoch(model=model, loader=batches, optimizer=optimizer, scheduler=scheduler,
+                                       logger=logger, autocast_dtype=autocast_dtype, scaler=scaler,
+                                       memory_format=memory_format)
+
+        elapsed = time_call(train, 1, synchronize=synchronize)
+        name = f"{autocast_dtype or torch.float32}{', channels last' if channels_last else ''}"
+        print(f"train epoch, {name}: {elapsed * 1000 / n_batches:7.2f}ms/batch")
+
+        elapsed = time_call(lambda: train_single.__validate(model, batches, autocast_dtype, memory_format), 1,
+                            n_warmup=0, synchronize=synchronize)
+        print(f"validation epoch, {name}: {elapsed * 1000 / n_batches:7.2f}ms/batch")
+
+if __name__ == "__main__":
+    train_epoch_benchmark()
@@ -0,0 +1,70 @@
+import io
+import json
+import os
+
+import click
+import numpy as np
+from PIL import Image
+
+from ml.benchmarks import create_photo, encode_photo, time_call
+from ml.utils.constants import DATA_DIR
+from ml.utils.transforms import FastTransform, create_transform_pipeline
+
+
+def __with_alpha(image: Image.Image) -> Image.Image:
+    # transparency fading from left to right
+    image = image.convert("RGBA")
+    image.putalpha(Image.linear_gradient("L").rotate(90).resize(image.size))
+    return image
+
+
+def __time(transform, images, n_repeats: int) -> float:
+    # per image
+    return time_call(lambda: [transform(Image.open(io.BytesIO(data))) for data in images],
+                     n_repeats, n_warmup=0) / len(images)
+
+
+@click.command()
+@click.option("--n-images", "-n", type=int, default=8)
+@click.option("--n-repeats", "-r", type=int, default=3)
+@click.option("--sizes", "-s", type=str, default="640x480,2000x1500,4000x3000")
+@click.option("--max-mean-difference", type=float, default=0.05)
+def transform_benchmark(n_images: int, n_repeats: int, sizes: str, max_mean_difference: float):
+    """
+    Decode + transform time per image of the exact torchvision pipeline and FastTransform,
+    with drift of FastTransform outputs in normalized units (asserted to stay below `max_mean_difference` on average)
+    """
+    config = json.load(open(os.path.join(DATA_DIR, "config.json"), "r"))
+    min_size = (config["min_size"][0], config["min_size"][1])
+
+    exact = create_transform_pipeline(min_size, config["mean"], config["std"])
+    fast = FastTransform(min_size, config["mean"], config["std"])
+
+    for size in sizes.split(","):
+        width, height = [int(value) for value in size.split("x")]
+
+        for image_format, alpha in [("JPEG", False), ("PNG", False), ("PNG", True)]:
+            images = [encode_photo(__with_alpha(create_photo(width, height, seed)) if alpha else
+                                   create_photo(width, height, seed), image_format)
+                      for seed in range(n_images)]
+            image_format = f"{image_format}A" if alpha else image_format
+
+            differences = np.concatenate([
+                (exact(Image.open(io.BytesIO(data))) -
+                 fast(Image.open(io.BytesIO(data)))).abs().flatten().numpy()
+                for data in images])
+
+            exact_time = __time(exact, images, n_repeats)
+            fast_time = __time(fast, images, n_repeats)
+
+            print(
+                f"{size:>9} {image_format:<4} exact={exact_time * 1000:7.2f}ms fast={fast_time * 1000:6.2f}ms "
+                f"speedup={exact_time / fast_time:5.1f}x "
+                f"difference mean={differences.mean():.4f} p99={np.percentile(differences, 99):.4f}")
+
+            assert differences.mean() < max_mean_difference, \
+                f"FastTransform drifted from the exact pipeline by {differences.mean():.4f} on average"
+
+
+if __name__ == "__main__":
+    transform_benchmark()
@@ -0,0 +1,58 @@
+import asyncio
+import base64
+import time
+
+import click
+import httpx
+
+from ml.benchmarks import create_photo, encode_photo
+from ml.inference.app import app
+
+
+async def __time(send, n_repeats: int) -> float:
+    # first request fills the prediction cache, the rest measure only the cost of getting the image in
+    (await send()).raise_for_status()
+
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        (await send()).raise_for_status()
+    return (time.perf_counter() - start) / n_repeats
+
+
+@click.command()
+@click.option("--sizes", "-s", type=str, default="1600x1200,2400x1800")
+@click.option("--n-repeats", "-r", type=int, default=10)
+def upload_benchmark(sizes: str, n_repeats: int):
+    """
+    Request overhead of sending a product photo as base64 json (/predict), raw body (/predict/binary)
+    and multipart file (/predict/batch). Predictions come from the prediction cache after the first request,
+    so the times are what receiving, parsing, decoding the transport encoding and hashing the image cost.
+    """
+    async def main():
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+                for size in sizes.split(","):
+                    width, height = [int(value) for value in size.split("x")]
+                    # strong noise barely compresses, which gives the multi megabyte files suppliers upload
+                    data = encode_photo(create_photo(width, height, noise=100), quality=95)
+                    encoded = base64.b64encode(data).decode("ascii")
+
+                    senders = {
+                        "base64 json": (len(encoded), lambda: client.post("/predict", json={"imageData": encoded})),
+                        "binary": (len(data), lambda: client.post("/predict/binary", content=data,
+                                                                  headers={"content-type": "application/octet-stream"})),
+                        "multipart": (len(data), lambda: client.post("/predict/batch",
+                                                                     files=[("files", ("image.jpg", data, "image/jpeg"))])),
+                    }
+
+                    print(f"{size} jpeg of {len(data) / 1024 ** 2:.2f}MB")
+                    for name, (payload, send) in senders.items():
+                        elapsed = await __time(send, n_repeats)
+                        print(
+                            f"  {name:>11}: payload={payload / 1024 ** 2:.2f}MB {elapsed * 1000:7.2f}ms/request")
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    upload_benchmark()
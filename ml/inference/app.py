@@ -1,23 +1,168 @@
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager, contextmanager
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from typing import Dict
+from typing import Any, Dict, List, Tuple
 from dotenv import load_dotenv, find_dotenv
+import asyncio
+import io
+import os
 import time
 
+import torch
+from PIL import Image, UnidentifiedImageError
+
 from ml.models import HierarchyModel
 from ml.utils.hierarchy import Hierarchy
-from ml.inference.utils import StorageClient, base64_to_pil
+from ml.utils.logger import create_file_logger
+from ml.inference.batching import MicroBatcher
+from ml.inference.prediction_cache import PredictionCache, get_registry_version
+from ml.inference.utils import StorageClient, base64_to_bytes, get_top_k_predictions, to_predictions
+from ml.utils.constants import MODELS_REGISTRY_PATH
+
+
+logger = create_file_logger("inference.log")
+
+# number of categories returned by /predict
+PREDICT_TOP_K = 5
+
+
+@contextmanager
+def __startup_phase(app: FastAPI, phase: str):
+    start = time.perf_counter()
+    yield
+    app.startup_times[phase] = time.perf_counter() - start
+    logger.info(f"Startup phase {phase} took {app.startup_times[phase]:.3f}s")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # first requests would otherwise pay for lazy initialization of the models
+    with __startup_phase(app, "warmup"):
+        await run_in_threadpool(app.model.warmup, app.warmup_batch_sizes)
+
+    await app.batcher.start()
+
+    # /ready only reports the app as ready once the models are warmed up and requests are being batched
+    app.ready = True
+    logger.info(
+        f"Ready after {time.perf_counter() - app.start_time:.3f}s")
+
+    yield
+
+    app.ready = False
+    await app.batcher.stop()
+    await app.storage_client.close()
+
+
+def __create_model(hierarchy: Hierarchy) -> HierarchyModel:
+    if os.getenv("INFERENCE_BACKEND", "torch") == "onnx":
+        # imported lazily so that onnxruntime is only needed when the backend is used
+        from ml.models.onnx_hierarchy_model import OnnxHierarchyModel
+        return OnnxHierarchyModel(hierarchy=hierarchy)
+
+    return HierarchyModel(
+        hierarchy=hierarchy,
+        fused=os.getenv("FUSED_INFERENCE", "false") == "true",
+        quantized=os.getenv("QUANTIZED_INFERENCE", "false") == "true",
+        optimized=os.getenv("OPTIMIZE_INFERENCE", "false") == "true",
+        compile_mode=os.getenv("COMPILE_MODE", "none"),
+        lazy=os.getenv("LAZY_MODEL_LOADING", "false") == "true",
+        cache_max_models=int(os.getenv("MODEL_CACHE_MAX_MODELS")) if os.getenv(
+            "MODEL_CACHE_MAX_MODELS") else None,
+        cache_max_memory_mb=float(os.getenv("MODEL_CACHE_MAX_MEMORY_MB")) if os.getenv(
+            "MODEL_CACHE_MAX_MEMORY_MB") else None,
+        pinned_depth=int(os.getenv("MODEL_CACHE_PINNED_DEPTH", "1")),
+        load_workers=int(os.getenv("MODEL_LOAD_WORKERS")) if os.getenv(
+            "MODEL_LOAD_WORKERS") else None,
+        fast_transform=os.getenv("FAST_PREPROCESSING", "false") == "true"
+    )
 
 
 def start_app():
     load_dotenv(find_dotenv())
-    app = FastAPI()
-    hierarchy = Hierarchy()
-    app.model = HierarchyModel(hierarchy=hierarchy)
+    app = FastAPI(lifespan=lifespan)
+    app.ready = False
+    app.start_time = time.perf_counter()
+    app.startup_times = {}
+
+    with __startup_phase(app, "hierarchy"):
+        hierarchy = Hierarchy()
+
+    with __startup_phase(app, "model"):
+        app.model = __create_model(hierarchy)
+
+    for phase, seconds in app.model.load_times.items():
+        logger.info(f"Model loading phase {phase} took {seconds:.3f}s")
 
     app.categories = hierarchy.get_categories_list()
 
+    # pruned inference only walks the subtrees that are still probable for each image
+    pruned = os.getenv("PRUNED_INFERENCE", "false") == "true"
+    beam_width = int(os.getenv("PRUNE_BEAM_WIDTH")) if os.getenv(
+        "PRUNE_BEAM_WIDTH") else None
+    threshold = float(os.getenv("PRUNE_THRESHOLD", "0.0"))
+
+    if beam_width is not None and beam_width < 1:
+        raise ValueError(f"PRUNE_BEAM_WIDTH has to be at least 1, got {beam_width}")
+
+    if not 0 <= threshold <= 1:
+        raise ValueError(f"PRUNE_THRESHOLD has to be between 0 and 1, got {threshold}")
+
+    if app.model.lazy and not pruned:
+        # dense inference runs every node model for every request, a cache smaller than the hierarchy reloads them all the time
+        logger.warning(
+            "LAZY_MODEL_LOADING without PRUNED_INFERENCE touches every node model on each request, "
+            "node models are reloaded from disk whenever the model cache is smaller than the hierarchy")
+
+    def predict_rows(tensor: torch.Tensor, k: int = PREDICT_TOP_K) -> List[Tuple[Dict[str, float], int]]:
+        # top k predictions and number of node models evaluated for every image in the batch
+        if pruned:
+            probs, n_evaluated = app.model.predict_pruned(
+                tensor, beam_width, threshold)
+            return [(get_top_k_predictions(image_probs, app.categories, k), image_evaluated)
+                    for image_probs, image_evaluated in zip(probs, n_evaluated.tolist())]
+
+        # only the top k leaves of every image are copied from the device
+        values, indices = app.model.predict_top_k(tensor, k)
+        return [(to_predictions(image_values, image_indices, app.categories), len(app.model.plan))
+                for image_values, image_indices in zip(values, indices)]
+
+    app.predict_rows = predict_rows
+
+    # concurrent /predict requests are grouped into a single forward pass of the hierarchy
+    app.batcher = MicroBatcher(
+        app.predict_rows,
+        max_batch_size=int(os.getenv("MAX_BATCH_SIZE", "16")),
+        max_wait_ms=float(os.getenv("MAX_BATCH_WAIT_MS", "5"))
+    )
+
+    # largest body accepted by /predict/binary
+    app.max_upload_bytes = int(float(os.getenv("MAX_UPLOAD_MB", "20")) * 1024 ** 2)
+
+    # number of images that /predict/batch pushes through the hierarchy in one forward pass
+    app.batch_predict_size = int(os.getenv("BATCH_PREDICT_SIZE", "64"))
+
+    # batch sizes the models are warmed up with, the single image and the largest micro batch are the common ones
+    app.warmup_batch_sizes = sorted({1, app.batcher.max_batch_size})
+
     app.storage_client = StorageClient()
+
+    # cached predictions are only valid for the models and inference settings that produced them
+    model_version = ":".join([
+        get_registry_version(MODELS_REGISTRY_PATH),
+        os.getenv("INFERENCE_BACKEND", "torch"),
+        os.getenv("QUANTIZED_INFERENCE", "false"),
+        os.getenv("FAST_PREPROCESSING", "false"),
+        str(pruned), str(beam_width), str(threshold)
+    ])
+    app.prediction_cache = PredictionCache(
+        model_version,
+        max_entries=int(os.getenv("PREDICTION_CACHE_SIZE", "1024")),
+        ttl_s=float(os.getenv("PREDICTION_CACHE_TTL_S", "3600")),
+        disk_path=os.getenv("PREDICTION_CACHE_DIR"),
+        max_disk_entries=int(os.getenv("PREDICTION_CACHE_MAX_DISK_ENTRIES", "100000"))
+    )
     return app
 
 
@@ -32,6 +177,19 @@ class ImageRequest(BaseModel):
 class PredictionResponse(BaseModel):
     predictions: Dict[str, float]
     processing_time: float
+    evaluated_nodes: int  # number of node models that were run for the image
+
+
+class BatchPredictionResult(BaseModel):
+    source: str  # file path or uploaded file name the predictions belong to
+    predictions: Dict[str, float]
+    evaluated_nodes: int = 0
+    error: str | None = None
+
+
+class BatchPredictionResponse(BaseModel):
+    results: List[BatchPredictionResult]
+    processing_time: float
 
 
 @app.post("/predict", response_model=PredictionResponse)
@@ -47,40 +205,226 @@ async def predict(request: ImageRequest) -> PredictionResponse:
     """
     start_time = time.time()
 
-    # Get image from request data
-    image = None
+    # Get image bytes from request data
+    data = None
     if request.filePath:
-        image = app.storage_client.get_image(request.filePath)
-    elif request.imageBase64:
-        image = base64_to_pil(request.imageBase64)
+        data = await app.storage_client.fetch(request.filePath)
+    elif request.imageData:
+        data = base64_to_bytes(request.imageData)
     else:
         raise HTTPException(status_code=400, detail="No image data provided")
 
-    # preprocess
-    tensor = app.model.transform_image(image)
+    return await __predict_data(data, start_time)
+
+
+@app.post("/predict/binary", response_model=PredictionResponse)
+async def predict_binary(request: Request) -> PredictionResponse:
+    """
+    Same as /predict for a raw image sent as the request body (application/octet-stream),
+    which avoids base64 encoding (a third larger payload), json parsing and the decoding copy.
+
+    Returns:
+        PredictionResponse with predictions and processing time
+    """
+    start_time = time.time()
 
-    # add dimension to simulate batch size
-    tensor = tensor.unsqueeze(0)
+    content_length = request.headers.get("content-length")
+    if content_length is not None and int(content_length) > app.max_upload_bytes:
+        raise HTTPException(status_code=413, detail="Image is too large")
 
-    probs = app.model.predict(tensor)
+    # chunks are joined once at the end, the bytes go straight to the decoder from there
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > app.max_upload_bytes:
+            raise HTTPException(status_code=413, detail="Image is too large")
+        chunks.append(chunk)
 
-    probs = probs.squeeze(0)
+    if size == 0:
+        raise HTTPException(status_code=400, detail="No image data provided")
 
-    # Get top 5 indices
-    top5_indices = probs.argsort()[-5:][::-1]
+    return await __predict_data(b"".join(chunks), start_time)
 
-    # Get top 5 probabilities
-    top5_probs = probs[top5_indices]
 
-    # Get top 5 categories
-    predictions = {
-        app.categories[index]: round(float(prob), 5) for index, prob in zip(top5_indices, top5_probs)
-    }
+async def __predict_data(data: bytes, start_time: float) -> PredictionResponse:
+    # the same photo is decoded and predicted only once, concurrent requests for it share the computation
+    predictions, evaluated_nodes = await app.prediction_cache.get_or_compute(
+        data, PREDICT_TOP_K, lambda: __predict_bytes(data))
 
     processing_time = time.time() - start_time
 
     return PredictionResponse(
         predictions=predictions,
+        processing_time=processing_time,
+        evaluated_nodes=evaluated_nodes
+    )
+
+
+@app.get("/ready")
+async def ready() -> Dict[str, Any]:
+    if not app.ready:
+        raise HTTPException(status_code=503, detail="Model is not ready")
+
+    return {"status": "ready", "startup_times": app.startup_times}
+
+
+@app.get("/metrics")
+async def metrics() -> Dict[str, Any]:
+    return {
+        "startup": {"phases": app.startup_times, "model_loading": app.model.load_times},
+        "batcher": app.batcher.get_stats(),
+        "model_cache": app.model.get_model_cache_stats(),
+        "prediction_cache": app.prediction_cache.get_stats(),
+    }
+
+
+def __load_from_bytes(data: bytes) -> torch.Tensor:
+    try:
+        image = Image.open(io.BytesIO(data))
+    except UnidentifiedImageError as e:
+        raise HTTPException(
+            status_code=400, detail=f"Invalid image data: {str(e)}")
+
+    return app.model.transform_image(image)
+
+
+async def __predict_bytes(data: bytes) -> Tuple[Dict[str, float], int]:
+    # preprocess in the threadpool so that other requests are served (and fetched) meanwhile
+    tensor = await run_in_threadpool(__load_from_bytes, data)
+
+    # batcher stacks this tensor with other waiting requests and returns only this image's row
+    return await app.batcher.submit(tensor)
+
+
+async def __predict_bytes_top_k(data: bytes, k: int) -> Tuple[Dict[str, float], int]:
+    # the batcher only returns PREDICT_TOP_K categories
+    tensor = await run_in_threadpool(__load_from_bytes, data)
+    rows = await run_in_threadpool(app.predict_rows, tensor.unsqueeze(0), k)
+    return rows[0]
+
+
+def __error_result(source: str, error: Exception) -> BatchPredictionResult:
+    return BatchPredictionResult(source=source, predictions={}, error=str(error) or type(error).__name__)
+
+
+def __prediction_result(source: str, row: Tuple[Dict[str, float], int]) -> BatchPredictionResult:
+    predictions, evaluated_nodes = row
+    return BatchPredictionResult(source=source, predictions=predictions, evaluated_nodes=evaluated_nodes)
+
+
+@app.post("/predict/batch", response_model=BatchPredictionResponse)
+async def predict_batch(
+    filePaths: List[str] = Form(default=[]),
+    files: List[UploadFile] = File(default=[]),
+    topK: int = Form(default=5, ge=1)
+) -> BatchPredictionResponse:
+    """
+    Process many images in one call and return top k predictions for each of them.
+
+    Args:
+        filePaths: locations of image files in storage (multipart form fields)
+        files: raw image files (multipart file parts)
+        topK: number of categories returned per image
+
+    Returns:
+        BatchPredictionResponse with one result per image, file paths first and uploaded files after them
+    """
+    start_time = time.time()
+
+    if len(filePaths) == 0 and len(files) == 0:
+        raise HTTPException(status_code=400, detail="No image data provided")
+
+    sources = list(filePaths) + [file.filename or "" for file in files]
+
+    # downloads run concurrently on the event loop
+    jobs = [app.storage_client.fetch(path) for path in filePaths]
+    jobs.extend(file.read() for file in files)
+
+    loaded = await asyncio.gather(*jobs, return_exceptions=True)
+
+    results = [
+        __error_result(source, data) if isinstance(data, Exception) else None
+        for source, data in zip(sources, loaded)
+    ]
+
+    # images already predicted are taken from the cache, images being predicted by another request are
+    # awaited once this request resolved its own claims (waiting while holding them could deadlock two batches),
+    # every distinct image that is left is computed once even if it appears several times in this batch
+    claimed: Dict[str, List[int]] = {}
+    in_flight: Dict[str, List[int]] = {}
+
+    # hashing multi megabyte uploads would block the event loop
+    keys = await run_in_threadpool(lambda: [
+        None if isinstance(data, Exception) else app.prediction_cache.key(data, topK) for data in loaded])
+
+    for i, (data, key) in enumerate(zip(loaded, keys)):
+        if key is None:
+            continue
+
+        if key in claimed:
+            claimed[key].append(i)
+            continue
+
+        if key in in_flight or app.prediction_cache.is_in_flight(key):
+            in_flight.setdefault(key, []).append(i)
+            continue
+
+        # does not wait, the key is not in flight
+        value, is_claimed = await app.prediction_cache.lookup_or_claim(key, len(data))
+        if is_claimed:
+            claimed[key] = [i]
+        else:
+            results[i] = __prediction_result(sources[i], value)
+
+    try:
+        # decoding is PIL bound and runs in the threadpool
+        keys = list(claimed.keys())
+        tensors = await asyncio.gather(
+            *[run_in_threadpool(__load_from_bytes, loaded[claimed[key][0]]) for key in keys], return_exceptions=True)
+
+        for key, tensor in zip(keys, tensors):
+            if isinstance(tensor, Exception):
+                app.prediction_cache.fail(key, tensor)
+                for i in claimed.pop(key):
+                    results[i] = __error_result(sources[i], tensor)
+
+        valid = [(key, tensor) for key, tensor in zip(keys, tensors) if key in claimed]
+
+        # run the hierarchy on real batches instead of one image at a time
+        for start in range(0, len(valid), app.batch_predict_size):
+            chunk = valid[start:start + app.batch_predict_size]
+            tensors = torch.stack([tensor for _, tensor in chunk])
+
+            rows = await run_in_threadpool(app.predict_rows, tensors, topK)
+
+            for (key, _), row in zip(chunk, rows):
+                app.prediction_cache.resolve(key, row)
+                for i in claimed.pop(key):
+                    results[i] = __prediction_result(sources[i], row)
+    except BaseException as e:
+        # other requests may wait for the keys this one claimed
+        for key in claimed:
+            app.prediction_cache.fail(key, e)
+        raise
+
+    # the other request may have failed meanwhile, the image is then predicted on its own
+    keys = list(in_flight.keys())
+    rows = await asyncio.gather(*[
+        app.prediction_cache.get_or_compute(
+            loaded[in_flight[key][0]], topK, lambda data=loaded[in_flight[key][0]]: __predict_bytes_top_k(data, topK))
+        for key in keys
+    ], return_exceptions=True)
+
+    for key, row in zip(keys, rows):
+        for i in in_flight[key]:
+            results[i] = __error_result(sources[i], row) if isinstance(
+                row, Exception) else __prediction_result(sources[i], row)
+
+    processing_time = time.time() - start_time
+
+    return BatchPredictionResponse(
+        results=results,
         processing_time=processing_time
     )
 
@@ -0,0 +1,129 @@
+import asyncio
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+import torch
+
+
+class MicroBatcher:
+    """
+    Collects single image requests into batches so that the hierarchy model
+    runs one forward pass for many concurrent callers.
+
+    A batch is dispatched as soon as it holds `max_batch_size` images or when
+    the oldest queued image has waited `max_wait_ms`, whichever happens first.
+    """
+
+    def __init__(self, predict_fn: Callable[[torch.Tensor], Sequence[Any]], max_batch_size: int = 16, max_wait_ms: float = 5.0):
+        # predict_fn receives a stacked batch and has to return a sequence with one entry per input row
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker: Optional[asyncio.Task] = None
+
+        self.n_batches = 0
+        self.n_items = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        if self.worker is None:
+            return
+
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+
+        self.worker = None
+
+        # fail requests that were still waiting so that their handlers do not hang
+        while not self.queue.empty():
+            _, future = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Batcher was stopped"))
+
+    async def submit(self, tensor: torch.Tensor) -> Any:
+        """
+        Enqueue a single image tensor (without batch dimension) and wait for its own result
+        """
+        if self.worker is None:
+            raise RuntimeError("Batcher is not running")
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((tensor, future))
+
+        return await future
+
+    def get_stats(self) -> dict:
+        return {
+            "batches": self.n_batches,
+            "items": self.n_items,
+            "avg_batch_size": self.n_items / self.n_batches if self.n_batches > 0 else 0.0,
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+        }
+
+    async def __collect_batch(self) -> List[Tuple[torch.Tensor, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+
+        # block until there is at least one request, the wait window starts with it
+        first = await self.queue.get()
+        batch = [first]
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            # take everything that is already waiting without yielding to the loop
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = await self.__collect_batch()
+
+            # callers that gave up (e.g. client disconnected) do not need a slot in the batch
+            batch = [item for item in batch if not item[1].done()]
+            if len(batch) == 0:
+                continue
+
+            try:
+                # a tensor of another shape fails only the requests of this batch, the worker keeps running
+                tensors = torch.stack([tensor for tensor, _ in batch])
+
+                # inference runs in a worker thread so that the event loop keeps accepting requests,
+                # which is what lets the next batch fill up while this one is being computed
+                results = await loop.run_in_executor(None, self.predict_fn, tensors)
+            except asyncio.CancelledError:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(RuntimeError("Batcher was stopped"))
+                raise
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.n_batches += 1
+            self.n_items += len(batch)
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,44 @@
+import asyncio
+import os
+
+import click
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import FileResponse
+
+
+def create_file_server(directory: str, latency_ms: float = 0.0) -> FastAPI:
+    """
+    Local stand-in for the Go server's /uploads/ route, serves files of `directory`.
+    `latency_ms` delays every response to imitate a remote storage when testing or benchmarking StorageClient.
+    """
+    app = FastAPI()
+    root = os.path.realpath(directory)
+
+    @app.get("/uploads/{file_path:path}")
+    async def uploads(file_path: str) -> FileResponse:
+        if latency_ms > 0:
+            await asyncio.sleep(latency_ms / 1000)
+
+        path = os.path.realpath(os.path.join(root, file_path))
+
+        # same as http.Dir in Go, paths must not escape the served directory
+        if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+            raise HTTPException(status_code=404, detail="File not found")
+
+        return FileResponse(path)
+
+    return app
+
+
+@click.command()
+@click.option("--directory", "-d", type=str, default="./uploads")
+@click.option("--port", "-p", type=int, default=4200)
+@click.option("--latency-ms", "-l", type=float, default=0.0)
+def file_server(directory: str, port: int, latency_ms: float):
+    import uvicorn
+    uvicorn.run(create_file_server(directory, latency_ms),
+                host="127.0.0.1", port=port)
+
+
+if __name__ == "__main__":
+    file_server()
@@ -0,0 +1,240 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+
+def get_registry_version(registry_path: str) -> str:
+    """
+    Fingerprint of every file in the model registry (name, size and modification time),
+    changes whenever a model is retrained, quantized, exported or packed again
+    """
+    digest = hashlib.sha256()
+
+    for directory, _, files in sorted(os.walk(registry_path)):
+        for file in sorted(files):
+            stat = os.stat(os.path.join(directory, file))
+            digest.update(
+                f"{os.path.relpath(os.path.join(directory, file), registry_path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+
+    return digest.hexdigest()[:16]
+
+
+class PredictionCache:
+    """
+    Content addressed cache of predictions, keyed by hash of the image bytes, number of returned
+    categories and model version, so the same photo is predicted once no matter where it comes from.
+
+    Entries live in an in memory LRU (at most `max_entries`, each for `ttl_s` seconds) and optionally in
+    `disk_path` (at most `max_disk_entries` json files) so they survive restarts and are shared by workers.
+    Hashing and disk reads and writes run in the default executor, never on the event loop.
+    The disk tier is an LRU of file names listed once on the first write, files written by other workers
+    meanwhile are counted only after a restart.
+    Concurrent requests for the same key share one in flight computation (singleflight).
+    Values have to be json serializable, values read from disk come back with lists instead of tuples.
+    """
+
+    def __init__(self, model_version: str, max_entries: int = 1024, ttl_s: float = 3600, disk_path: Optional[str] = None, max_disk_entries: int = 100000):
+        self.model_version = model_version
+        self.max_entries = max_entries
+        self.ttl = ttl_s
+        self.disk_path = disk_path
+        self.max_disk_entries = max_disk_entries
+
+        if disk_path is not None:
+            os.makedirs(disk_path, exist_ok=True)
+
+        # key -> (expiration time, value)
+        self.entries: OrderedDict[str, Tuple[float, Any]] = OrderedDict()
+        self.in_flight: Dict[str, asyncio.Future] = {}
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+        # file names on disk from least to most recently used, written and read from executor threads
+        self.disk_files: Optional[OrderedDict[str, None]] = None
+        self.disk_lock = threading.Lock()
+
+    def key(self, data: bytes, k: int) -> str:
+        digest = hashlib.sha256(data)
+        digest.update(f":{k}:{self.model_version}".encode())
+        return digest.hexdigest()
+
+    def __disk_file(self, key: str) -> str:
+        return os.path.join(self.disk_path, f"{key}.json")
+
+    def __read_disk(self, key: str) -> Optional[Any]:
+        try:
+            if time.time() - os.path.getmtime(self.__disk_file(key)) > self.ttl:
+                return None
+
+            with open(self.__disk_file(key), "r") as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        with self.disk_lock:
+            if self.disk_files is not None:
+                self.disk_files[key] = None
+                self.disk_files.move_to_end(key)
+
+        return value
+
+    def __list_disk_files(self) -> OrderedDict[str, None]:
+        files = []
+        for file in os.listdir(self.disk_path):
+            if file.endswith(".json"):
+                try:
+                    files.append((os.path.getmtime(os.path.join(self.disk_path, file)), file[:-len(".json")]))
+                except OSError:
+                    pass
+
+        return OrderedDict((key, None) for _, key in sorted(files))
+
+    def __write_disk(self, key: str, value: Any):
+        try:
+            tmp_path = f"{self.__disk_file(key)}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, self.__disk_file(key))
+
+            with self.disk_lock:
+                # the directory is scanned once, later writes only evict the least recently used files
+                if self.disk_files is None:
+                    self.disk_files = self.__list_disk_files()
+
+                self.disk_files[key] = None
+                self.disk_files.move_to_end(key)
+
+                while len(self.disk_files) > self.max_disk_entries:
+                    evicted, _ = self.disk_files.popitem(last=False)
+                    try:
+                        os.remove(self.__disk_file(evicted))
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+
+    def __store(self, key: str, value: Any):
+        if self.max_entries > 0:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def is_in_flight(self, key: str) -> bool:
+        return key in self.in_flight
+
+    async def lookup_or_claim(self, key: str, n_bytes: int = 0) -> Tuple[Optional[Any], bool]:
+        """
+        Returns (value, False) when the key is cached or computed by someone else meanwhile,
+        otherwise (None, True) and the caller has to `resolve` or `fail` the key.
+        `n_bytes` is the size of the image, counted as saved when it does not need to be processed.
+        Waits for keys in flight, a caller holding claims must not wait (see `is_in_flight`),
+        two requests waiting on each other's claims would never finish.
+        """
+        while True:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    self.bytes_saved += n_bytes
+                    return entry[1], False
+
+                del self.entries[key]
+
+            if key in self.in_flight:
+                try:
+                    value = await asyncio.shield(self.in_flight[key])
+                except Exception:
+                    # computation of the other request failed, this one tries on its own
+                    continue
+
+                self.coalesced += 1
+                self.bytes_saved += n_bytes
+                return value, False
+
+            # the key is claimed before the disk is read, requests coming meanwhile wait for the read
+            self.in_flight[key] = asyncio.get_running_loop().create_future()
+
+            if self.disk_path is not None:
+                try:
+                    value = await asyncio.to_thread(self.__read_disk, key)
+                except BaseException as e:
+                    self.fail(key, e)
+                    raise
+
+                if value is not None:
+                    self.__settle(key, value)
+                    self.disk_hits += 1
+                    self.bytes_saved += n_bytes
+                    return value, False
+
+            self.misses += 1
+            return None, True
+
+    def __settle(self, key: str, value: Any):
+        self.__store(key, value)
+
+        future = self.in_flight.pop(key)
+        future.set_result(value)
+
+    def resolve(self, key: str, value: Any):
+        self.__settle(key, value)
+
+        # nobody waits for the file, the write runs in the background
+        if self.disk_path is not None:
+            asyncio.get_running_loop().run_in_executor(None, self.__write_disk, key, value)
+
+    def fail(self, key: str, error: BaseException):
+        future = self.in_flight.pop(key)
+
+        # waiters retry on exceptions, a cancelled computation must not cancel them
+        if not isinstance(error, Exception):
+            error = RuntimeError("Prediction was cancelled")
+
+        future.set_exception(error)
+        # nobody may be waiting, the exception is retrieved so that asyncio does not log it as unhandled
+        future.exception()
+
+    async def get_or_compute(self, data: bytes, k: int, compute: Callable[[], Awaitable[Any]]) -> Any:
+        # hashing a multi megabyte upload would block the event loop
+        key = await asyncio.to_thread(self.key, data, k)
+        value, claimed = await self.lookup_or_claim(key, len(data))
+
+        if not claimed:
+            return value
+
+        try:
+            value = await compute()
+        except BaseException as e:
+            self.fail(key, e)
+            raise
+
+        self.resolve(key, value)
+        return value
+
+    def get_stats(self) -> dict:
+        hits = self.hits + self.disk_hits + self.coalesced
+        requests = hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_ratio": hits / requests if requests > 0 else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "entries": len(self.entries),
+            "in_flight": len(self.in_flight),
+            "model_version": self.model_version,
+        }
@@ -1,51 +1,159 @@
 from PIL import Image
-import base64
+from typing import Dict, List, Optional
+import asyncio
+import binascii
 import io
-import requests
 import os
+import httpx
+import numpy as np
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError, ServiceRequestError
 from fastapi import HTTPException
-from azure.storage.blob import BlobServiceClient
+from fastapi.concurrency import run_in_threadpool
 
 
-def base64_to_pil(base64_string: str) -> Image.Image:
-    # We should use that later for supporting base64 encoded images
-    """Convert base64 string to PIL Image."""
+def base64_to_bytes(base64_string: str) -> bytes:
+    """Decode base64 string (optionally a data URL) into raw image bytes."""
     try:
-        # Remove data URL prefix if present
-        if "base64," in base64_string:
-            base64_string = base64_string.split("base64,")[1]
+        # Remove data URL prefix if present, only the (short) header is searched, not the whole payload
+        prefix_end = base64_string.find("base64,", 0, 256)
+        if prefix_end != -1:
+            base64_string = base64_string[prefix_end + len("base64,"):]
 
-        # Decode base64 string
-        image_data = base64.b64decode(base64_string)
+        # a2b_base64 reads ascii str directly, the decoded bytes are the only copy of the payload
+        return binascii.a2b_base64(base64_string)
+    except Exception as e:
+        raise HTTPException(
+            status_code=400, detail=f"Invalid image data: {str(e)}")
 
-        # Convert to PIL Image
-        image = Image.open(io.BytesIO(image_data))
 
-        return image
+def base64_to_pil(base64_string: str) -> Image.Image:
+    """Convert base64 string to PIL Image."""
+    try:
+        return Image.open(io.BytesIO(base64_to_bytes(base64_string)))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=400, detail=f"Invalid image data: {str(e)}")
 
 
+def decode_image(data: bytes) -> Image.Image:
+    image = Image.open(io.BytesIO(data))
+    # Image.open is lazy, pixels are decoded here so that it happens in the calling (worker) thread
+    image.load()
+    return image
+
+
+def to_predictions(values: np.ndarray, indices: np.ndarray, categories: List[str]) -> Dict[str, float]:
+    """Map top k leaf indices of a single image and their probabilities to rounded probabilities per category."""
+    return {
+        categories[index]: round(float(value), 5) for index, value in zip(indices, values)
+    }
+
+
+def get_top_k_predictions(probs: np.ndarray, categories: List[str], k: int = 5) -> Dict[str, float]:
+    """Map the k most probable leaf categories of a single image to their rounded probabilities."""
+    top_k_indices = probs.argsort()[-k:][::-1]
+
+    return to_predictions(probs[top_k_indices], top_k_indices, categories)
+
+
 class StorageClient:
-    def __init__(self):
+    """
+    Asynchronous image storage (Go server uploads or Azure blob storage).
+
+    One pooled client with keep-alive connections is shared by all requests, at most `max_concurrency`
+    downloads run at once, each attempt is bounded by `timeout` seconds and transient failures
+    (connection errors, timeouts, 5xx responses) are retried `retries` times with exponential backoff.
+    """
+
+    def __init__(self, max_concurrency: Optional[int] = None, timeout: Optional[float] = None, retries: Optional[int] = None):
         self.env = os.getenv('ENV', 'LOCAL')
+        self.max_concurrency = max_concurrency or int(
+            os.getenv('STORAGE_MAX_CONCURRENCY', '32'))
+        self.timeout = timeout or float(os.getenv('STORAGE_TIMEOUT_S', '10'))
+        self.retries = retries if retries is not None else int(
+            os.getenv('STORAGE_RETRIES', '2'))
+
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
         if self.env == 'AZURE':
+            # aio client is imported lazily, it needs aiohttp which the local setup does not
+            from azure.storage.blob.aio import BlobServiceClient
+
             conn_str = os.getenv('BLOB_STORAGE_CONNECTION_STRING')
             self.blob_client = BlobServiceClient.from_connection_string(
                 conn_str)
+            self.container_client = self.blob_client.get_container_client(
+                "images")
         else:
             self.server_url = os.getenv(
                 'GO_SERVER_URL', 'http://localhost:4200')
+            self.http_client = httpx.AsyncClient(
+                base_url=self.server_url,
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency
+                )
+            )
 
-    def get_image(self, file_path: str) -> Image.Image:
+    async def close(self):
         if self.env == 'AZURE':
-            container_name = "images"
-            blob_client = self.blob_client.get_container_client(container_name)
-            blob_data = blob_client.download_blob(file_path).readall()
-            return Image.open(io.BytesIO(blob_data))
+            await self.blob_client.close()
         else:
-            response = requests.get(
-                f"{self.go_server_url}/uploads/{file_path}", stream=True)
-            response.raise_for_status()
-            return Image.open(io.BytesIO(response.content))
+            await self.http_client.aclose()
+
+    async def __download(self, file_path: str) -> bytes:
+        if self.env == 'AZURE':
+            downloader = await asyncio.wait_for(
+                self.container_client.download_blob(file_path), self.timeout)
+            return await asyncio.wait_for(downloader.readall(), self.timeout)
+
+        response = await self.http_client.get(f"/uploads/{file_path}")
+        response.raise_for_status()
+        return response.content
+
+    @staticmethod
+    def __is_not_found(error: Exception) -> bool:
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code == 404
+
+        return isinstance(error, ResourceNotFoundError)
+
+    @staticmethod
+    def __is_transient(error: Exception) -> bool:
+        if isinstance(error, (httpx.TransportError, asyncio.TimeoutError, ServiceRequestError)):
+            return True
+
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code >= 500
+
+        if isinstance(error, HttpResponseError):
+            return error.status_code is not None and error.status_code >= 500
+
+        return False
+
+    async def fetch(self, file_path: str) -> bytes:
+        """Raw bytes of the image stored under `file_path`."""
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    return await self.__download(file_path)
+            except Exception as e:
+                if self.__is_not_found(e):
+                    raise HTTPException(
+                        status_code=404, detail=f"Image {file_path} not found")
+
+                if not self.__is_transient(e) or attempt == self.retries:
+                    raise HTTPException(
+                        status_code=502, detail=f"Failed to fetch image {file_path}: {str(e) or type(e).__name__}")
+
+            # backoff happens outside of the semaphore so that waiting retries do not block other downloads
+            await asyncio.sleep(0.1 * 2 ** attempt)
+
+    async def get_image(self, file_path: str) -> Image.Image:
+        data = await self.fetch(file_path)
+
+        # decoding is cpu bound, it runs in the threadpool so that the event loop keeps serving other requests
+        return await run_in_threadpool(decode_image, data)
@@ -1,109 +1,454 @@
 import torch
 import json
+import logging
 import os
+import threading
+import time
 import numpy as np
 import torch.nn.functional as F
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from glob import glob
+from itertools import chain
+from typing import Callable, Dict, List, Optional, Tuple
 from PIL import Image
 from ml.models import HierarchyNodeModel
-from ml.scripts.preprocess import create_transform_pipeline
-from ml.utils.constants import DATA_DIR, MODELS_REGISTRY_PATH
+from ml.models.node_model_cache import NodeModelCache
+from ml.models.optimization import optimize_for_inference
+from ml.models.stacked_node_models import StackedNodeModels
+from ml.utils.constants import DATA_DIR, MODELS_REGISTRY_PATH, PACKED_REGISTRY_PATH
 from ml.utils.hierarchy import Hierarchy
+from ml.utils.packed_registry import PackedRegistry
+from ml.utils.transforms import FastTransform, create_transform_pipeline
+
+
+@dataclass
+class PlanStep:
+    node_id: str
+    # columns of the node's children in the edge probability matrix
+    column_start: int
+    column_end: int
+    # node model or any callable mapping an image batch to logits (e.g. onnxruntime session wrapper)
+    model: Callable[[torch.Tensor], torch.Tensor]
 
 
 class HierarchyModel:
-    def __init__(self, hierarchy: Hierarchy):
+    def __init__(self, hierarchy: Hierarchy, fused: bool = False, fused_chunk_size: Optional[int] = None, device: Optional[torch.device] = None, quantized: bool = False, optimized: bool = False, compile_mode: str = "none",
+                 lazy: bool = False, cache_max_models: Optional[int] = None, cache_max_memory_mb: Optional[float] = None, pinned_depth: int = 1,
+                 load_workers: Optional[int] = None, fast_transform: bool = False):
+        if quantized and fused:
+            raise ValueError("Quantized node models cannot be fused")
+
+        if lazy and fused:
+            raise ValueError("Lazily loaded node models cannot be fused")
+
+        if fused and compile_mode != "none":
+            raise ValueError("Fused node models cannot be compiled")
+
         self.models = {}
+        self.fused = fused
+        self.fused_chunk_size = fused_chunk_size
+        self.load_workers = load_workers
+        self.quantized = quantized
+        # folded batch norms, no dropout and channels_last weights, see ml.models.optimization
+        self.optimized = optimized and not quantized
+        self.compile_mode = compile_mode
+        self.memory_format = torch.channels_last if self.optimized else torch.contiguous_format
+        # node models are loaded on first use and kept in a bounded lru cache, nodes above pinned_depth stay loaded,
+        # pays off together with predict_pruned which only touches the branches the images actually go to
+        self.lazy = lazy
+        self.cache_max_models = cache_max_models
+        self.cache_max_memory_mb = cache_max_memory_mb
+        self.pinned_depth = pinned_depth
         self.metadata = {}
         self.hierarchy = hierarchy
-        self.hierarchy_mask = np.load(
-            os.path.join(MODELS_REGISTRY_PATH, "hierarchy_mask.npy"))
         self.config = json.load(
             open(os.path.join(DATA_DIR, "config.json"), "r"))
 
-        self.transform_pipeline = create_transform_pipeline(
+        # fast transform decodes jpegs at reduced scale and resizes in uint8, outputs drift slightly from the exact pipeline
+        self.transform_pipeline = (FastTransform if fast_transform else create_transform_pipeline)(
             (self.config["min_size"][0], self.config["min_size"][1]),
             self.config["mean"],
             self.config["std"]
         )
 
-        self.device = torch.device(
+        self.device = device or torch.device(
             "cuda" if torch.cuda.is_available() else "cpu")
 
-        self.__load_metadata()
-        self.__load_models()
+        # int8 kernels are only available on cpu
+        if quantized:
+            self.device = torch.device("cpu")
+
+        # seconds spent in every loading phase, reported by the app at startup
+        self.load_times: Dict[str, float] = {}
+
+        self.__timed("registry", self.__open_registry)
+        self.__timed("mask", self.__load_hierarchy_mask)
+        self.__timed("metadata", self.__load_metadata)
+        self.__timed("models", self._load_models)
+        self.__timed("plan", self.__build_plan)
+
+        # per request buffers are allocated once on the device and reused by every call of predict,
+        # the lock protects them when predict is called from several threads
+        self.edge_log_probs: Optional[torch.Tensor] = None
+        self.leaf_log_probs: Optional[torch.Tensor] = None
+        self.buffers_lock = threading.Lock()
+
+    def __timed(self, phase: str, load: Callable[[], None]):
+        start = time.perf_counter()
+        load()
+        self.load_times[phase] = time.perf_counter() - start
+
+    def __open_registry(self):
+        # packed registry (ml.scripts.pack_registry) is mapped instead of reading the separate registry files
+        self.registry = PackedRegistry(PACKED_REGISTRY_PATH) if os.path.exists(
+            PACKED_REGISTRY_PATH) else None
+
+        if self.registry is None:
+            return
+
+        # a retrained node would otherwise keep being served with the weights it had when the registry was packed,
+        # node metadata holds the training run id and is rewritten with every training of the node
+        metadata = self.__read_metadata_files()
+        if len(metadata) == 0:
+            logging.getLogger(__name__).warning(
+                f"No node metadata next to packed registry {self.registry.path}, it can not be checked to be up to date")
+        elif metadata != self.registry.get_json("nodes"):
+            raise ValueError(
+                f"Packed registry {self.registry.path} is outdated, node models were trained since it was packed, pack it again or remove it")
+
+    def __build_plan(self):
+        self.__build_leaf_index()
+
+        # all node models are executed as one vmapped forward instead of a python loop over the hierarchy
+        self.stacked_models = StackedNodeModels(
+            self.models, self.device, self.fused_chunk_size) if self.fused else None
+
+        self.__compile_plan()
+
+    def __load_hierarchy_mask(self):
+        # sparse mask: edge columns on the path of every leaf (see Hierarchy.create_sparse_mask)
+        mask_path = os.path.join(MODELS_REGISTRY_PATH, "hierarchy_mask.npz")
+
+        if self.registry is not None:
+            indices, indptr, depths = (self.registry.get_tensor(f"hierarchy_mask.{name}").numpy()
+                                       for name in ("indices", "indptr", "depths"))
+        elif os.path.exists(mask_path):
+            mask = np.load(mask_path)
+            indices, indptr, depths = mask["indices"], mask["indptr"], mask["depths"]
+        else:
+            # registries trained before the sparse mask existed only contain the dense matrix,
+            # the same paths can be derived from the hierarchy itself
+            indices, indptr, depths = self.hierarchy.create_sparse_mask()
+
+        # the mask lives on the device next to the models, every gathered edge knows which leaf it is summed into
+        self.mask_indices = torch.from_numpy(indices).to(self.device)
+        self.mask_leaf_ids = torch.repeat_interleave(
+            torch.arange(len(depths)), torch.from_numpy(np.diff(indptr))).to(self.device)
+        self.mask_depths = torch.from_numpy(depths).to(self.device)
 
     def __load_metadata(self):
+        if self.registry is not None:
+            if self.registry.get_json("leaf_order") != self.hierarchy.leaf_order:
+                raise ValueError(
+                    f"Packed registry {self.registry.path} was created for a different hierarchy, pack it again")
+
+            self.metadata = self.registry.get_json("nodes")
+            return
+
+        self.metadata = self.__read_metadata_files()
+
+    def __read_metadata_files(self) -> Dict[str, dict]:
+        metadata = {}
         metadata_files = glob(os.path.join(MODELS_REGISTRY_PATH, "*.json"))
 
         for file in metadata_files:
             file_name = os.path.splitext(os.path.split(file)[-1])[0]
 
             with open(file, "r") as f:
-                model_metadata = json.load(f)
-                self.metadata[file_name] = model_metadata
+                metadata[file_name] = json.load(f)
+
+        return metadata
+
+    def __load_node_model(self, node_id: str) -> Tuple[Callable[[torch.Tensor], torch.Tensor], int]:
+        # int8 torchscript models written by ml.scripts.quantize next to the float weights,
+        # nodes quantize could not calibrate (no processed images) run in float
+        quantized_path = os.path.join(MODELS_REGISTRY_PATH, f"{node_id}.int8.pt")
+
+        if self.quantized and os.path.exists(quantized_path):
+            path = quantized_path
+            model = torch.jit.load(path, map_location=self.device)
+            model.eval()
+        else:
+            path = os.path.join(MODELS_REGISTRY_PATH, f"{node_id}.pth")
+            n_classes = self.metadata[node_id]["n_classes"]
+
+            if self.registry is not None:
+                # module is created without storage and takes the mapped tensors as its parameters, nothing is copied on cpu
+                path = self.registry.path
+                with torch.device("meta"):
+                    model = HierarchyNodeModel(n_classes)
+
+                model.load_state_dict(
+                    self.registry.get_state_dict(node_id), assign=True)
+                model.to(self.device)
+            else:
+                model = HierarchyNodeModel(n_classes).to(self.device)
 
-    def __load_models(self):
+                model.load_state_dict(torch.load(
+                    path, map_location=self.device, weights_only=True))
 
-        model_files = glob(os.path.join(MODELS_REGISTRY_PATH, "*.pth"))
-        self.models = {}
+            # models are only ever used for inference, so they are switched to eval mode once here
+            model.eval()
 
-        for file in model_files:
-            file_name = os.path.splitext(os.path.split(file)[-1])[0]
-            model_metadata = self.metadata[file_name]
-            n_classes = model_metadata["n_classes"]
+            if self.optimized:
+                model = optimize_for_inference(
+                    model, self.__example_input(), compile_mode=self.compile_mode)
+
+        # estimated memory of the weights, frozen torchscript models do not expose them as parameters so the file size is used
+        size = sum(tensor.nbytes for tensor in chain(model.parameters(), model.buffers())) or os.path.getsize(path)
+
+        return model, size
+
+    def _load_models(self):
+        if self.registry is not None:
+            node_ids = self.registry.get_json("weights")
+        else:
+            node_ids = [os.path.split(file)[-1].removesuffix(".pth")
+                        for file in glob(os.path.join(MODELS_REGISTRY_PATH, "*.pth"))]
+
+        if self.quantized:
+            node_ids = sorted(set(node_ids) | {os.path.split(file)[-1].removesuffix(".int8.pt")
+                                               for file in glob(os.path.join(MODELS_REGISTRY_PATH, "*.int8.pt"))})
+
+        if self.lazy:
+            # every image passes through the top levels, so only those are loaded up front
+            pinned_node_ids = [node_id for node_id in node_ids
+                               if self.hierarchy.get_depth(node_id) < self.pinned_depth]
+            self.models = NodeModelCache(
+                self.__load_node_model, node_ids, pinned_node_ids, self.cache_max_models, self.cache_max_memory_mb)
+            return
+
+        # loading is mostly file io and tensor copies which release the gil, so node models are loaded concurrently
+        with ThreadPoolExecutor(max_workers=self.load_workers) as executor:
+            models = executor.map(
+                lambda node_id: self.__load_node_model(node_id)[0], node_ids)
 
-            model = HierarchyNodeModel(
-                n_classes).to(self.device)
+            self.models = dict(zip(node_ids, models))
 
-            model.load_state_dict(torch.load(
-                file, map_location=self.device, weights_only=True))
+    def __build_leaf_index(self):
+        # column of each leaf in the predictions, leaves are ordered the same way as in the hierarchy mask (bfs)
+        self.leaf_index = {leaf: i for i,
+                           leaf in enumerate(self.hierarchy.leaf_order)}
 
-            self.models[file_name] = model
+    def __compile_plan(self):
+        # the bfs traversal over internal nodes is static, so it is resolved once into a list of steps
+        # that write straight into their columns of the edge probability matrix
+        self.plan: List[PlanStep] = []
+        self.n_edges = 0
+
+        for node in self.hierarchy.bfs_order:
+            if self.hierarchy.is_leaf(node):
+                continue
+
+            model_metadata = self.metadata[node]
+            column_start = self.n_edges
+            self.n_edges += model_metadata["n_classes"]
+
+            # single label nodes have a constant probability of 1 for their only child,
+            # the log probability buffer is initialized with zeros so they need no step at all
+            if model_metadata["is_single_label"]:
+                continue
+
+            # cached models are resolved on every call, the cache may have evicted them since the plan was compiled
+            model = self.models.bind(node) if self.lazy else self.models[node]
+
+            self.plan.append(PlanStep(
+                node, column_start, self.n_edges, model))
+
+        assert self.mask_indices.max().item() < self.n_edges, \
+            f"Hierarchy mask references edge {self.mask_indices.max().item()} but node models produce only {self.n_edges}"
+
+        if self.fused:
+            # fused output is flattened to (batch_size, n_nodes * max_classes), every plan column
+            # is then filled by a single gather instead of a python loop over the nodes
+            max_classes = max(self.stacked_models.n_classes.values())
+            columns = []
+            sources = []
+
+            for step in self.plan:
+                node_index = self.stacked_models.node_index[step.node_id]
+                for i in range(step.column_end - step.column_start):
+                    columns.append(step.column_start + i)
+                    sources.append(node_index * max_classes + i)
+
+            self.fused_columns = torch.tensor(columns, device=self.device)
+            self.fused_sources = torch.tensor(sources, device=self.device)
+
+    def __example_input(self, batch_size: int = 1) -> torch.Tensor:
+        height, width = self.config["min_size"]
+        return torch.zeros((batch_size, 3, height, width), device=self.device).to(memory_format=self.memory_format)
+
+    @torch.no_grad()
+    def warmup(self, batch_sizes: List[int] = [1]):
+        """
+        Runs the hierarchy on dummy batches, so that lazy initialization (buffers, allocator, jit profiling
+        and torch.compile graphs) happens before the first real request instead of during it
+        """
+        if self.lazy:
+            # a full pass would load (and evict) every node model, only the pinned ones are warmed up
+            for model, _ in self.models.pinned.values():
+                for batch_size in batch_sizes:
+                    for _ in range(2):
+                        model(self.__example_input(batch_size))
+            return
+
+        for batch_size in batch_sizes:
+            # profiling executor of frozen torchscript models optimizes the graph on the second run
+            for _ in range(2):
+                self.predict_top_k(self.__example_input(batch_size))
+
+    def get_model_cache_stats(self) -> Optional[dict]:
+        return self.models.get_stats() if self.lazy else None
 
     def transform_image(self, image: Image):
         return self.transform_pipeline(image)
 
-    def predict(self, tensor: torch.Tensor):
+    def __get_buffers(self, batch_size: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.edge_log_probs is None or self.edge_log_probs.shape[0] < batch_size:
+            # columns of single label nodes are never written, they keep log(1) = 0
+            self.edge_log_probs = torch.zeros(
+                (batch_size, self.n_edges), device=self.device)
+            self.leaf_log_probs = torch.zeros(
+                (batch_size, len(self.leaf_index)), device=self.device)
+
+        return self.edge_log_probs[:batch_size], self.leaf_log_probs[:batch_size]
+
+    def _fill_edge_log_probs(self, tensor: torch.Tensor, edge_log_probs: torch.Tensor):
+        # writes log softmax of every node model into its columns of the edge matrix
+        if self.fused:
+            batch_size = tensor.shape[0]
+            fused_log_probs = self.stacked_models(tensor, log=True)
+            fused_log_probs = fused_log_probs.permute(
+                1, 0, 2).reshape(batch_size, -1)
+            edge_log_probs[:, self.fused_columns] = fused_log_probs[:,
+                                                                    self.fused_sources]
+        else:
+            for step in self.plan:
+                output = step.model(tensor)
+                edge_log_probs[:, step.column_start:step.column_end] = F.log_softmax(
+                    output, dim=-1)
+
+    @torch.no_grad()
+    def __predict_on_device(self, tensor: torch.Tensor) -> torch.Tensor:
+        tensor = tensor.to(self.device, memory_format=self.memory_format)
+        batch_size = tensor.shape[0]
+
+        with self.buffers_lock:
+            edge_log_probs, leaf_log_probs = self.__get_buffers(batch_size)
+
+            self._fill_edge_log_probs(tensor, edge_log_probs)
+
+            # gather log probabilities of edges on every leaf's path and sum them per leaf,
+            # which equals multiplying by the dense mask without materializing it
+            leaf_log_probs.zero_()
+            leaf_log_probs.index_add_(
+                1, self.mask_leaf_ids, edge_log_probs[:, self.mask_indices])
+            leaf_log_probs /= self.mask_depths
+
+            # exp + normalization of leaf probabilities, result is a new tensor so it can leave the lock
+            return F.softmax(leaf_log_probs, dim=-1)
+
+    def predict(self, tensor: torch.Tensor) -> np.ndarray:
+        return self.__predict_on_device(tensor).cpu().numpy()
 
-        tensor = tensor.to(self.device)
+    def predict_top_k(self, tensor: torch.Tensor, k: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Top k leaf probabilities and their indices, only these are transferred from the device
+        """
+        leaf_probs = self.__predict_on_device(tensor)
+        values, indices = torch.topk(
+            leaf_probs, min(k, leaf_probs.shape[1]), dim=1)
 
-        root_node = self.hierarchy.get_root_id()
-        preds = []
+        return values.cpu().numpy(), indices.cpu().numpy()
 
-        queue = [root_node]
+    @torch.no_grad()
+    def predict_pruned(self, tensor: torch.Tensor, beam_width: Optional[int] = None, threshold: float = 0.0) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Top-down prediction that only runs node models on subtrees that are still in play for a given image.
 
+        At every level of the hierarchy each image keeps at most `beam_width` candidate nodes whose path probability
+        (product of edge probabilities from the root) is at least `threshold`, the most probable candidate is always kept.
+        Images that reached the same node are regrouped into one sub-batch for that node's model.
+        Leaves that were pruned away get zero probability, the remaining ones are scored the same way as in `predict`.
+
+        Returns:
+            leaf probabilities of shape (batch_size, n_leaves) and number of node models evaluated for each image
+        """
+        # without any candidate the leaf probabilities would be normalized by zero
+        if beam_width is not None and beam_width < 1:
+            raise ValueError(f"Beam width has to be at least 1, got {beam_width}")
+
+        if not 0 <= threshold <= 1:
+            raise ValueError(f"Pruning threshold has to be between 0 and 1, got {threshold}")
+
+        tensor = tensor.to(self.device, memory_format=self.memory_format)
         batch_size = tensor.shape[0]
-        while len(queue) > 0:
 
-            node = queue.pop(0)
-            model_metadata = self.metadata[node]
+        leaf_scores = np.zeros((batch_size, len(self.leaf_index)))
+        n_evaluated = np.zeros(batch_size, dtype=np.int64)
 
-            is_single_label = model_metadata["is_single_label"]
+        # node -> images that reached it with their path log probability and depth
+        frontier: Dict[str, List[Tuple[int, float, int]]] = {
+            self.hierarchy.get_root_id(): [(i, 0.0, 0) for i in range(batch_size)]
+        }
 
-            children = self.hierarchy.get_non_leaf_children(node)
+        while len(frontier) > 0:
+            # candidate children per image: (path log probability, depth, child node)
+            candidates: Dict[int, List[Tuple[float, int, str]]] = {
+                i: [] for i in range(batch_size)}
 
-            if is_single_label:
-                output = np.ones((batch_size, 1))
-            else:
-                model = self.models[node]
-                model.eval()
+            for node, entries in frontier.items():
+                model_metadata = self.metadata[node]
+                children = model_metadata["children"]
+
+                images = [image for image, _, _ in entries]
+
+                if model_metadata["is_single_label"]:
+                    probs = np.ones((len(images), 1))
+                else:
+                    output = self.models[node](tensor[images])
+                    probs = F.softmax(output, dim=-1).cpu().numpy()
+                    n_evaluated[images] += 1
+
+                log_probs = np.log(probs + 1e-10)
 
-                with torch.no_grad():
-                    output = model(tensor)
-                    output = F.softmax(output, dim=-1).cpu().numpy()
+                for row, (image, path_log_prob, depth) in enumerate(entries):
+                    for col, child in enumerate(children):
+                        candidates[image].append(
+                            (path_log_prob + log_probs[row, col], depth + 1, child))
 
-            preds.append(output)
+            frontier = {}
 
-            queue.extend(children)
+            for image, image_candidates in candidates.items():
+                image_candidates.sort(key=lambda candidate: candidate[0], reverse=True)
 
-        all_probs = np.concatenate(preds, axis=1)
+                if beam_width is not None:
+                    image_candidates = image_candidates[:beam_width]
 
-        log_probs = np.log(all_probs + 1e-10)
+                for rank, (path_log_prob, depth, node) in enumerate(image_candidates):
+                    if rank > 0 and np.exp(path_log_prob) < threshold:
+                        break
 
-        leaf_probs = np.exp(log_probs @ self.hierarchy_mask.T)
+                    if node in self.leaf_index:
+                        # mean of edge log probabilities along the path, same as the depth normalized hierarchy mask
+                        leaf_scores[image, self.leaf_index[node]] = np.exp(
+                            path_log_prob / depth)
+                    else:
+                        frontier.setdefault(node, []).append(
+                            (image, path_log_prob, depth))
 
         # normalize leaf probabilities
-        leaf_probs /= leaf_probs.sum(axis=1, keepdims=True)
+        leaf_probs = leaf_scores / leaf_scores.sum(axis=1, keepdims=True)
 
-        return leaf_probs
+        return leaf_probs, n_evaluated
@@ -0,0 +1,120 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import torch
+
+NodeModel = Callable[[torch.Tensor], torch.Tensor]
+
+
+class NodeModelCache:
+    """
+    Least recently used cache of node models that loads them on first use.
+
+    The budget is given as a maximum number of models and/or maximum estimated memory of their weights,
+    when a newly loaded model exceeds it the least recently used models are evicted until it fits again.
+    Pinned models (typically the top levels of the hierarchy, which every image passes through) are loaded
+    up front and never evicted, they count towards the memory but not towards the budget.
+    Models are loaded outside of the lock, hits are not blocked by a slow load and concurrent misses
+    of the same node wait for a single load.
+    """
+
+    def __init__(self, load_fn: Callable[[str], Tuple[NodeModel, int]], node_ids: Iterable[str], pinned_node_ids: Iterable[str] = (), max_models: Optional[int] = None, max_memory_mb: Optional[float] = None):
+        # load_fn returns the model and estimated size of its weights in bytes
+        self.load_fn = load_fn
+        self.node_ids = set(node_ids)
+        self.max_models = max_models
+        self.max_memory = max_memory_mb * 1024 ** 2 if max_memory_mb is not None else None
+
+        self.pinned: Dict[str, Tuple[NodeModel, int]] = {}
+        self.cached: OrderedDict[str, Tuple[NodeModel, int]] = OrderedDict()
+        self.loading: Dict[str, Future] = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        for node_id in pinned_node_ids:
+            if node_id in self.node_ids:
+                self.pinned[node_id] = self.load_fn(node_id)
+
+    def __contains__(self, node_id: str) -> bool:
+        return node_id in self.node_ids
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    def __getitem__(self, node_id: str) -> NodeModel:
+        if node_id in self.pinned:
+            return self.pinned[node_id][0]
+
+        if node_id not in self.node_ids:
+            raise KeyError(node_id)
+
+        with self.lock:
+            if node_id in self.cached:
+                self.hits += 1
+                self.cached.move_to_end(node_id)
+                return self.cached[node_id][0]
+
+            loading = self.loading.get(node_id)
+            if loading is None:
+                self.misses += 1
+                self.loading[node_id] = Future()
+            else:
+                self.hits += 1
+
+        if loading is not None:
+            return loading.result()[0]
+
+        try:
+            entry = self.load_fn(node_id)
+        except BaseException as e:
+            with self.lock:
+                loading = self.loading.pop(node_id)
+            loading.set_exception(e)
+            raise
+
+        with self.lock:
+            loading = self.loading.pop(node_id)
+            self.cached[node_id] = entry
+            self.__evict()
+
+        loading.set_result(entry)
+        return entry[0]
+
+    def bind(self, node_id: str) -> NodeModel:
+        # callable that resolves the model on every call, so that it can be stored in a plan while the model itself comes and goes
+        def forward(tensor: torch.Tensor) -> torch.Tensor:
+            return self[node_id](tensor)
+
+        return forward
+
+    def __cached_memory(self) -> int:
+        return sum(size for _, size in self.cached.values())
+
+    def __evict(self):
+        # the most recently loaded model always stays, even if it alone is over the budget
+        while len(self.cached) > 1 and (
+            (self.max_models is not None and len(self.cached) > self.max_models) or
+            (self.max_memory is not None and self.__cached_memory() > self.max_memory)
+        ):
+            self.cached.popitem(last=False)
+            self.evictions += 1
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            requests = self.hits + self.misses
+
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests > 0 else 0.0,
+                "pinned": len(self.pinned),
+                "cached": len(self.cached),
+                "total": len(self.node_ids),
+                "memory_mb": (self.__cached_memory() + sum(size for _, size in self.pinned.values())) / 1024 ** 2,
+            }
@@ -0,0 +1,88 @@
+import os
+from glob import glob
+from typing import Optional
+
+import numpy as np
+import onnxruntime as ort
+import torch
+
+from ml.models.hierarchy_model import HierarchyModel
+from ml.utils.constants import ONNX_REGISTRY_PATH
+from ml.utils.hierarchy import Hierarchy
+
+
+def create_session_options(intra_op_threads: Optional[int] = None, inter_op_threads: Optional[int] = None) -> ort.SessionOptions:
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+
+    # by default use every core for the kernels of one node model, nodes themselves run one after another
+    options.intra_op_num_threads = intra_op_threads or int(
+        os.getenv("ORT_INTRA_OP_THREADS", os.cpu_count() or 1))
+    options.inter_op_num_threads = inter_op_threads or int(
+        os.getenv("ORT_INTER_OP_THREADS", "1"))
+
+    return options
+
+
+class OnnxNodeModel:
+    """
+    Callable wrapper around onnxruntime session of a single node model,
+    behaves like HierarchyNodeModel in eval mode (image batch in, logits out)
+    """
+
+    def __init__(self, path: str, options: ort.SessionOptions):
+        self.session = ort.InferenceSession(
+            path, sess_options=options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, tensor: torch.Tensor) -> torch.Tensor:
+        logits = self.session.run(
+            None, {"input": tensor.numpy(force=True)})[0]
+        return torch.from_numpy(logits)
+
+
+class OnnxHierarchyModel(HierarchyModel):
+    """
+    HierarchyModel backed by onnxruntime CPU sessions exported with ml.scripts.export_onnx.
+
+    There is one session per node model (used also by pruned inference), if the whole hierarchy was
+    additionally exported as one graph (hierarchy.onnx) a single session computes every node at once in predict.
+    """
+
+    def __init__(self, hierarchy: Hierarchy):
+        options = create_session_options()
+
+        self.graph_session = None
+        graph_path = os.path.join(ONNX_REGISTRY_PATH, "hierarchy.onnx")
+        if os.path.exists(graph_path):
+            self.graph_session = ort.InferenceSession(
+                graph_path, sess_options=options, providers=["CPUExecutionProvider"])
+
+        self.session_options = options
+
+        # sessions only run on cpu, so the aggregation stays there as well
+        super().__init__(hierarchy, device=torch.device("cpu"))
+
+    def _load_models(self):
+        self.models = {}
+
+        for file in glob(os.path.join(ONNX_REGISTRY_PATH, "*.onnx")):
+            file_name = os.path.splitext(os.path.split(file)[-1])[0]
+
+            if file_name == "hierarchy":
+                continue
+
+            self.models[file_name] = OnnxNodeModel(file, self.session_options)
+
+        if len(self.models) == 0:
+            raise FileNotFoundError(
+                f"No onnx models found in {ONNX_REGISTRY_PATH}, export them with ml.scripts.export_onnx first")
+
+    def _fill_edge_log_probs(self, tensor: torch.Tensor, edge_log_probs: torch.Tensor):
+        if self.graph_session is None:
+            super()._fill_edge_log_probs(tensor, edge_log_probs)
+            return
+
+        output = self.graph_session.run(
+            None, {"input": tensor.numpy(force=True)})[0]
+        edge_log_probs.copy_(torch.from_numpy(np.ascontiguousarray(output)))
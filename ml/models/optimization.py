@@ -0,0 +1,74 @@
+import copy
+import threading
+from typing import Callable
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from .hierarchy_node_model import HierarchyNodeModel, ResidualBlock
+
+COMPILE_MODES = ("none", "freeze", "compile")
+
+# torchscript tracing shares global state (e.g. names of generated types), node models loaded from
+# several threads have to be traced one at a time
+TRACE_LOCK = threading.Lock()
+
+
+def strip_dropout(model: nn.Module) -> nn.Module:
+    # dropout is an identity at inference, as a module it only costs a call (and breaks quantized regions)
+    for name, module in model.named_children():
+        if isinstance(module, (nn.Dropout, nn.Dropout2d)):
+            setattr(model, name, nn.Identity())
+        else:
+            strip_dropout(module)
+
+    return model
+
+
+def fold_batch_norms(model: HierarchyNodeModel) -> HierarchyNodeModel:
+    """
+    Folds batch norms that directly follow a convolution into the convolution's weights.
+
+    In the stem the batch norm follows the convolution. In the pre-activation residual blocks only bn2
+    follows conv1, bn1 normalizes the block input which is shared with the shortcut, so it has to stay.
+    """
+    model.conv1[0] = fuse_conv_bn_eval(model.conv1[0], model.conv1[1])
+    model.conv1[1] = nn.Identity()
+
+    for module in model.modules():
+        if isinstance(module, ResidualBlock):
+            module.conv1 = fuse_conv_bn_eval(module.conv1, module.bn2)
+            module.bn2 = nn.Identity()
+
+    return model
+
+
+def optimize_for_inference(model: HierarchyNodeModel, example_input: torch.Tensor, channels_last: bool = True, compile_mode: str = "none") -> Callable[[torch.Tensor], torch.Tensor]:
+    """
+    Returns an inference only version of a node model with the same outputs (up to float rounding)
+
+    Args:
+        model: trained node model, it is not modified
+        example_input: batch used for tracing when compile_mode is "freeze"
+        channels_last: store weights in NHWC layout, inputs should be converted to channels_last as well
+        compile_mode: "none", "freeze" (torch.jit.trace + torch.jit.freeze) or "compile" (torch.compile)
+    """
+    if compile_mode not in COMPILE_MODES:
+        raise ValueError(f"Invalid compile mode: {compile_mode}")
+
+    model = copy.deepcopy(model).eval()
+    model = fold_batch_norms(strip_dropout(model))
+
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+        example_input = example_input.to(memory_format=torch.channels_last)
+
+    if compile_mode == "freeze":
+        with TRACE_LOCK, torch.no_grad():
+            return torch.jit.freeze(torch.jit.trace(model, example_input))
+
+    if compile_mode == "compile":
+        return torch.compile(model, dynamic=True)
+
+    return model
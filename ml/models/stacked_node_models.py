@@ -0,0 +1,80 @@
+import copy
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn.functional as F
+from torch.func import functional_call, stack_module_state, vmap
+
+from .hierarchy_node_model import HierarchyNodeModel
+
+
+class StackedNodeModels:
+    """
+    Executes many HierarchyNodeModel instances as a single vectorized forward pass.
+
+    All node models share the same architecture, only the size of the last head layer differs.
+    Heads are padded to the largest number of classes (padded logits are -inf so they get zero
+    probability), weights of all models are stacked along a new leading dimension and the forward
+    is vmapped over it, which turns every convolution into one grouped convolution over all nodes.
+    """
+
+    def __init__(self, models: Dict[str, HierarchyNodeModel], device: torch.device, chunk_size: Optional[int] = None):
+        self.node_ids: List[str] = list(models.keys())
+        self.node_index = {node_id: i for i, node_id in enumerate(self.node_ids)}
+        self.n_classes = {node_id: model.head[-1].out_features
+                          for node_id, model in models.items()}
+
+        max_classes = max(self.n_classes.values())
+
+        padded_models = [self.__pad_head(models[node_id], max_classes).to(device).eval()
+                         for node_id in self.node_ids]
+
+        self.params, self.buffers = stack_module_state(padded_models)
+
+        # stateless skeleton of the architecture, actual weights are passed in functional_call
+        base_model = copy.deepcopy(padded_models[0]).to("meta")
+
+        def forward(params, buffers, x):
+            return functional_call(base_model, (params, buffers), (x,))
+
+        # chunk_size bounds how many node models are evaluated at once, which caps activation memory
+        # for very large hierarchies at the price of a few more kernel launches
+        self.forward_all = vmap(forward, in_dims=(
+            0, 0, None), chunk_size=chunk_size)
+
+    @staticmethod
+    def __pad_head(model: HierarchyNodeModel, max_classes: int) -> HierarchyNodeModel:
+        n_classes = model.head[-1].out_features
+
+        if n_classes == max_classes:
+            return model
+
+        # copy keeps the architecture of the given model, which may already be optimized (e.g. folded batch norms)
+        padded = copy.deepcopy(model)
+        head = model.head[-1]
+
+        padded_head = torch.nn.Linear(
+            head.in_features, max_classes, device=head.weight.device)
+
+        with torch.no_grad():
+            padded_head.weight.zero_()
+            padded_head.weight[:n_classes] = head.weight
+            padded_head.bias.fill_(float("-inf"))
+            padded_head.bias[:n_classes] = head.bias
+
+        padded.head[-1] = padded_head
+
+        return padded
+
+    @torch.no_grad()
+    def __call__(self, tensor: torch.Tensor, log: bool = False) -> torch.Tensor:
+        """
+        Returns softmax (or log softmax) outputs of every node model with shape (n_nodes, batch_size, max_classes),
+        columns beyond node's own number of classes are zero (-inf for log softmax)
+        """
+        logits = self.forward_all(self.params, self.buffers, tensor)
+
+        if log:
+            return F.log_softmax(logits, dim=-1)
+
+        return F.softmax(logits, dim=-1)
@@ -8,27 +8,17 @@ from tqdm.auto import tqdm
 
 
 @torch.no_grad()
-def evaluate_model(hierarchy_file_path: Optional[str] = None):
+def evaluate_model(hierarchy_file_path: Optional[str] = None, quantized: bool = False):
     hierarchy = Hierarchy(hierarchy_file_path)
 
     device = torch.device(
         "cuda" if torch.cuda.is_available() else "cpu"
     )
 
-    model = HierarchyModel(hierarchy=hierarchy)
-
-    categories = {}
+    model = HierarchyModel(hierarchy=hierarchy, quantized=quantized)
 
     # create a dict with leaf categories in an bfs order that was used during training and creating hierarchy mask
-    queue = [hierarchy.get_root_id()]
-
-    while queue:
-        node_id = queue.pop(0)
-
-        if hierarchy.is_leaf(node_id):
-            categories[node_id] = [node_id]
-        else:
-            queue.extend(hierarchy.get_children(node_id))
+    categories = {node_id: [node_id] for node_id in hierarchy.leaf_order}
 
     dataloader = create_images_dataloader(
         categories,
@@ -112,8 +102,12 @@ def evaluate_model(hierarchy_file_path: Optional[str] = None):
 
 if __name__ == "__main__":
 
+    # --quantized evaluates int8 node models written by ml.scripts.quantize
+    quantized = "--quantized" in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != "--quantized"]
+
     hierarchy_file_path = None
-    if len(sys.argv) == 2:
-        hierarchy_file_path = sys.argv[1]
+    if len(args) == 1:
+        hierarchy_file_path = args[0]
 
-    print(evaluate_model(hierarchy_file_path))
+    print(evaluate_model(hierarchy_file_path, quantized))
@@ -0,0 +1,96 @@
+import os
+from glob import glob
+
+import click
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from ml.models import HierarchyModel
+from ml.utils.constants import ONNX_REGISTRY_PATH
+from ml.utils.hierarchy import Hierarchy
+
+
+class HierarchyGraph(nn.Module):
+    """
+    All node models of the hierarchy in one module, output is the full edge log probability matrix
+    (batch_size, n_edges) in the same column layout as HierarchyModel's plan
+    """
+
+    def __init__(self, model: HierarchyModel):
+        super().__init__()
+        self.n_edges = model.n_edges
+        self.node_models = nn.ModuleList([step.model for step in model.plan])
+        self.columns = [(step.column_start, step.column_end)
+                        for step in model.plan]
+
+    def forward(self, x):
+        batch_size = x.shape[0]
+        pieces = []
+        previous_end = 0
+
+        for node_model, (column_start, column_end) in zip(self.node_models, self.columns):
+            # columns between plan steps belong to single label nodes, their log probability is 0
+            if column_start > previous_end:
+                pieces.append(x.new_zeros(
+                    (batch_size, column_start - previous_end)))
+
+            pieces.append(F.log_softmax(node_model(x), dim=-1))
+            previous_end = column_end
+
+        if previous_end < self.n_edges:
+            pieces.append(x.new_zeros((batch_size, self.n_edges - previous_end)))
+
+        return torch.cat(pieces, dim=1)
+
+
+def __export(module: nn.Module, example_input: torch.Tensor, path: str, output_name: str):
+    torch.onnx.export(
+        module,
+        example_input,
+        path,
+        input_names=["input"],
+        output_names=[output_name],
+        dynamic_axes={"input": {0: "batch_size"},
+                      output_name: {0: "batch_size"}},
+        opset_version=17,
+    )
+
+
+def export_hierarchy(model: HierarchyModel, fused: bool = False):
+    """
+    Exports every node model of `model` to ONNX_REGISTRY_PATH and, if `fused`, the whole hierarchy as one graph
+    """
+    os.makedirs(ONNX_REGISTRY_PATH, exist_ok=True)
+
+    # graphs of an earlier export (nodes no longer in the hierarchy, a fused graph) would be served with the new ones
+    for path in glob(os.path.join(ONNX_REGISTRY_PATH, "*.onnx")):
+        os.remove(path)
+
+    height, width = model.config["min_size"]
+    example_input = torch.randn(1, 3, height, width)
+
+    for step in model.plan:
+        path = os.path.join(ONNX_REGISTRY_PATH, f"{step.node_id}.onnx")
+        __export(step.model, example_input, path, "logits")
+        print(f"Exported node {step.node_id} to {path}")
+
+    # per node graphs are always exported, pruned inference needs to run nodes separately
+    if fused:
+        path = os.path.join(ONNX_REGISTRY_PATH, "hierarchy.onnx")
+        __export(HierarchyGraph(model).eval(),
+                 example_input, path, "edge_log_probs")
+        print(f"Exported hierarchy with {len(model.plan)} node models to {path}")
+
+
+@click.command()
+@click.option("--hierarchy", "-h", "hierarchy_path", type=str, required=False)
+@click.option("--fused/--per-node", default=False, help="Additionally export whole hierarchy as one graph")
+def export_onnx(hierarchy_path: str = None, fused: bool = False):
+    model = HierarchyModel(Hierarchy(hierarchy_path),
+                           device=torch.device("cpu"))
+    export_hierarchy(model, fused)
+
+
+if __name__ == "__main__":
+    export_onnx()
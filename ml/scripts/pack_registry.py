@@ -0,0 +1,68 @@
+import json
+import os
+from glob import glob
+from typing import Optional
+
+import click
+import numpy as np
+import torch
+
+from ml.utils.constants import MODELS_REGISTRY_PATH, PACKED_REGISTRY_PATH
+from ml.utils.hierarchy import Hierarchy
+from ml.utils.packed_registry import write_packed_registry
+
+
+@click.command()
+@click.option("--hierarchy", "-h", "hierarchy_path", type=str, required=False)
+@click.option("--output", "-o", "output_path", type=str, default=PACKED_REGISTRY_PATH)
+def pack_registry(hierarchy_path: Optional[str] = None, output_path: str = PACKED_REGISTRY_PATH):
+    """
+    Packs node weights (*.pth), node metadata (*.json), bfs plan, leaf and category table and hierarchy mask
+    of the registry into one memory mappable file that HierarchyModel prefers over the separate files.
+    The file has to be packed again whenever a node model is retrained, HierarchyModel refuses packs whose node
+    metadata (which holds the training run id of every node) differs from the metadata files next to it.
+    """
+    hierarchy = Hierarchy(hierarchy_path)
+
+    nodes = {}
+    for file in glob(os.path.join(MODELS_REGISTRY_PATH, "*.json")):
+        with open(file, "r") as f:
+            nodes[os.path.splitext(os.path.split(file)[-1])[0]] = json.load(f)
+
+    tensors = {}
+    weights = []
+    for file in glob(os.path.join(MODELS_REGISTRY_PATH, "*.pth")):
+        node_id = os.path.splitext(os.path.split(file)[-1])[0]
+        weights.append(node_id)
+
+        for name, tensor in torch.load(file, map_location="cpu", weights_only=True).items():
+            tensors[f"{node_id}.{name}"] = tensor
+
+    mask_path = os.path.join(MODELS_REGISTRY_PATH, "hierarchy_mask.npz")
+    if os.path.exists(mask_path):
+        mask = np.load(mask_path)
+        indices, indptr, depths = mask["indices"], mask["indptr"], mask["depths"]
+    else:
+        indices, indptr, depths = hierarchy.create_sparse_mask()
+
+    tensors["hierarchy_mask.indices"] = torch.from_numpy(indices)
+    tensors["hierarchy_mask.indptr"] = torch.from_numpy(indptr)
+    tensors["hierarchy_mask.depths"] = torch.from_numpy(depths)
+
+    # safetensors metadata only holds strings, structured values are stored as json
+    metadata = {
+        "nodes": json.dumps(nodes),
+        "weights": json.dumps(sorted(weights)),
+        "plan": json.dumps([node for node in hierarchy.bfs_order if not hierarchy.is_leaf(node)]),
+        "leaf_order": json.dumps(hierarchy.leaf_order),
+        "categories": json.dumps(hierarchy.get_categories_list()),
+    }
+
+    write_packed_registry(output_path, tensors, metadata)
+
+    print(
+        f"Packed {len(weights)} node models ({os.path.getsize(output_path) / 1024 ** 2:.2f}MB) to {output_path}")
+
+
+if __name__ == "__main__":
+    pack_registry()
@@ -1,65 +1,42 @@
+import hashlib
 import json
 import shutil
 import os
-from typing import Optional
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
 
 import click
 import pandas as pd
 import torch
-import torchvision.transforms.v2 as v2
 from PIL import Image
+from tqdm.auto import tqdm
 
-from ml.utils.constants import DATA_DIR, PROCESSED_IMAGES_PATH, RAW_IMAGES_PATH
-from ml.utils.image_statistics import get_images_statistics, print_statistics
-
-
-def RGBA2RGB(img: torch.Tensor) -> torch.Tensor:
-    if img.shape[0] == 4:
-        rgb = img[:3]
-        alpha = img[3]
-        bg = torch.ones_like(rgb) * (1 - alpha)
-        return rgb * alpha + bg
-
-    return img
-
-
-def LA2RGB(img: torch.Tensor) -> torch.Tensor:
-    if img.shape[0] == 2:  # LA format
-        luminance, alpha = img[0], img[1]
-        # Convert to RGB by repeating the luminance channel
-        rgb = luminance.unsqueeze(0).repeat(3, 1, 1)
-        bg = torch.ones_like(rgb) * (1 - alpha)
-        return rgb * alpha + bg
-    return img
-
-
-def create_transform_pipeline(min_size: tuple, dataset_mean: list, dataset_std: list):
-
-    return v2.Compose([
-        v2.ToImage(),
-        v2.Resize(min_size),
-        v2.Lambda(LA2RGB),
-        v2.RGB(),
-        v2.Lambda(RGBA2RGB),
-        v2.ToDtype(torch.float32, scale=True),
-        v2.Normalize(
-            mean=dataset_mean,
-            std=dataset_std
-        )
-    ])
+from ml.utils.constants import DATA_DIR, PREPROCESS_MANIFEST_PATH, PROCESSED_IMAGES_PATH, RAW_IMAGES_PATH
+from ml.utils.image_statistics import get_image_statistics, print_statistics, summarize_statistics
+# transforms moved to ml.utils.transforms so that serving does not import this script, re-exported for existing imports
+from ml.utils.transforms import LA2RGB, RGBA2RGB, FastTransform, create_transform_pipeline  # noqa: F401
 
 
 @click.command()
 @click.option("--min-size", "-m", "min_size_threshold", type=int)
 @click.option("--n-product", "-np", "n_products_threshold", type=int, required=False, default=5)
 @click.option("--hierarchy", "-h", "hierarchy_path", type=str, required=False)
-def preprocess_images(min_size_threshold: int, n_products_threshold: int = 5,  hierarchy_path: Optional[str] = None):
+@click.option("--fast/--exact", "fast", default=False, help="Use FastTransform (draft mode jpeg decoding) instead of the torchvision pipeline")
+@click.option("--workers", "-w", "n_workers", type=int, default=os.cpu_count(), help="Number of processes decoding and transforming images")
+@click.option("--uint8", "uint8", is_flag=True, default=False, help="Store resized uint8 images, normalized per batch by the data loader, instead of normalized float32 tensors")
+@click.option("--refresh-statistics", is_flag=True, default=False, help="Process every image again with newly computed min size, mean and std instead of the ones already processed images use")
+def preprocess_images(min_size_threshold: int, n_products_threshold: int = 5,  hierarchy_path: Optional[str] = None, fast: bool = False, n_workers: Optional[int] = None, uint8: bool = False, refresh_statistics: bool = False):
 
-    statistics = get_images_statistics(min_size_threshold)
+    manifest = __load_manifest()
+    __scan_images(manifest, n_workers)
+
+    statistics = summarize_statistics({
+        os.path.join(RAW_IMAGES_PATH, path): image["statistics"] for path, image in manifest["images"].items()}, min_size_threshold)
     print_statistics(statistics)
 
-    __preprocess_images(
-        statistics["min_size"], statistics["corrupted_files"], statistics["files_below_min_size"], statistics["dataset_mean"], statistics["dataset_std"])
+    __preprocess_images(manifest, statistics, fast,
+                        n_workers, uint8, refresh_statistics)
 
     __remove_unusable_categories(n_products_threshold)
 
@@ -67,41 +44,184 @@ def preprocess_images(min_size_threshold: int, n_products_threshold: int = 5,  h
         __preprocess_hierarchy(hierarchy_path)
 
 
-def __preprocess_images(min_size: tuple, corrupted_files: set, file_below_min_size: set, dataset_mean: list, dataset_std: list):
+# the manifest maps raw images (relative path, size, modification time) to the sha256 of their content and
+# their statistics, and processed tensors to the hash of the image they were created from, with the transform
+# settings they were created with, so re-runs only decode images that are new or changed
+def __load_manifest() -> dict:
+    if os.path.exists(PREPROCESS_MANIFEST_PATH):
+        with open(PREPROCESS_MANIFEST_PATH, "r") as f:
+            return json.load(f)
+
+    return {"transform": None, "images": {}, "outputs": {}}
 
-    transform = create_transform_pipeline(min_size, dataset_mean, dataset_std)
+
+def __save_manifest(manifest: dict):
+    tmp_path = f"{PREPROCESS_MANIFEST_PATH}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, separators=(",", ":"))
+    os.replace(tmp_path, PREPROCESS_MANIFEST_PATH)
+
+
+def __chunk_size(n_items: int, n_workers: int) -> int:
+    # large chunks keep the inter process overhead low, small enough ones keep all workers busy until the end
+    return max(1, min(64, n_items // (max(1, n_workers) * 8)))
+
+
+def __scan_image(raw_path: str) -> Tuple[str, dict]:
+    with open(raw_path, "rb") as f:
+        data = f.read()
+
+    content_hash = hashlib.sha256(data).hexdigest()
+    # mean and std are estimated from every 25th image, chosen by content so that the sample does not change between runs
+    return content_hash, get_image_statistics(data, int(content_hash[:8], 16) % 25 == 0)
+
+
+def __scan_images(manifest: dict, n_workers: Optional[int]):
+    images = {}
+    to_scan = []
 
     for class_name in os.listdir(RAW_IMAGES_PATH):
-        base_save_path = os.path.join(PROCESSED_IMAGES_PATH, class_name)
-        os.makedirs(base_save_path, exist_ok=True)
         for img_name in os.listdir(os.path.join(RAW_IMAGES_PATH, class_name)):
+            path = f"{class_name}/{img_name}"
+            stat = os.stat(os.path.join(RAW_IMAGES_PATH, class_name, img_name))
+            image = manifest["images"].get(path)
 
-            raw_path = os.path.join(RAW_IMAGES_PATH, class_name, img_name)
-
-            if raw_path in corrupted_files or raw_path in file_below_min_size:
-                continue
+            if image is not None and image["n_bytes"] == stat.st_size and image["mtime_ns"] == stat.st_mtime_ns:
+                images[path] = image
+            else:
+                images[path] = {"n_bytes": stat.st_size,
+                                "mtime_ns": stat.st_mtime_ns}
+                to_scan.append(path)
 
-            img_name = img_name.split(".")[0] + ".pt"
-            save_path = os.path.join(base_save_path, img_name)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(n_workers) as executor:
+        results = executor.map(__scan_image, [os.path.join(RAW_IMAGES_PATH, path) for path in to_scan],
+                               chunksize=__chunk_size(len(to_scan), n_workers))
+
+        for path, (content_hash, statistics) in tqdm(zip(to_scan, results), total=len(to_scan), desc="Scanning images", unit="img"):
+            images[path]["hash"] = content_hash
+            images[path]["statistics"] = statistics
+
+    elapsed = time.perf_counter() - start
+    print(f"Scanned {len(to_scan)} new or changed of {len(images)} images in {elapsed:.1f}s "
+          f"({len(to_scan) / max(elapsed, 1e-9):.0f} images/s)")
+
+    # images removed from the raw directory are dropped from the manifest
+    manifest["images"] = images
+    __save_manifest(manifest)
+
+
+def __init_transform_worker(min_size: tuple, dataset_mean: list, dataset_std: list, fast: bool, uint8: bool):
+    global __transform
+
+    # every worker transforms one image at a time, torch threads would only compete with the other workers
+    torch.set_num_threads(1)
+    __transform = (FastTransform if fast else create_transform_pipeline)(
+        min_size, dataset_mean, dataset_std, normalize=not uint8)
+
+
+def __transform_image(raw_path: str, save_path: str, min_size: tuple) -> bool:
+    # one broken image (decompression bomb, unexpected shape, ...) must not abort the whole run
+    try:
+        tensor = __transform(Image.open(raw_path))
+
+        assert tensor.shape == (
+            3, min_size[0], min_size[1]), f"All images should have the same shape. Got {tensor.shape}"
+    except Exception as e:
+        print(f"Error processing {raw_path}: {e}")
+        return False
+
+    torch.save(tensor, save_path)
+    return True
+
+
+def __preprocess_images(manifest: dict, statistics: dict, fast: bool = False, n_workers: Optional[int] = None, uint8: bool = False, refresh_statistics: bool = False):
+
+    transform = {
+        "min_size": [statistics["min_size"][0], statistics["min_size"][1]],
+        "mean": statistics["dataset_mean"],
+        "std": statistics["dataset_std"],
+        "fast": fast,
+        "uint8": uint8}
+
+    # new images shift the statistics a little, processing everything again for that is not worth it
+    if manifest["transform"] is not None and not refresh_statistics:
+        transform.update({key: manifest["transform"][key]
+                         for key in ["min_size", "mean", "std"]})
+        print("Reusing min size, mean and std of already processed images, pass --refresh-statistics to recompute them")
+
+    if transform != manifest["transform"]:
+        manifest["transform"] = transform
+        manifest["outputs"] = {}
+
+    min_size = (transform["min_size"][0], transform["min_size"][1])
+    unusable = statistics["corrupted_files"] | statistics["files_below_min_size"]
+
+    outputs = {}
+    to_process = []
+    for path, image in sorted(manifest["images"].items()):
+        raw_path = os.path.join(RAW_IMAGES_PATH, path)
+        if raw_path in unusable:
+            continue
+
+        class_name, img_name = path.split("/")
+        output = f"{class_name}/{img_name.split('.')[0]}.pt"
+
+        # a.jpg and a.png would be written to the same tensor (by two workers at once), the first one is kept
+        if output in outputs:
+            print(f"Skipping {raw_path}, another image of {class_name} is already processed to {output}")
+            continue
+
+        outputs[output] = image["hash"]
+
+        if manifest["outputs"].get(output) != image["hash"] or not os.path.exists(os.path.join(PROCESSED_IMAGES_PATH, output)):
+            to_process.append((raw_path, output))
+
+    # tensors of images that were removed, changed name or became unusable would end up in the training data
+    for output in manifest["outputs"].keys() - outputs.keys():
+        if os.path.exists(os.path.join(PROCESSED_IMAGES_PATH, output)):
+            os.remove(os.path.join(PROCESSED_IMAGES_PATH, output))
+
+    manifest["outputs"] = {output: content_hash for output, content_hash in manifest["outputs"].items()
+                           if outputs.get(output) == content_hash}
+
+    for class_name in {output.split("/")[0] for _, output in to_process}:
+        os.makedirs(os.path.join(PROCESSED_IMAGES_PATH, class_name), exist_ok=True)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(n_workers, initializer=__init_transform_worker,
+                             initargs=(min_size, transform["mean"], transform["std"], fast, uint8)) as executor:
+        results = executor.map(__transform_image,
+                               [raw_path for raw_path, _ in to_process],
+                               [os.path.join(PROCESSED_IMAGES_PATH, output)
+                                for _, output in to_process],
+                               [min_size] * len(to_process),
+                               chunksize=__chunk_size(len(to_process), n_workers))
 
-            try:
-                tensor = transform(Image.open(raw_path))
-            except OSError:
-                print(f"Error processing {raw_path}")
-                continue
+        try:
+            for i, ((_, output), processed) in enumerate(tqdm(zip(to_process, results), total=len(to_process), desc="Processing images", unit="img")):
+                if processed:
+                    manifest["outputs"][output] = outputs[output]
 
-            assert tensor.shape == (
-                3, min_size[0], min_size[1]), f"All images should have the same shape. Got {tensor.shape}"
+                # an interrupted run resumes from the last saved manifest
+                if (i + 1) % 10000 == 0:
+                    __save_manifest(manifest)
+        finally:
+            # outputs written so far are kept even when the run fails
+            __save_manifest(manifest)
 
-            torch.save(tensor, save_path)
+    elapsed = time.perf_counter() - start
+    print(f"Processed {len(to_process)} images in {elapsed:.1f}s ({len(to_process) / max(elapsed, 1e-9):.0f} images/s), "
+          f"{len(outputs) - len(to_process)} unchanged images skipped")
 
-        print(f"Finished processing {class_name}")
+    __save_manifest(manifest)
 
     with open(os.path.join(DATA_DIR, 'config.json'), 'w') as f:
         json.dump({
             "min_size": [min_size[0], min_size[1]],
-            "mean": dataset_mean,
-            "std": dataset_std}, f)
+            "mean": transform["mean"],
+            "std": transform["std"],
+            "dtype": "uint8" if uint8 else "float32"}, f)
 
 
 # removing categories with less than n images
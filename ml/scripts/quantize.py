@@ -0,0 +1,104 @@
+import copy
+import os
+import random
+from typing import Optional
+
+import click
+import torch
+import torch.nn as nn
+from torch.ao.quantization import default_dynamic_qconfig, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from ml.models import HierarchyModel
+from ml.models.optimization import strip_dropout
+from ml.utils.constants import MODELS_REGISTRY_PATH, PROCESSED_IMAGES_PATH
+from ml.utils.data_loader import get_split_files
+from ml.utils.hierarchy import Hierarchy
+
+
+def quantize_node_model(model: nn.Module, calibration_tensors: torch.Tensor, dynamic_head: bool = False, batch_size: int = 32) -> torch.jit.ScriptModule:
+    """
+    Post training static int8 quantization of a single node model.
+
+    FX graph mode fuses conv + following batch norm (+ relu) before observers are inserted,
+    so batch norms that directly follow a convolution are folded into its weights.
+    Activation ranges are calibrated on `calibration_tensors`.
+    """
+    model = strip_dropout(copy.deepcopy(model).cpu().eval())
+
+    qconfig_mapping = get_default_qconfig_mapping("x86")
+    if dynamic_head:
+        # head is small, dynamic quantization avoids calibrating its activations
+        qconfig_mapping = qconfig_mapping.set_module_name(
+            "head", default_dynamic_qconfig)
+
+    example_inputs = (calibration_tensors[:1],)
+    prepared = prepare_fx(model, qconfig_mapping, example_inputs)
+
+    with torch.no_grad():
+        for start in range(0, len(calibration_tensors), batch_size):
+            prepared(calibration_tensors[start:start + batch_size])
+
+    quantized = convert_fx(prepared)
+
+    # torchscript keeps the quantized graph loadable without the FX tracing code
+    with torch.no_grad():
+        return torch.jit.freeze(torch.jit.trace(quantized, example_inputs))
+
+
+def __sample_calibration_tensors(hierarchy: Hierarchy, node_id: str, n_samples: int, config: dict) -> Optional[torch.Tensor]:
+    # calibrate only on training images that can actually reach this node
+    files = []
+    for leaf in hierarchy.get_leaf_nodes(node_id):
+        files.extend(get_split_files(
+            os.path.join(PROCESSED_IMAGES_PATH, leaf), 'train'))
+
+    if len(files) == 0:
+        return None
+
+    files = random.Random(42).sample(files, min(n_samples, len(files)))
+
+    tensors = torch.stack([torch.load(file, weights_only=True) for file in files])
+
+    # images preprocessed with --uint8 are normalized the way the data loader does it
+    if tensors.dtype == torch.uint8:
+        mean = torch.tensor(config["mean"]).view(1, 3, 1, 1)
+        std = torch.tensor(config["std"]).view(1, 3, 1, 1)
+        return (tensors.float() / 255 - mean) / std
+
+    return tensors.float()
+
+
+@click.command()
+@click.option("--hierarchy", "-h", "hierarchy_path", type=str, required=False)
+@click.option("--n-calibration", "-n", "n_calibration_samples", type=int, default=256)
+@click.option("--dynamic-head/--static-head", default=False)
+def quantize(hierarchy_path: Optional[str] = None, n_calibration_samples: int = 256, dynamic_head: bool = False):
+    hierarchy = Hierarchy(hierarchy_path)
+    model = HierarchyModel(hierarchy, device=torch.device("cpu"))
+
+    for step in model.plan:
+        calibration_tensors = __sample_calibration_tensors(
+            hierarchy, step.node_id, n_calibration_samples, model.config)
+
+        # quantized weights are stored next to float ones, HierarchyModel(quantized=True) picks them up
+        path = os.path.join(MODELS_REGISTRY_PATH, f"{step.node_id}.int8.pt")
+
+        if calibration_tensors is None:
+            # an int8 model of earlier weights would be served instead of the float one
+            if os.path.exists(path):
+                os.remove(path)
+            print(f"No processed training images for node {step.node_id}, skipping (it runs in float)")
+            continue
+
+        quantized = quantize_node_model(
+            step.model, calibration_tensors, dynamic_head)
+
+        torch.jit.save(quantized, path)
+
+        print(
+            f"Quantized node {step.node_id} on {len(calibration_tensors)} samples to {path}")
+
+
+if __name__ == "__main__":
+    quantize()
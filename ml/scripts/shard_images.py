@@ -0,0 +1,67 @@
+import json
+import os
+from glob import glob
+
+from typing import Optional
+
+import click
+import torch
+from torchvision.tv_tensors._image import Image
+from tqdm.auto import tqdm
+
+from ml.utils.constants import DATA_DIR, PROCESSED_IMAGES_PATH, SHARDED_IMAGES_PATH
+from ml.utils.data_loader import get_preprocess_fingerprint
+from ml.utils.image_shards import DTYPES, write_image_shards
+
+# the torchvision pipeline saves tv_tensors.Image
+torch.serialization.add_safe_globals([Image])
+
+
+@click.command()
+@click.option("--output", "-o", "output_path", type=str, default=SHARDED_IMAGES_PATH)
+@click.option("--dtype", "-d", type=click.Choice(list(DTYPES.keys())), required=False, help="float16 by default, uint8 for images preprocessed with --uint8")
+@click.option("--shard-size", "-s", type=int, default=2048, help="Number of images per shard file")
+def shard_images(output_path: str = SHARDED_IMAGES_PATH, dtype: Optional[str] = None, shard_size: int = 2048):
+    """
+    Converts the processed images (one .pt file per image) into memory mapped shards that create_images_dataloader
+    prefers over the per file layout. Has to run again after every preprocessing (until then the dataloader falls back
+    to the per file layout), the per file layout is kept.
+    """
+    with open(os.path.join(DATA_DIR, "config.json"), "r") as f:
+        config = json.load(f)
+
+    # taken before reading the images, shards of images preprocessed meanwhile are then seen as outdated
+    fingerprint = get_preprocess_fingerprint()
+
+    min_size = config["min_size"]
+    if dtype is None:
+        dtype = "uint8" if config.get("dtype") == "uint8" else "float16"
+
+    # glob order per leaf is what get_split_files splits, keeping it keeps train/val/test splits the same
+    leaves = {leaf: glob(os.path.join(PROCESSED_IMAGES_PATH, leaf, "*.pt"))
+              for leaf in sorted(os.listdir(PROCESSED_IMAGES_PATH))
+              if leaf != "tmp" and os.path.isdir(os.path.join(PROCESSED_IMAGES_PATH, leaf))}
+
+    n_files = sum(len(files) for files in leaves.values())
+    progress_bar = tqdm(total=n_files, desc="Sharding images", unit="img")
+
+    def load(files):
+        for file in files:
+            yield torch.load(file, weights_only=True)
+            progress_bar.update(1)
+
+    write_image_shards(output_path, {leaf: load(files) for leaf, files in leaves.items()},
+                       (3, min_size[0], min_size[1]), dtype, shard_size, fingerprint)
+    progress_bar.close()
+
+    files_size = sum(os.path.getsize(file)
+                     for files in leaves.values() for file in files)
+    shards_size = sum(os.path.getsize(os.path.join(output_path, file))
+                      for file in os.listdir(output_path) if file.endswith(".bin"))
+
+    print(f"Wrote {n_files} images of {len(leaves)} leaves into {-(-n_files // shard_size)} shards")
+    print(f"Size: {files_size / 1024 ** 2:.1f}MB as files, {shards_size / 1024 ** 2:.1f}MB as {dtype} shards")
+
+
+if __name__ == "__main__":
+    shard_images()
@@ -1,6 +1,7 @@
 import json
 import os
 import sys
+import uuid
 from glob import glob
 from typing import Optional
 
@@ -8,7 +9,7 @@ import numpy as np
 import torch
 
 from ml.scripts.train_single import TrainConfig, train_singular_model
-from ml.utils.constants import CONFIGS_PATH, MODELS_REGISTRY_PATH
+from ml.utils.constants import CONFIGS_PATH, MODELS_REGISTRY_PATH, ONNX_REGISTRY_PATH, PACKED_REGISTRY_PATH
 from ml.utils.hierarchy import Hierarchy
 
 
@@ -18,6 +19,8 @@ class ModelMetadata:
         self.n_classes = n_classes
         self.is_single_label = False
         self.children = children
+        # identifies the training run, packed registries compare it to notice retrained nodes
+        self.run_id = uuid.uuid4().hex
 
     def save(self):
         path = os.path.join(MODELS_REGISTRY_PATH, f"{self.model_name}.json")
@@ -26,6 +29,7 @@ class ModelMetadata:
             "n_classes": self.n_classes,
             "is_single_label": self.is_single_label,
             "children": self.children,
+            "run_id": self.run_id,
         }
 
         with open(path, "w") as f:
@@ -43,6 +47,18 @@ def train_hierarchy(project_name: str, hierarchy_file_path: Optional[str] = None
     # prepare dir for saving models
     os.makedirs(MODELS_REGISTRY_PATH, exist_ok=True)
 
+    # the packed registry holds the weights from before training, HierarchyModel reads the files until it is packed again
+    if os.path.exists(PACKED_REGISTRY_PATH):
+        os.remove(PACKED_REGISTRY_PATH)
+        print(f"Removed packed registry {PACKED_REGISTRY_PATH}, run ml.scripts.pack_registry after training")
+
+    # the same holds for onnx graphs, OnnxHierarchyModel would serve the previous weights of retrained nodes
+    onnx_paths = glob(os.path.join(ONNX_REGISTRY_PATH, "*.onnx"))
+    for path in onnx_paths:
+        os.remove(path)
+    if len(onnx_paths) > 0:
+        print(f"Removed onnx models from {ONNX_REGISTRY_PATH}, run ml.scripts.export_onnx after training")
+
     # decide whether we should start training from scratch or resume training
     model_files = [os.path.splitext(os.path.split(path)[-1])[0] for path in glob(
         os.path.join(MODELS_REGISTRY_PATH, "*.pth"))]
@@ -86,6 +102,11 @@ def train_hierarchy(project_name: str, hierarchy_file_path: Optional[str] = None
 
         print(f"Training node {node_id}")
 
+        # int8 model of the previous weights would keep being served, ml.scripts.quantize creates it again
+        quantized_path = os.path.join(MODELS_REGISTRY_PATH, f"{node_id}.int8.pt")
+        if os.path.exists(quantized_path):
+            os.remove(quantized_path)
+
         metadata = ModelMetadata(node_id, len(children), children)
 
         if len(children) == 1:
@@ -101,11 +122,11 @@ def train_hierarchy(project_name: str, hierarchy_file_path: Optional[str] = None
         metadata.save()
         print(f"Finished training node {node_id}")
 
-    print("Creating hierarchy mask matrix")
-    hierarchy_mask = hierarchy.create_matrix_mask()
+    print("Creating sparse hierarchy mask")
+    indices, indptr, depths = hierarchy.create_sparse_mask()
 
-    np.save(os.path.join(MODELS_REGISTRY_PATH,
-            "hierarchy_mask.npy"), hierarchy_mask)
+    np.savez(os.path.join(MODELS_REGISTRY_PATH, "hierarchy_mask.npz"),
+             indices=indices, indptr=indptr, depths=depths)
 
     print("Finished training hierarchy")
 
@@ -1,11 +1,10 @@
-from collections import defaultdict
 import json
 import sys
 import logging
 import os
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Tuple
+from typing import Optional, Tuple
 
 import numpy as np
 import torch
@@ -40,6 +39,17 @@ class TrainConfig:
 
     optimizer: str
 
+    # augment whole training batches on the device instead of every sample in the data loader workers
+    batched_augmentations: bool = False
+
+    # train accuracy is measured on clean inputs in eval mode on every n-th batch (1 measures every batch)
+    train_accuracy_interval: int = 10
+
+    # autocast to bfloat16 (float16 with loss scaling on gpus without bfloat16) and channels last activations,
+    # weights stay float32 and checkpoints are saved contiguous
+    mixed_precision: bool = False
+    channels_last: bool = False
+
     @property
     def initial_lr(self) -> float:
         return self.max_lr / self.div_factor
@@ -55,13 +65,22 @@ def __get_data_loaders(hierarchy: Hierarchy, node_id: str, train_config: TrainCo
         child) for child in children}
 
     train_loader = create_images_dataloader(
-        categories_dict, split='train', batch_size=train_config.batch_size, device=device)
+        categories_dict, split='train', batch_size=train_config.batch_size, device=device,
+        batched_augmentations=train_config.batched_augmentations)
     val_loader = create_images_dataloader(
         categories_dict, split='val', batch_size=train_config.batch_size, device=device)
 
     return train_loader, val_loader, len(children)
 
 
+def __create_mixed_precision(device: torch.device) -> Tuple[torch.dtype, Optional[torch.amp.GradScaler]]:
+    # bfloat16 has the range of float32 and needs no loss scaling, float16 gradients would underflow without it
+    if device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+        return torch.float16, torch.amp.GradScaler('cuda')
+
+    return torch.bfloat16, None
+
+
 def __create_optimizer(model: nn.Module, train_config: TrainConfig) -> torch.optim.Optimizer:
     if train_config.optimizer == 'adamw':
         return torch.optim.AdamW(
@@ -126,22 +145,13 @@ def mixup_data(x, y, alpha):
         lam = 1
 
     batch_size = x.size()[0]
-    index = torch.randperm(batch_size)
+    index = torch.randperm(batch_size, device=x.device)
 
     mixed_x = lam * x + (1 - lam) * x[index]
     y_a, y_b = y, y[index]
     return mixed_x, y_a, y_b, lam
 
 
-def get_gradient_norm(model):
-    total_norm = 0
-    for p in model.parameters():
-        if p.grad is not None:
-            param_norm = p.grad.data.norm(2)
-            total_norm += param_norm.item() ** 2
-    return total_norm ** 0.5
-
-
 def __train_epoch(
     model: nn.Module,
     loader: PrefetchLoader,
@@ -154,110 +164,125 @@ def __train_epoch(
     prev_val_acc: float = 0.0,
     epoch: int = 0,
     total_epochs: int = 100,
-    avg_grad_norm: float = 0.0
+    avg_grad_norm: float = 0.0,
+    train_accuracy_interval: int = 10,
+    autocast_dtype: Optional[torch.dtype] = None,
+    scaler: Optional[torch.amp.GradScaler] = None,
+    memory_format: torch.memory_format = torch.contiguous_format
 ) -> Tuple[float, float, float, float]:
 
     model.train()
-    total_loss = 0
-    correct = 0
-    total_samples = 0
+    device = next(model.parameters()).device
+
+    # metrics are accumulated on the device and read once at the end of the epoch,
+    # reading them every step would wait for the device to finish the step
+    total_loss = torch.zeros((), device=device)
+    total_grad_norm = torch.zeros((), device=device)
+    # steps skipped by the grad scaler have an infinite gradient norm
+    finite_grad_norms = torch.zeros((), device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    evaluated_samples = 0
 
     alpha = get_mixup_alpha(prev_train_acc, prev_val_acc,
                             epoch, total_epochs, avg_grad_norm)
     logger.info(f"Mixup alpha: {alpha}")
 
     progress_bar = tqdm(loader, desc='Training')
-    grad_norms = []
 
     criterion = nn.CrossEntropyLoss(label_smoothing=label_smoothing)
 
-    for X_batch, y_batch in progress_bar:
+    for step, (X_batch, y_batch) in enumerate(progress_bar):
         optimizer.zero_grad()
 
+        X_batch = X_batch.contiguous(memory_format=memory_format)
         mixed_X, y_a, y_b, lam = mixup_data(X_batch, y_batch, alpha)
 
-        y_pred = model(mixed_X)
+        with torch.autocast(device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+            y_pred = model(mixed_X)
 
-        loss = lam * criterion(y_pred, y_a) + (1 - lam) * \
-            criterion(y_pred, y_b)
+            loss = lam * criterion(y_pred, y_a) + (1 - lam) * \
+                criterion(y_pred, y_b)
 
-        loss.backward()
-
-        grad_norm = get_gradient_norm(model)
-        grad_norms.append(grad_norm)
+        if scaler is not None:
+            scaler.scale(loss).backward()
+            # clipping works on the real gradients
+            scaler.unscale_(optimizer)
+        else:
+            loss.backward()
 
-        # Gradient clipping
-        torch.nn.utils.clip_grad_norm_(
-            model.parameters(), grad_clip_value, norm_type=2)
+        # Gradient clipping, returns the norm of the gradients before clipping
+        grad_norm = torch.nn.utils.clip_grad_norm_(
+            model.parameters(), grad_clip_value, norm_type=2).detach()
+        total_grad_norm += torch.where(torch.isfinite(grad_norm), grad_norm, 0.0)
+        finite_grad_norms += torch.isfinite(grad_norm)
 
-        optimizer.step()
+        if scaler is not None:
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            optimizer.step()
         scheduler.step()
 
         # Update metrics
-        model.eval()
-        with torch.no_grad():
-            original_outputs = model(X_batch)
-            pred = original_outputs.argmax(dim=1)
-            correct += (pred == y_batch).sum().item()
-        model.train()
-
-        total_samples += y_batch.size(0)
-        total_loss += loss.item()
-
-        # Update progress bar
-        progress_bar.set_postfix(
-            loss=f"{loss.item():.4f}",
-            acc=f"{100.0 * correct / total_samples:.2f}%"
-        )
+        if step % train_accuracy_interval == 0:
+            model.eval()
+            with torch.no_grad(), torch.autocast(device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+                original_outputs = model(X_batch)
+                pred = original_outputs.argmax(dim=1)
+                correct += (pred == y_batch).sum()
+            model.train()
 
-    epoch_loss = total_loss / len(loader)
-    epoch_acc = correct / total_samples
+            evaluated_samples += y_batch.size(0)
 
-    avg_grad_norm = np.mean(grad_norms)
+        total_loss += loss.detach()
+
+    n_steps = max(len(loader), 1)
+    epoch_loss = total_loss.item() / n_steps
+    epoch_acc = correct.item() / max(evaluated_samples, 1)
+    avg_grad_norm = total_grad_norm.item() / max(finite_grad_norms.item(), 1)
 
     return epoch_loss, epoch_acc, alpha, avg_grad_norm
 
 
 @torch.no_grad()
-def __validate(model: nn.Module, loader: PrefetchLoader) -> Tuple[float, float, float, dict]:
+def __validate(model: nn.Module, loader: PrefetchLoader, autocast_dtype: Optional[torch.dtype] = None,
+               memory_format: torch.memory_format = torch.contiguous_format) -> Tuple[float, float, float, dict]:
     model.eval()
-    total_loss = 0
-    correct = 0
-    total_samples = 0
+    device = next(model.parameters()).device
 
-    correct_per_class = defaultdict(int)
-    total_per_class = defaultdict(int)
+    # accumulated on the device and read once at the end, same as in __train_epoch
+    total_loss = torch.zeros((), device=device)
+    correct_per_class = None
+    total_per_class = None
 
     criterion = nn.CrossEntropyLoss()
     progress_bar = tqdm(
         loader, desc='Validation')
     for X_batch, y_batch in progress_bar:
-        y_pred = model(X_batch)
-        loss = criterion(y_pred, y_batch)
+        with torch.autocast(device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+            y_pred = model(X_batch.contiguous(memory_format=memory_format))
+            loss = criterion(y_pred, y_batch)
 
-        total_loss += loss.item()
-        total_samples += y_batch.size(0)
+        total_loss += loss
 
         # Per-class metrics
         preds = y_pred.argmax(dim=1)
-        for pred, label in zip(preds, y_batch):
-            label_idx = label.item()
-            total_per_class[label_idx] += 1
-            if pred == label:
-                correct_per_class[label_idx] += 1
+        n_classes = y_pred.size(1)
+        batch_total = torch.bincount(y_batch, minlength=n_classes)
+        batch_correct = torch.bincount(
+            y_batch[preds == y_batch], minlength=n_classes)
 
-        correct += (y_pred.argmax(dim=1) == y_batch).sum().item()
+        total_per_class = batch_total if total_per_class is None else total_per_class + batch_total
+        correct_per_class = batch_correct if correct_per_class is None else correct_per_class + batch_correct
 
-        progress_bar.set_postfix(
-            loss=f"{loss.item():.4f}",
-            acc=f"{100.0 * correct / total_samples:.2f}%"
-        )
+    correct_per_class = correct_per_class.tolist()
+    total_per_class = total_per_class.tolist()
 
-    epoch_loss = total_loss / len(loader)
-    epoch_acc = correct / total_samples
+    epoch_loss = total_loss.item() / len(loader)
+    epoch_acc = sum(correct_per_class) / sum(total_per_class)
 
     class_accuracies = {
-        f"val/class_{k}_accuracy": correct_per_class[k] / total_per_class[k] for k in total_per_class.keys()}
+        f"val/class_{k}_accuracy": correct_per_class[k] / total_per_class[k] for k in range(len(total_per_class)) if total_per_class[k] > 0}
 
     balanced_accuracy = np.mean(list(class_accuracies.values()))
 
@@ -284,6 +309,8 @@ def train_singular_model(hierarchy: Hierarchy, node_id: str, train_config: Train
             "div_factor": train_config.div_factor,
             "final_div_factor": train_config.final_div_factor,
             "max_lr": train_config.max_lr,
+            "mixed_precision": train_config.mixed_precision,
+            "channels_last": train_config.channels_last,
             "node_id": node_id,
             "num_classes": None  # Will be set after loading data
         }
@@ -304,7 +331,10 @@ def train_singular_model(hierarchy: Hierarchy, node_id: str, train_config: Train
 
     # Create model
     model = HierarchyNodeModel(num_classes=num_classes)
-    model.to(device)
+    autocast_dtype, scaler = __create_mixed_precision(
+        device) if train_config.mixed_precision else (None, None)
+    memory_format = torch.channels_last if train_config.channels_last else torch.contiguous_format
+    model.to(device, memory_format=memory_format)
 
     wandb.watch(model, log="all", log_freq=10)
 
@@ -350,12 +380,16 @@ def train_singular_model(hierarchy: Hierarchy, node_id: str, train_config: Train
             prev_val_acc=val_acc,
             epoch=epoch,
             total_epochs=train_config.epochs,
-            avg_grad_norm=avg_grad_norm
+            avg_grad_norm=avg_grad_norm,
+            train_accuracy_interval=train_config.train_accuracy_interval,
+            autocast_dtype=autocast_dtype,
+            scaler=scaler,
+            memory_format=memory_format
         )
 
         # Validation phase
         val_loss, val_acc, val_balanced_acc, val_class_acc = __validate(
-            model, val_loader)
+            model, val_loader, autocast_dtype, memory_format)
         smoothed_val_loss = val_smoother.update(val_loss)
 
         # Log metrics to wandb
@@ -390,7 +424,8 @@ def train_singular_model(hierarchy: Hierarchy, node_id: str, train_config: Train
         if smoothed_val_loss < best_val_loss:
             best_val_loss = smoothed_val_loss
             patience = 0
-            torch.save(model.state_dict(), os.path.join(
+            # channels last weights are saved contiguous, the layout HierarchyModel and the export scripts expect
+            torch.save({name: tensor.contiguous() for name, tensor in model.state_dict().items()}, os.path.join(
                 MODELS_REGISTRY_PATH, f'{node_id}.pth'))
             logger.info(f'Saved new best model with val_loss: {val_loss:.4f}')
 
@@ -1,2 +1,2 @@
-from .image_statistics import get_images_statistics, print_statistics
+from .image_statistics import get_images_statistics, get_image_statistics, summarize_statistics, print_statistics
 from .constants import RAW_IMAGES_PATH, PROCESSED_IMAGES_PATH, HIERARCHY_FILE_PATH
@@ -0,0 +1,236 @@
+import math
+from typing import List, Optional, Union
+
+import torch
+import torch.nn.functional as F
+
+# rgb <-> yiq, hue is a rotation of the iq plane
+RGB_TO_YIQ = torch.tensor([
+    [0.299, 0.587, 0.114],
+    [0.596, -0.274, -0.322],
+    [0.211, -0.523, 0.312],
+])
+YIQ_TO_RGB = torch.linalg.inv(RGB_TO_YIQ)
+
+GRAYSCALE_WEIGHTS = (0.2989, 0.587, 0.114)
+
+
+class BatchAugmentations:
+    """
+    Batched counterpart of the per sample train augmentations of ImageDataset (color jitter, gaussian blur,
+    sharpness, erasing, perspective, rotation, horizontal flip and autocontrast, with the same (effective)
+    probabilities and ranges), for batches of images with pixel values in 0-1 on any device.
+
+    Every sample gets its own random parameters, samples an augmentation is not applied to get its identity
+    parameters, so a batch is a fixed sequence of tensor ops without host synchronization.
+    Perspective, rotation and flip are composed into a single resampling. Differences to torchvision:
+    color jitter runs in a fixed order and shifts hue by rotating the chroma plane in YIQ instead of HSV.
+    """
+
+    def __init__(self, erasing_value: Union[float, List[float]] = 0.0, generator: Optional[torch.Generator] = None):
+        self.erasing_value = erasing_value
+        self.generator = generator
+
+    def __rand(self, *size: int, device: torch.device, low: float = 0.0, high: float = 1.0) -> torch.Tensor:
+        return low + (high - low) * torch.rand(*size, device=device, generator=self.generator)
+
+    def __applied(self, n: int, p: float, device: torch.device) -> torch.Tensor:
+        return self.__rand(n, device=device) < p
+
+    def __apply(self, augmentation, images: torch.Tensor, p: float) -> torch.Tensor:
+        applied = self.__applied(images.shape[0], p, images.device)
+
+        # on accelerators every op runs on the whole batch (with identity parameters where the augmentation is not
+        # applied), selecting samples would synchronize with the host, on the cpu computing only them is cheaper
+        if images.device.type != "cpu":
+            return augmentation(images, applied)
+
+        selected = applied.nonzero().squeeze(1)
+        if len(selected) > 0:
+            images[selected] = augmentation(
+                images[selected], torch.ones(len(selected), dtype=torch.bool))
+        return images
+
+    def __color_jitter(self, images: torch.Tensor, applied: torch.Tensor) -> torch.Tensor:
+        n, device = images.shape[0], images.device
+
+        def factor(spread: float) -> torch.Tensor:
+            return torch.where(applied, self.__rand(n, device=device, low=1 - spread, high=1 + spread), 1.0).view(n, 1, 1, 1)
+
+        gray_weights = torch.tensor(GRAYSCALE_WEIGHTS, device=device)
+
+        images = images.mul(factor(0.3)).clamp_(0, 1)
+
+        mean = torch.einsum("c,nchw->nhw", gray_weights, images).mean(dim=(1, 2)).view(n, 1, 1, 1)
+        images = torch.lerp(mean, images, factor(0.3)).clamp_(0, 1)
+
+        gray = torch.einsum("c,nchw->nhw", gray_weights, images).unsqueeze(1)
+        images = torch.lerp(gray, images, factor(0.3)).clamp_(0, 1)
+
+        angle = torch.where(applied, self.__rand(n, device=device, low=-0.15, high=0.15), 0.0) * 2 * math.pi
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        rotation = torch.zeros(n, 3, 3, device=device)
+        rotation[:, 0, 0] = 1
+        rotation[:, 1, 1], rotation[:, 1, 2] = cos, -sin
+        rotation[:, 2, 1], rotation[:, 2, 2] = sin, cos
+
+        hue = YIQ_TO_RGB.to(device) @ rotation @ RGB_TO_YIQ.to(device)
+        return torch.bmm(hue, images.flatten(2)).view_as(images).clamp_(0, 1)
+
+    def __gaussian_blur(self, images: torch.Tensor, applied: torch.Tensor) -> torch.Tensor:
+        n, c, h, w = images.shape
+        sigma = self.__rand(n, device=images.device, low=0.1, high=2.0)
+
+        # 3 tap kernel per sample, [0, 1, 0] where the blur is not applied
+        side = torch.exp(-1 / (2 * sigma ** 2))
+        kernel = torch.stack([side, torch.ones_like(side), side], dim=1)
+        kernel = kernel / kernel.sum(dim=1, keepdim=True)
+        kernel = torch.where(applied.view(n, 1), kernel,
+                             torch.tensor([0.0, 1.0, 0.0], device=images.device))
+        kernel = kernel.repeat_interleave(c, dim=0)
+
+        # one group per sample and channel
+        images = F.pad(images.reshape(1, n * c, h, w),
+                       (1, 1, 1, 1), mode="reflect")
+        images = F.conv2d(images, kernel.view(n * c, 1, 1, 3), groups=n * c)
+        images = F.conv2d(images, kernel.view(n * c, 1, 3, 1), groups=n * c)
+
+        return images.view(n, c, h, w)
+
+    def __adjust_sharpness(self, images: torch.Tensor, applied: torch.Tensor) -> torch.Tensor:
+        n = images.shape[0]
+
+        # same smoothing kernel as torchvision (3x3 ones with 5 in the middle, divided by 13) as a 3x3 mean,
+        # border pixels stay as they are
+        blurred = images.clone()
+        blurred[:, :, 1:-1, 1:-1] = (F.avg_pool2d(images, 3, stride=1) * 9 +
+                                     images[:, :, 1:-1, 1:-1] * 4) / 13
+
+        factor = torch.where(applied, 2.0, 1.0).view(n, 1, 1, 1)
+        return torch.lerp(blurred, images, factor).clamp_(0, 1)
+
+    def __erase(self, images: torch.Tensor, applied: torch.Tensor) -> torch.Tensor:
+        n, c, h, w = images.shape
+        device = images.device
+
+        area = self.__rand(n, device=device, low=0.02, high=0.2) * h * w
+        ratio = torch.exp(self.__rand(
+            n, device=device, low=math.log(0.3), high=math.log(3.3)))
+
+        erase_h = torch.sqrt(area * ratio).round().clamp(1, h)
+        erase_w = torch.sqrt(area / ratio).round().clamp(1, w)
+        top = (self.__rand(n, device=device) * (h - erase_h + 1)).floor()
+        left = (self.__rand(n, device=device) * (w - erase_w + 1)).floor()
+
+        rows = torch.arange(h, device=device).view(1, h, 1)
+        cols = torch.arange(w, device=device).view(1, 1, w)
+        mask = (rows >= top.view(n, 1, 1)) & (rows < (top + erase_h).view(n, 1, 1)) & \
+            (cols >= left.view(n, 1, 1)) & (cols < (left + erase_w).view(n, 1, 1))
+        mask = (mask & applied.view(n, 1, 1)).unsqueeze(1)
+
+        value = torch.as_tensor(self.erasing_value, dtype=images.dtype,
+                                device=device).reshape(-1, 1, 1).expand(c, 1, 1)
+        return torch.where(mask, value, images)
+
+    def __perspective(self, n: int, h: int, w: int, applied: torch.Tensor, device: torch.device) -> torch.Tensor:
+        # corners move inwards by up to distortion_scale / 2 of the size, the homography maps output corners to input ones
+        distortion = 0.3
+        start = torch.tensor([[0, 0], [w, 0], [w, h], [0, h]],
+                             dtype=torch.float32, device=device).expand(n, 4, 2)
+
+        offset = self.__rand(n, 4, 2, device=device) * torch.tensor(
+            [distortion * w / 2, distortion * h / 2], device=device)
+        direction = torch.tensor(
+            [[1, 1], [-1, 1], [-1, -1], [1, -1]], dtype=torch.float32, device=device)
+        end = start + offset * direction * applied.view(n, 1, 1)
+
+        x, y = end[..., 0], end[..., 1]
+        u, v = start[..., 0], start[..., 1]
+        zeros, ones = torch.zeros_like(x), torch.ones_like(x)
+
+        # u = (a x + b y + c) / (g x + h y + 1), v = (d x + e y + f) / (g x + h y + 1)
+        a = torch.cat([
+            torch.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y], dim=-1),
+            torch.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y], dim=-1),
+        ], dim=1)
+        coefficients = torch.linalg.solve(a, torch.cat([u, v], dim=1))
+
+        return torch.cat([coefficients, torch.ones(n, 1, device=device)], dim=1).view(n, 3, 3)
+
+    def __rotation(self, n: int, h: int, w: int, applied: torch.Tensor, device: torch.device) -> torch.Tensor:
+        angle = torch.where(applied, self.__rand(
+            n, device=device, low=-15, high=15), 0.0) * math.pi / 180
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        cx, cy = w / 2, h / 2
+
+        # rotation about the image center
+        matrix = torch.zeros(n, 3, 3, device=device)
+        matrix[:, 0, 0], matrix[:, 0, 1] = cos, -sin
+        matrix[:, 1, 0], matrix[:, 1, 1] = sin, cos
+        matrix[:, 0, 2] = cx - cos * cx + sin * cy
+        matrix[:, 1, 2] = cy - sin * cx - cos * cy
+        matrix[:, 2, 2] = 1
+        return matrix
+
+    def __flip(self, n: int, w: int, applied: torch.Tensor, device: torch.device) -> torch.Tensor:
+        matrix = torch.eye(3, device=device).repeat(n, 1, 1)
+        matrix[:, 0, 0] = torch.where(applied, -1.0, 1.0)
+        matrix[:, 0, 2] = torch.where(applied, float(w), 0.0)
+        return matrix
+
+    def __warp(self, images: torch.Tensor, matrix: torch.Tensor) -> torch.Tensor:
+        n, _, h, w = images.shape
+        device = images.device
+
+        # pixel centers in pixel coordinates, mapped to input coordinates and normalized for grid_sample
+        ys, xs = torch.meshgrid(torch.arange(h, device=device) + 0.5,
+                                torch.arange(w, device=device) + 0.5, indexing="ij")
+        points = torch.stack([xs, ys, torch.ones_like(xs)], dim=-1).view(1, h * w, 3)
+        source = points @ matrix.transpose(1, 2)
+        source = source[..., :2] / source[..., 2:]
+
+        grid = source / torch.tensor([w, h], device=device) * 2 - 1
+        return F.grid_sample(images, grid.view(n, h, w, 2), mode="bilinear",
+                             padding_mode="zeros", align_corners=False)
+
+    def __autocontrast(self, images: torch.Tensor, applied: torch.Tensor) -> torch.Tensor:
+        minimum = images.amin(dim=(2, 3), keepdim=True)
+        maximum = images.amax(dim=(2, 3), keepdim=True)
+
+        # constant channels stay as they are
+        scale = torch.where(maximum > minimum, 1 / (maximum - minimum), 1.0)
+        minimum = torch.where(maximum > minimum, minimum, 0.0)
+
+        contrasted = ((images - minimum) * scale).clamp(0, 1)
+        return torch.where(applied.view(-1, 1, 1, 1), contrasted, images)
+
+    @torch.no_grad()
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        n, _, h, w = images.shape
+        device = images.device
+
+        # samples are replaced in place on the cpu
+        if device.type == "cpu":
+            images = images.clone()
+
+        images = self.__apply(self.__color_jitter, images, 0.5)
+        images = self.__apply(self.__gaussian_blur, images, 0.4)
+        # RandomAdjustSharpness and RandomPerspective inside RandomApply have their own p=0.5
+        images = self.__apply(self.__adjust_sharpness, images, 0.2)
+        images = self.__apply(self.__erase, images, 0.5)
+
+        # output -> input maps, perspective is applied first and the flip last
+        perspective, rotation, flip = self.__applied(n, 0.15, device), self.__applied(
+            n, 0.3, device), self.__applied(n, 0.5, device)
+        matrix = self.__perspective(n, h, w, perspective, device) \
+            @ self.__rotation(n, h, w, rotation, device) \
+            @ self.__flip(n, w, flip, device)
+
+        if device.type != "cpu":
+            images = self.__warp(images, matrix)
+        else:
+            selected = (perspective | rotation | flip).nonzero().squeeze(1)
+            if len(selected) > 0:
+                images[selected] = self.__warp(images[selected], matrix[selected])
+
+        return self.__apply(self.__autocontrast, images, 0.3)
@@ -3,11 +3,21 @@ import os
 DATA_DIR = "./ml/data"
 RAW_IMAGES_PATH = "./ml/data/raw_images"
 PROCESSED_IMAGES_PATH = "./ml/data/processed_images"
+# processed images packed into memory mappable shards, see ml.scripts.shard_images
+SHARDED_IMAGES_PATH = "./ml/data/sharded_images"
 HIERARCHY_FILE_PATH = "./ml/data/hierarchy.csv"
 
+# content hashes, image statistics and processed outputs of raw images, see ml.scripts.preprocess
+PREPROCESS_MANIFEST_PATH = "./ml/data/preprocess_manifest.json"
+
 MODELS_REGISTRY_PATH = "/content/drive/MyDrive/bach/models_registry" if os.getenv(
     "TRAINING_ENV", "LOCAL") == "GOOGLE_COLAB" else "./ml/models_registry"
 
+ONNX_REGISTRY_PATH = os.path.join(MODELS_REGISTRY_PATH, "onnx")
+
+# every node model, node metadata and the hierarchy mask in one memory mappable file, see ml.scripts.pack_registry
+PACKED_REGISTRY_PATH = os.path.join(MODELS_REGISTRY_PATH, "registry.safetensors")
+
 CONFIGS_PATH = "./ml/data/configs"
 
 LOG_DIR = "./ml/logs"
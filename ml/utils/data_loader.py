@@ -1,57 +1,109 @@
+import hashlib
+import json
 import os
 import random
 from glob import glob
 from queue import Queue
 from threading import Thread
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import torch
 from torch.utils.data import DataLoader, Dataset
 from torchvision.tv_tensors._image import Image
 from torchvision.transforms import v2
 
-from .constants import PROCESSED_IMAGES_PATH
+from .batch_augmentations import BatchAugmentations
+from .constants import DATA_DIR, PREPROCESS_MANIFEST_PATH, PROCESSED_IMAGES_PATH, SHARDED_IMAGES_PATH
+from .image_shards import INDEX_FILE, ImageShards
 
 torch.serialization.add_safe_globals([Image])
 
 
+def get_split_files(cat_dir: str, split: str = 'train', train_ratio: float = 0.70, val_ratio: float = 0.15) -> List[str]:
+    """
+    Deterministic train/val/test split of processed tensor files of a single leaf category
+    """
+    tensor_files = glob(os.path.join(cat_dir, '*.pt'))
+
+    return [tensor_files[idx] for idx in get_split_indices(len(tensor_files), split, train_ratio, val_ratio)]
+
+
+def get_split_indices(n_files: int, split: str = 'train', train_ratio: float = 0.70, val_ratio: float = 0.15) -> List[int]:
+    """
+    Deterministic train/val/test split of `n_files` samples of a single leaf category
+    """
+    # Generate deterministic train/val/test split
+    indices = list(range(n_files))
+
+    # Seed random number generator for reproducibility
+    random.Random(42).shuffle(indices)
+
+    n_train = int(n_files * train_ratio)
+    n_val = int(n_files * val_ratio)
+
+    if split == 'train':
+        selected_indices = indices[:n_train]
+    elif split == 'val':
+        selected_indices = indices[n_train:n_train + n_val]
+    else:  # test
+        selected_indices = indices[n_train + n_val:]
+
+    return selected_indices
+
+
+def get_preprocess_fingerprint() -> Optional[str]:
+    """
+    Fingerprint of the processed images (transform settings and source image hash of every output of
+    ml.scripts.preprocess, plus the dataset config), None for data preprocessed without a manifest
+    """
+    if not os.path.exists(PREPROCESS_MANIFEST_PATH):
+        return None
+
+    with open(PREPROCESS_MANIFEST_PATH, "r") as f:
+        manifest = json.load(f)
+
+    digest = hashlib.sha256(json.dumps(
+        {"transform": manifest["transform"], "outputs": manifest["outputs"]}, sort_keys=True).encode())
+
+    with open(os.path.join(DATA_DIR, "config.json"), "rb") as f:
+        digest.update(f.read())
+
+    return digest.hexdigest()[:16]
+
+
+def __use_sharded_images() -> bool:
+    if not os.path.exists(os.path.join(SHARDED_IMAGES_PATH, INDEX_FILE)):
+        return False
+
+    fingerprint = get_preprocess_fingerprint()
+    if fingerprint is not None and ImageShards(SHARDED_IMAGES_PATH).fingerprint != fingerprint:
+        print(f"Shards in {SHARDED_IMAGES_PATH} were not created from the current processed images, "
+              f"using the per file layout (run ml.scripts.shard_images again)")
+        return False
+
+    return True
+
+
 class ImageDataset(Dataset):
     def __init__(self, root_dir: str, categories: Dict[str, List[str]], split: str = 'train',
-                 train_ratio: float = 0.70, val_ratio: float = 0.15):
+                 train_ratio: float = 0.70, val_ratio: float = 0.15, dataset_mean: Optional[List[float]] = None,
+                 augment: bool = True):
 
         self.root_dir = os.path.normpath(root_dir)
         self.categories = categories
         self.split = split
+        # without per sample augmentations PrefetchLoader augments whole batches (see BatchAugmentations)
+        self.augment = augment
 
         # Create category to index mapping
         self.cat_mapping = {cat: idx for idx,
                             cat in enumerate(categories.keys())}
 
-        self.train_augmentations = v2.Compose([
-            v2.RandomApply([
-                v2.ColorJitter(
-                    brightness=0.3,
-                    contrast=0.3,
-                    saturation=0.3,
-                    hue=0.15
-                )
-            ], p=0.5),
-            v2.RandomApply([
-                v2.GaussianBlur(kernel_size=(3, 3), sigma=(0.1, 2.0))
-            ], p=0.4),
-            v2.RandomApply([
-                v2.RandomAdjustSharpness(sharpness_factor=2)
-            ], p=0.4),
-            v2.RandomErasing(p=0.5, scale=(0.02, 0.2), ratio=(0.3, 3.3)),
-            v2.RandomApply([
-                v2.RandomPerspective(distortion_scale=0.3)
-            ], p=0.3),
-            v2.RandomApply([
-                v2.RandomRotation(degrees=15)
-            ], p=0.3),
-            v2.RandomHorizontalFlip(p=0.5),
-            v2.RandomAutocontrast(p=0.3),
-        ])
+        self.train_augmentations = self.__create_train_augmentations(0)
+        # uint8 images (preprocess --uint8) are augmented before normalization, erasing fills them with the
+        # dataset mean, which is what 0 is for normalized images
+        self.uint8_train_augmentations = self.__create_train_augmentations(
+            [round(255 * m) for m in dataset_mean] if dataset_mean is not None else 0)
 
         self.rebalancing_augmentations = [
             'flip_h',         # Horizontal flip
@@ -71,30 +123,13 @@ class ImageDataset(Dataset):
         for cat, leaves in categories.items():
             n_samples[cat] = 0
             for leaf in leaves:
-                cat_dir = os.path.join(self.root_dir, leaf)
-                tensor_files = glob(os.path.join(cat_dir, '*.pt'))
-
-                # Generate deterministic train/val/test split
-                n_files = len(tensor_files)
-                indices = list(range(n_files))
+                selected_samples = self._get_leaf_samples(
+                    leaf, split, train_ratio, val_ratio)
 
-                # Seed random number generator for reproducibility
-                random.Random(42).shuffle(indices)
-
-                n_train = int(n_files * train_ratio)
-                n_val = int(n_files * val_ratio)
-
-                if split == 'train':
-                    selected_indices = indices[:n_train]
-                elif split == 'val':
-                    selected_indices = indices[n_train:n_train + n_val]
-                else:  # test
-                    selected_indices = indices[n_train + n_val:]
-
-                n_samples[cat] += len(selected_indices)
-                for idx in selected_indices:
+                n_samples[cat] += len(selected_samples)
+                for sample in selected_samples:
                     self.samples.append({
-                        'path': tensor_files[idx],
+                        **sample,
                         'category': cat,
                         'label': self.cat_mapping[cat]
                     })
@@ -115,11 +150,10 @@ class ImageDataset(Dataset):
         max_cat = max(n_samples, key=n_samples.get)
         max_cat_samples = max(n_samples.values())
 
-        # create tmp path for storing transformed tensors
-        tmp_dir = os.path.join(self.root_dir, 'tmp')
-        os.makedirs(tmp_dir, exist_ok=True)
+        # rebalancing is virtual, extra samples name a source sample and one of the rebalancing augmentations,
+        # which is applied when the sample is loaded, the seed keeps the choices the same between runs
+        rng = random.Random(42)
 
-        # Balance classes by creating transformations
         for cat in self.categories.keys():
             if cat == max_cat:
                 print(
@@ -130,64 +164,99 @@ class ImageDataset(Dataset):
                 sample for sample in self.samples if sample['category'] == cat]
             n_samples_cat = n_samples[cat]
             while n_samples_cat < max_cat_samples:
-                # Select a random sample from the class
-                sample = random.choice(cat_samples)
-                # Create a random transformation
-                tensor = torch.load(sample['path'], weights_only=True)
-
-                transformation_type = random.choice(
-                    self.rebalancing_augmentations)
-                if transformation_type == 'flip_h':
-                    transformed_tensor = torch.flip(
-                        tensor, [2])  # Horizontal flip
-                elif transformation_type == 'flip_v':
-                    transformed_tensor = torch.flip(
-                        tensor, [1])  # Vertical flip
-                elif transformation_type == 'rot90':
-                    transformed_tensor = torch.rot90(tensor, k=1, dims=(1, 2))
-                elif transformation_type == 'rot180':
-                    transformed_tensor = torch.rot90(tensor, k=2, dims=(1, 2))
-                elif transformation_type == 'rot270':
-                    transformed_tensor = torch.rot90(tensor, k=3, dims=(1, 2))
-                elif transformation_type == 'flip_h_rot90':
-                    transformed_tensor = torch.rot90(
-                        torch.flip(tensor, [2]), k=1, dims=(1, 2))
-                elif transformation_type == 'flip_v_rot90':
-                    transformed_tensor = torch.rot90(
-                        torch.flip(tensor, [1]), k=1, dims=(1, 2))
-                else:  # identity
-                    transformed_tensor = tensor
-
-                # Save the transformed tensor to a temporary path
-                tmp_path = os.path.join(
-                    tmp_dir, f'{n_samples_cat}_{cat}.pt')
-
-                assert transformed_tensor.shape == tensor.shape, \
-                    f"Transformed tensor shape {transformed_tensor.shape} does not match original tensor shape {tensor.shape}"
-
-                torch.save(transformed_tensor, tmp_path)
-
                 self.samples.append({
-                    'path': tmp_path,
-                    'category': cat,
-                    'label': self.cat_mapping[cat]
+                    **rng.choice(cat_samples),
+                    'rebalancing': rng.randrange(len(self.rebalancing_augmentations))
                 })
 
                 n_samples_cat += 1
 
             print(f"Balanced class {cat} to {n_samples_cat} samples")
 
+    def __rebalance(self, tensor: torch.Tensor, transformation: int) -> torch.Tensor:
+        transformation_type = self.rebalancing_augmentations[transformation]
+
+        # quarter rotations of non square images would change their shape, they are flipped instead
+        if tensor.shape[1] != tensor.shape[2] and transformation_type in ('rot90', 'rot270', 'flip_h_rot90', 'flip_v_rot90'):
+            transformation_type = {'rot90': 'flip_h', 'rot270': 'flip_v',
+                                   'flip_h_rot90': 'rot180', 'flip_v_rot90': 'identity'}[transformation_type]
+
+        if transformation_type == 'flip_h':
+            transformed_tensor = torch.flip(
+                tensor, [2])  # Horizontal flip
+        elif transformation_type == 'flip_v':
+            transformed_tensor = torch.flip(
+                tensor, [1])  # Vertical flip
+        elif transformation_type == 'rot90':
+            transformed_tensor = torch.rot90(tensor, k=1, dims=(1, 2))
+        elif transformation_type == 'rot180':
+            transformed_tensor = torch.rot90(tensor, k=2, dims=(1, 2))
+        elif transformation_type == 'rot270':
+            transformed_tensor = torch.rot90(tensor, k=3, dims=(1, 2))
+        elif transformation_type == 'flip_h_rot90':
+            transformed_tensor = torch.rot90(
+                torch.flip(tensor, [2]), k=1, dims=(1, 2))
+        elif transformation_type == 'flip_v_rot90':
+            transformed_tensor = torch.rot90(
+                torch.flip(tensor, [1]), k=1, dims=(1, 2))
+        else:  # identity
+            transformed_tensor = tensor
+
+        assert transformed_tensor.shape == tensor.shape, \
+            f"Transformed tensor shape {transformed_tensor.shape} does not match original tensor shape {tensor.shape}"
+
+        return transformed_tensor
+
+    def __create_train_augmentations(self, erasing_value) -> v2.Compose:
+        return v2.Compose([
+            v2.RandomApply([
+                v2.ColorJitter(
+                    brightness=0.3,
+                    contrast=0.3,
+                    saturation=0.3,
+                    hue=0.15
+                )
+            ], p=0.5),
+            v2.RandomApply([
+                v2.GaussianBlur(kernel_size=(3, 3), sigma=(0.1, 2.0))
+            ], p=0.4),
+            v2.RandomApply([
+                v2.RandomAdjustSharpness(sharpness_factor=2)
+            ], p=0.4),
+            v2.RandomErasing(p=0.5, scale=(0.02, 0.2),
+                             ratio=(0.3, 3.3), value=erasing_value),
+            v2.RandomApply([
+                v2.RandomPerspective(distortion_scale=0.3)
+            ], p=0.3),
+            v2.RandomApply([
+                v2.RandomRotation(degrees=15)
+            ], p=0.3),
+            v2.RandomHorizontalFlip(p=0.5),
+            v2.RandomAutocontrast(p=0.3),
+        ])
+
+    def _get_leaf_samples(self, leaf: str, split: str, train_ratio: float, val_ratio: float) -> List[dict]:
+        cat_dir = os.path.join(self.root_dir, leaf)
+        return [{'path': path} for path in get_split_files(cat_dir, split, train_ratio, val_ratio)]
+
+    def _load_tensor(self, sample: dict) -> torch.Tensor:
+        return torch.load(sample['path'], weights_only=True)
+
     def __len__(self) -> int:
         return len(self.samples)
 
     def __getitem__(self, idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
         sample = self.samples[idx]
         # Load preprocessed tensor
-        tensor = torch.load(sample['path'], weights_only=True)
+        tensor = self._load_tensor(sample)
 
-        if self.split == 'train':
+        if 'rebalancing' in sample:
+            tensor = self.__rebalance(tensor, sample['rebalancing'])
+
+        if self.split == 'train' and self.augment:
             old_shape = tensor.shape
-            tensor = self.train_augmentations(tensor)
+            tensor = (self.uint8_train_augmentations if tensor.dtype ==
+                      torch.uint8 else self.train_augmentations)(tensor)
 
             assert tensor.shape == old_shape, \
                 f"Augmented tensor shape {tensor.shape} does not match original tensor shape {old_shape}"
@@ -195,12 +264,55 @@ class ImageDataset(Dataset):
         return tensor, torch.tensor(sample['label'], dtype=torch.long)
 
 
+class ShardedImageDataset(ImageDataset):
+    """
+    ImageDataset over images converted by ml.scripts.shard_images. Samples are slices of memory mapped shards
+    instead of one torch.load per file, splits are the same as of the per file layout the shards were created from.
+    """
+
+    def __init__(self, root_dir: str, categories: Dict[str, List[str]], split: str = 'train',
+                 train_ratio: float = 0.70, val_ratio: float = 0.15, dataset_mean: Optional[List[float]] = None,
+                 augment: bool = True):
+
+        self.shards = ImageShards(root_dir)
+        super().__init__(root_dir, categories, split,
+                         train_ratio, val_ratio, dataset_mean, augment)
+
+    def _get_leaf_samples(self, leaf: str, split: str, train_ratio: float, val_ratio: float) -> List[dict]:
+        leaf_range = self.shards.get_leaf_range(leaf)
+        return [{'index': leaf_range[idx]} for idx in get_split_indices(len(leaf_range), split, train_ratio, val_ratio)]
+
+    def _load_tensor(self, sample: dict) -> torch.Tensor:
+        # copy (and conversion of float16 shards) out of the mapping, augmentations and collation must not write to it
+        tensor = self.shards[sample['index']]
+        return tensor.clone() if tensor.dtype == torch.uint8 else tensor.to(torch.float32, copy=True)
+
+
 class PrefetchLoader:
-    def __init__(self, loader: DataLoader, buffer_size: int = 2, device: torch.device = None, root_dir: str = None):
+    def __init__(self, loader: DataLoader, buffer_size: int = 2, device: torch.device = None, root_dir: str = None,
+                 dataset_mean: Optional[List[float]] = None, dataset_std: Optional[List[float]] = None,
+                 augmentations: Optional[BatchAugmentations] = None):
         self.loader = loader
         self.buffer_size = buffer_size
         self.device = device or torch.device(
             'cuda' if torch.cuda.is_available() else 'cpu')
+
+        # (x / 255 - mean) / std == x * scale + bias, same as ToDtype and Normalize of the transform pipeline
+        if dataset_mean is not None and dataset_std is not None:
+            self.std = torch.tensor(dataset_std, dtype=torch.float32,
+                                    device=self.device).view(1, 3, 1, 1)
+            self.mean = torch.tensor(dataset_mean, dtype=torch.float32,
+                                     device=self.device).view(1, 3, 1, 1)
+            self.scale = 1 / (255 * self.std)
+            self.bias = -self.mean / self.std
+        else:
+            self.scale = None
+            self.bias = None
+
+        self.augmentations = augmentations
+        if augmentations is not None and self.scale is None:
+            raise ValueError(
+                "Batched augmentations need dataset mean and std to work on pixel values")
         self.buffer = Queue(maxsize=buffer_size)
         self.stop_event = None
         self.prefetch_thread = None
@@ -218,6 +330,7 @@ class PrefetchLoader:
                     batch = tuple(t.to(self.device, non_blocking=True)
                                   if isinstance(t, torch.Tensor) else t
                                   for t in batch)
+                    batch = (self.normalize(batch[0]),) + batch[1:]
                 elif isinstance(batch, dict):
                     batch = {k: v.to(self.device, non_blocking=True)
                              if isinstance(v, torch.Tensor) else v
@@ -233,6 +346,22 @@ class PrefetchLoader:
             self.buffer.put(None)  # Signal end of data
             self._active = False
 
+    def normalize(self, images: torch.Tensor) -> torch.Tensor:
+        # augmentations work on pixel values in 0-1, same as the per sample v2 transforms on unnormalized images
+        if self.augmentations is not None:
+            pixels = images.float() / 255 if images.dtype == torch.uint8 else images * self.std + self.mean
+            return (self.augmentations(pixels) - self.mean) / self.std
+
+        # uint8 images are converted after the transfer, which moves a quarter of the bytes of float32 images
+        if images.dtype != torch.uint8:
+            return images
+
+        if self.scale is None:
+            raise ValueError(
+                "uint8 images need dataset mean and std to be normalized")
+
+        return torch.addcmul(self.bias, images, self.scale)
+
     def __iter__(self):
         # Clean up previous iteration if necessary
         if self._active:
@@ -270,7 +399,11 @@ class PrefetchLoader:
                 self.prefetch_thread.join()
 
     def clean_tmp_folder(self):
+        # rebalanced samples are no longer written to disk, this only removes leftovers of older versions
         tmp_dir = os.path.join(self.root_dir, 'tmp')
+        if not os.path.exists(tmp_dir):
+            return
+
         for file in os.listdir(tmp_dir):
             os.remove(os.path.join(tmp_dir, file))
 
@@ -283,7 +416,8 @@ def create_images_dataloader(
     split: str = 'train',
     num_workers: int = 4,
     n_prefetch_batches: int = 3,
-    device: torch.device = None
+    device: torch.device = None,
+    batched_augmentations: bool = False
 ) -> PrefetchLoader:
     """
     Creates a dataloader with prefetching for the specified categories.
@@ -295,9 +429,19 @@ def create_images_dataloader(
         split: One of 'train', 'val', 'test'
         num_workers: Number of worker processes
         prefetch_factor: Number of batches to prefetch
+        batched_augmentations: Augment training batches on the device instead of every sample in the workers
     """
 
-    dataset = ImageDataset(PROCESSED_IMAGES_PATH, categories, split)
+    config = json.load(open(os.path.join(DATA_DIR, "config.json"), "r"))
+    batched_augmentations = batched_augmentations and split == 'train'
+
+    # shards created by ml.scripts.shard_images replace the per file layout when present and up to date
+    if __use_sharded_images():
+        dataset = ShardedImageDataset(
+            SHARDED_IMAGES_PATH, categories, split, dataset_mean=config["mean"], augment=not batched_augmentations)
+    else:
+        dataset = ImageDataset(PROCESSED_IMAGES_PATH,
+                               categories, split, dataset_mean=config["mean"], augment=not batched_augmentations)
 
     should_drop_last = split == 'train' and len(dataset) > batch_size
     batch_size = min(batch_size, len(dataset))
@@ -312,4 +456,6 @@ def create_images_dataloader(
     )
 
     # Wrap with prefetching
-    return PrefetchLoader(loader, buffer_size=n_prefetch_batches, device=device, root_dir=PROCESSED_IMAGES_PATH)
+    return PrefetchLoader(loader, buffer_size=n_prefetch_batches, device=device, root_dir=dataset.root_dir,
+                          dataset_mean=config["mean"], dataset_std=config["std"],
+                          augmentations=BatchAugmentations(config["mean"]) if batched_augmentations else None)
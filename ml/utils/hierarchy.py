@@ -1,83 +1,129 @@
-import pandas as pd
+import csv
 import numpy as np
-import graphviz
-from typing import List, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 from .constants import DATA_DIR, HIERARCHY_FILE_PATH
 
+if TYPE_CHECKING:
+    import pandas as pd
+
 
 class Hierarchy():
     def __init__(self, path: Optional[str] = None):
         if path is None:
             path = HIERARCHY_FILE_PATH
-        self.hierarchy: pd.DataFrame = pd.read_csv(path)
+        self.path = path
+        self.__dataframe: Optional["pd.DataFrame"] = None
 
-    def get_root_id(self):
-        root_node = self.hierarchy[self.hierarchy["<Parent ID>"].isnull()]
+        # plain csv reader is enough for the index, pandas is only needed by draw_tree and is not imported when serving
+        with open(path, "r", newline="") as f:
+            rows = list(csv.DictReader(f))
 
-        return root_node["<ID>"].values[0]
+        self.__build_index(rows)
 
-    def get_parent(self, child_id: str):
-        parent = self.hierarchy.loc[self.hierarchy["<ID>"]
-                                    == child_id, '<Parent ID>'].values
+    @property
+    def hierarchy(self) -> "pd.DataFrame":
+        if self.__dataframe is None:
+            import pandas as pd
+            self.__dataframe = pd.read_csv(self.path)
 
-        if len(parent) == 0 or pd.isna(parent[0]):
-            return None
+        return self.__dataframe
 
-        return parent[0]
+    def __build_index(self, rows: List[Dict[str, str]]):
+        # every query is answered from these lookups instead of scanning the dataframe,
+        # the index is built once and is linear in the number of nodes
+        ids = [row["<ID>"] for row in rows]
+        names = [row["<Name>"] for row in rows]
+        # empty parent column marks the root
+        parents = [row["<Parent ID>"] or None for row in rows]
 
-    def get_children(self, parent_id: str):
+        self.names: Dict[str, str] = dict(zip(ids, names))
+        self.parents: Dict[str, Optional[str]] = {}
+        self.children: Dict[str, List[str]] = {node_id: [] for node_id in ids}
 
-        children = self.hierarchy.loc[self.hierarchy["<Parent ID>"] == parent_id,
-                                      '<ID>'].values
-        children.sort()
+        self.root_id = None
+        for node_id, parent_id in zip(ids, parents):
+            if parent_id is None:
+                self.parents[node_id] = None
+                if self.root_id is None:
+                    self.root_id = node_id
+                continue
 
-        return children.tolist()
+            self.parents[node_id] = parent_id
+            self.children.setdefault(parent_id, []).append(node_id)
 
-    def is_leaf(self, node_id: str):
-        return len(self.get_children(node_id)) == 0
+        for children in self.children.values():
+            children.sort()
 
-    def get_non_leaf_children(self, parent_id: str):
-        children = self.get_children(parent_id)
+        # bfs traversal defines the order of edges in the hierarchy mask and the order of leaf categories
+        self.bfs_order: List[str] = [self.root_id]
+        self.depths: Dict[str, int] = {self.root_id: 0}
 
-        return [child for child in children if not self.is_leaf(child)]
+        for node_id in self.bfs_order:
+            for child_id in self.children[node_id]:
+                self.depths[child_id] = self.depths[node_id] + 1
+                self.bfs_order.append(child_id)
 
-    def get_categories_list(self):
+        self.leaf_order: List[str] = [
+            node_id for node_id in self.bfs_order if len(self.children[node_id]) == 0]
 
-        queue = [self.get_root_id()]
-        categories_list = []
+        # edge (parent, child) is identified by the child, its column is the position of the child in bfs order
+        # (root has no incoming edge, so it is skipped)
+        self.edge_index: Dict[str, int] = {
+            node_id: i - 1 for i, node_id in enumerate(self.bfs_order) if i > 0}
 
-        while queue:
-            node_id = queue.pop(0)
+        self.__leaf_nodes_cache: Dict[str, List[str]] = {}
 
-            if self.is_leaf(node_id):
-                categories_list.append(
-                    f"{self.hierarchy.loc[self.hierarchy['<ID>'] == node_id, '<Name>'].values[0]} ({node_id})"
-                )
-            else:
-                queue.extend(self.get_children(node_id))
+    def get_root_id(self):
+        return self.root_id
 
-        return categories_list
+    def get_parent(self, child_id: str):
+        return self.parents.get(child_id)
+
+    def get_children(self, parent_id: str):
+        # copy so that callers extending their bfs queues cannot corrupt the index
+        return list(self.children.get(parent_id, []))
+
+    def get_depth(self, node_id: str) -> int:
+        return self.depths[node_id]
+
+    def get_name(self, node_id: str) -> str:
+        return self.names[node_id]
+
+    def is_leaf(self, node_id: str):
+        return len(self.children.get(node_id, [])) == 0
+
+    def get_non_leaf_children(self, parent_id: str):
+        return [child for child in self.children.get(parent_id, []) if not self.is_leaf(child)]
+
+    def get_categories_list(self):
+        return [f"{self.names[node_id]} ({node_id})" for node_id in self.leaf_order]
 
     def get_leaf_nodes(self, root_id: str) -> List[str]:
         """
-        Recursively get all leaf nodes ids under a given root node
+        Get all leaf nodes ids under a given root node (sorted)
         """
 
-        children = self.get_children(root_id)
-
-        if not children:
-            return [root_id]
+        if root_id not in self.__leaf_nodes_cache:
+            leaf_nodes = []
+            stack = [root_id]
 
-        leaf_nodes = []
+            while stack:
+                node_id = stack.pop()
+                children = self.children.get(node_id, [])
 
-        for child in children:
-            leaf_nodes.extend(self.get_leaf_nodes(child))
+                if len(children) == 0:
+                    leaf_nodes.append(node_id)
+                else:
+                    stack.extend(children)
 
-        leaf_nodes.sort()
+            leaf_nodes.sort()
+            self.__leaf_nodes_cache[root_id] = leaf_nodes
 
-        return leaf_nodes
+        return list(self.__leaf_nodes_cache[root_id])
 
     def draw_tree(self):
+        import graphviz
+        import pandas as pd
 
         dot = graphviz.Digraph(comment='Hierarchy')
 
@@ -116,51 +162,43 @@ class Hierarchy():
 
     def create_matrix_mask(self):
 
-        edges = []  # List of (parent_id, child_id) tuples
-        leaf_nodes = []
-        edge_to_col_idx = {}  # Map (parent, child) -> column index
-
-        root_id = self.get_root_id()
-
-        queue = [root_id]
+        n_leaves = len(self.leaf_order)
+        n_edges = len(self.edge_index)
+        mask_matrix = np.zeros((n_leaves, n_edges), dtype=np.float32)
 
-        while len(queue) > 0:
-            current_node_id = queue.pop(0)
+        # we want to not penalize predictions by how deep they are in the hierarchy
+        # therefore every edge on the path from root to a leaf gets weight 1 / depth of the leaf
+        # this will make sure that all leaf nodes have the same weight
+        for row_idx, leaf_id in enumerate(self.leaf_order):
+            weight = 1.0 / self.depths[leaf_id]
 
-            children = self.get_children(current_node_id)
+            current_node_id = leaf_id
+            while self.parents[current_node_id] is not None:
+                mask_matrix[row_idx, self.edge_index[current_node_id]] = weight
+                current_node_id = self.parents[current_node_id]
 
-            if len(children) == 0:
-                leaf_nodes.append(current_node_id)
+        return mask_matrix
 
-            for child_id in children:
-                edges.append((current_node_id, child_id))
-                edge_to_col_idx[(current_node_id, child_id)] = len(edges) - 1
-                queue.append(child_id)
+    def create_sparse_mask(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Sparse (CSR like) form of the matrix mask, memory is linear in the sum of leaf depths instead of n_leaves * n_edges
 
-        # Create the mask matrix
-        n_leaves = len(leaf_nodes)
-        n_edges = len(edge_to_col_idx)
-        mask_matrix = np.zeros((n_leaves, n_edges), dtype=np.float32)
+        Returns:
+            indices: edge columns on the path of every leaf, concatenated in leaf (bfs) order
+            indptr: leaf i owns indices[indptr[i]:indptr[i + 1]]
+            depths: depth of every leaf, edge log probabilities on the path are averaged by it
+        """
+        indices = []
+        indptr = [0]
+        depths = []
 
-        for row_idx, leaf_id in enumerate(leaf_nodes):
+        for leaf_id in self.leaf_order:
             current_node_id = leaf_id
-            while True:
-
-                parent_id = self.get_parent(current_node_id)
-
-                if parent_id is None:  # Reached root
-                    break
+            while self.parents[current_node_id] is not None:
+                indices.append(self.edge_index[current_node_id])
+                current_node_id = self.parents[current_node_id]
 
-                # Mark the edge in the mask
-                edge = (parent_id, current_node_id)
-                col_idx = edge_to_col_idx[edge]
-                mask_matrix[row_idx, col_idx] = 1.0
-                current_node_id = parent_id
+            indptr.append(len(indices))
+            depths.append(self.depths[leaf_id])
 
-        # we want to not penalize predictions by how deep they are in the hierarchy
-        # therefore we will normalize the mask matrix by the depth of each leaf
-        # this will make sure that all leaf nodes have the same weight
-        leaves_depth = np.sum(mask_matrix, axis=1)
-        mask_matrix = mask_matrix / np.expand_dims(leaves_depth, axis=1)
-
-        return mask_matrix
+        return np.array(indices, dtype=np.int64), np.array(indptr, dtype=np.int64), np.array(depths, dtype=np.float32)
@@ -0,0 +1,135 @@
+import json
+import mmap
+import os
+import shutil
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import torch
+
+DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "uint8": torch.uint8,
+}
+
+INDEX_FILE = "index.json"
+
+
+def get_shard_file(shard: int) -> str:
+    return f"shard_{shard:05d}.bin"
+
+
+def write_image_shards(path: str, leaves: Dict[str, Iterable[torch.Tensor]], shape: Tuple[int, ...], dtype: str = "float16",
+                       shard_size: int = 2048, fingerprint: Optional[str] = None):
+    """
+    Writes fixed shape image tensors of every leaf category into `shard_size` sample shards of raw `dtype` values.
+    Samples of a leaf are stored contiguously in the order they are given, the index maps each leaf to its
+    range of sample ids, sample i is at position i % shard_size of shard i // shard_size.
+    `fingerprint` identifies the data the shards were created from and is stored in the index.
+
+    Shards are written into a separate directory that replaces `path` at the end, a conversion that did not
+    finish is never picked up by `ImageShards` and processes that still map the previous shards keep reading
+    their (unlinked) files instead of having them truncated.
+    """
+    path = os.path.normpath(path)
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    index = {"shape": list(shape), "dtype": dtype, "shard_size": shard_size,
+             "n_samples": 0, "fingerprint": fingerprint, "leaves": {}}
+
+    n_samples = 0
+    shard = None
+    try:
+        for leaf, tensors in leaves.items():
+            start = n_samples
+
+            for tensor in tensors:
+                assert tuple(tensor.shape) == tuple(shape), \
+                    f"All images should have the same shape. Got {tensor.shape}"
+                # normalized float images can not be stored as uint8 and uint8 ones would not be normalized as floats
+                assert (tensor.dtype == torch.uint8) == (dtype == "uint8"), \
+                    f"Can not store {tensor.dtype} images as {dtype}"
+
+                if n_samples % shard_size == 0:
+                    if shard is not None:
+                        shard.close()
+                    shard = open(os.path.join(
+                        tmp_path, get_shard_file(n_samples // shard_size)), "wb")
+
+                # plain tensor, the torchvision pipeline produces tv_tensors.Image
+                shard.write(tensor.as_subclass(torch.Tensor).to(DTYPES[dtype]).contiguous().reshape(-1)
+                            .view(torch.uint8).numpy().tobytes())
+                n_samples += 1
+
+            index["leaves"][leaf] = [start, n_samples]
+    finally:
+        if shard is not None:
+            shard.close()
+
+    index["n_samples"] = n_samples
+
+    with open(os.path.join(tmp_path, INDEX_FILE), "w") as f:
+        json.dump(index, f)
+
+    # directories can not be replaced in one step, readers finding no index in between use the per file layout
+    old_path = f"{path}.old"
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+
+class ImageShards:
+    """
+    Read side of `write_image_shards`.
+
+    Shards are mapped copy-on-write on first access, samples are views into the mapping, so reading one
+    touches only its own pages and processes reading the same shards share them through the page cache.
+    Mappings are not pickled, every DataLoader worker maps the shards it reads itself.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(os.path.join(path, INDEX_FILE), "r") as f:
+            index = json.load(f)
+
+        self.shape = tuple(index["shape"])
+        self.dtype = DTYPES[index["dtype"]]
+        self.shard_size = index["shard_size"]
+        self.n_samples = index["n_samples"]
+        self.fingerprint: Optional[str] = index.get("fingerprint")
+        self.leaves: Dict[str, List[int]] = index["leaves"]
+
+        self.shards: Dict[int, torch.Tensor] = {}
+
+    def __len__(self) -> int:
+        return self.n_samples
+
+    def __getstate__(self) -> dict:
+        return {**self.__dict__, "shards": {}}
+
+    def __get_shard(self, shard: int) -> torch.Tensor:
+        if shard not in self.shards:
+            with open(os.path.join(self.path, get_shard_file(shard)), "rb") as f:
+                # ACCESS_COPY gives a writable buffer (torch.frombuffer needs one) without ever writing to the file
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+            self.shards[shard] = torch.frombuffer(
+                buffer, dtype=self.dtype).view(-1, *self.shape)
+
+        return self.shards[shard]
+
+    def get_leaf_range(self, leaf: str) -> range:
+        start, end = self.leaves.get(leaf, (0, 0))
+        return range(start, end)
+
+    def __getitem__(self, idx: int) -> torch.Tensor:
+        return self.__get_shard(idx // self.shard_size)[idx % self.shard_size]
@@ -1,4 +1,7 @@
+import io
 import os
+from typing import Dict
+
 import numpy as np
 from PIL import Image, UnidentifiedImageError
 from .constants import RAW_IMAGES_PATH
@@ -66,6 +69,75 @@ def get_images_statistics(min_size_threshold: int) -> dict:
     }
 
 
+def get_image_statistics(data: bytes, sample: bool) -> dict:
+    """
+    Statistics of a single encoded image, channel means (of values in 0-1) only when `sample` is set,
+    `summarize_statistics` combines them into the same dict `get_images_statistics` returns
+    """
+    try:
+        img = Image.open(io.BytesIO(data))
+        statistics = {"size": list(img.size), "corrupted": False}
+
+        if sample:
+            img_array = np.array(img.convert("RGB")) / 255.0
+            statistics["channels_mean"] = np.mean(
+                img_array, axis=(0, 1)).tolist()
+            statistics["channels_squared_mean"] = np.mean(
+                np.square(img_array), axis=(0, 1)).tolist()
+
+        return statistics
+
+    except (UnidentifiedImageError, OSError):
+        return {"size": None, "corrupted": True}
+
+
+def summarize_statistics(images: Dict[str, dict], min_size_threshold: int) -> dict:
+    """
+    Statistics of the dataset from per image statistics (path -> `get_image_statistics` result)
+    """
+    min_size = (np.inf, np.inf)
+    corrupted_files = set()
+    file_below_min_size = set()
+    smallest_file = ""
+
+    channels_sum = np.zeros(3)
+    channels_squared_sum = np.zeros(3)
+    n_valid = 0
+
+    for path in sorted(images):
+        statistics = images[path]
+
+        if statistics["corrupted"]:
+            corrupted_files.add(path)
+            continue
+
+        img_size = statistics["size"]
+        if img_size[0] >= min_size_threshold and img_size[1] >= min_size_threshold:
+            if img_size[0] < min_size[0] and img_size[1] < min_size[1]:
+                min_size = tuple(img_size)
+                smallest_file = path
+
+            if "channels_mean" in statistics:
+                channels_sum += statistics["channels_mean"]
+                channels_squared_sum += statistics["channels_squared_mean"]
+                n_valid += 1
+        else:
+            file_below_min_size.add(path)
+
+    mean = channels_sum / n_valid
+    std = np.sqrt(channels_squared_sum / n_valid - np.square(mean))
+
+    return {
+        "min_size": min_size,
+        "smallest_file": smallest_file,
+        "corrupted_files": corrupted_files,
+        "files_below_min_size": file_below_min_size,
+        "total_files": len(images),
+        "dataset_mean": mean.tolist(),
+        "dataset_std": std.tolist()
+    }
+
+
 def print_statistics(statistics: dict):
     print("Minimum image size: ", statistics["min_size"])
     print("Total number of files: ", statistics["total_files"])
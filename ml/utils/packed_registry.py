@@ -0,0 +1,109 @@
+import json
+import mmap
+import os
+import struct
+from typing import Dict, List, Optional
+
+import torch
+
+# dtype names used by the safetensors format
+DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+DTYPE_NAMES = {dtype: name for name, dtype in DTYPES.items()}
+
+
+def write_packed_registry(path: str, tensors: Dict[str, torch.Tensor], metadata: Dict[str, str]):
+    """
+    Writes tensors and string metadata into a single file with the safetensors layout:
+    8 byte little endian header length, json header (tensor dtypes, shapes and byte offsets, plus `__metadata__`)
+    and the raw tensor bytes right after it, so the file can be memory mapped and read by any safetensors reader.
+
+    The file is written next to the target and moved over it at the end, processes that still map the
+    previous registry keep reading their (unlinked) copy.
+    """
+    # widest dtypes first keep every tensor aligned to its element size when the data starts 8 byte aligned
+    names = sorted(tensors, key=lambda name: (-tensors[name].element_size(), name))
+
+    header = {"__metadata__": metadata}
+    offset = 0
+    for name in names:
+        tensor = tensors[name]
+        header[name] = {
+            "dtype": DTYPE_NAMES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + tensor.nbytes],
+        }
+        offset += tensor.nbytes
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # safetensors pads the header with spaces to align the data section
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+
+        for name in names:
+            # raw bytes through a uint8 view, which also covers dtypes numpy does not know (bfloat16)
+            tensor = tensors[name].detach().cpu().contiguous().reshape(-1)
+            f.write(tensor.view(torch.uint8).numpy().tobytes())
+
+    os.replace(tmp_path, path)
+
+
+class PackedRegistry:
+    """
+    Read side of `write_packed_registry`.
+
+    The file is mapped copy-on-write, tensors are views into the mapping, so nothing is read until
+    a page is touched and processes mapping the same file share it through the page cache.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(path, "rb") as f:
+            # ACCESS_COPY gives a writable buffer (torch.frombuffer needs one) without ever writing to the file
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        header_length = struct.unpack("<Q", self.buffer[:8])[0]
+        header = json.loads(self.buffer[8:8 + header_length])
+
+        self.metadata: Dict[str, str] = header.pop("__metadata__", {})
+        self.entries = header
+        self.data_start = 8 + header_length
+
+    def keys(self) -> List[str]:
+        return list(self.entries.keys())
+
+    def get_tensor(self, name: str) -> torch.Tensor:
+        entry = self.entries[name]
+        dtype = DTYPES[entry["dtype"]]
+        begin, end = entry["data_offsets"]
+
+        if begin == end:
+            return torch.empty(entry["shape"], dtype=dtype)
+
+        tensor = torch.frombuffer(
+            self.buffer, dtype=dtype, count=(end - begin) // dtype.itemsize, offset=self.data_start + begin)
+
+        return tensor.reshape(entry["shape"])
+
+    def get_state_dict(self, prefix: str) -> Dict[str, torch.Tensor]:
+        # all tensors stored under `prefix.` with the prefix stripped
+        return {name[len(prefix) + 1:]: self.get_tensor(name)
+                for name in self.entries if name.startswith(f"{prefix}.")}
+
+    def get_json(self, key: str, default: Optional[object] = None) -> object:
+        return json.loads(self.metadata[key]) if key in self.metadata else default
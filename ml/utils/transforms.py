@@ -0,0 +1,93 @@
+import torch
+import torchvision.transforms.v2 as v2
+from PIL import Image
+
+
+def RGBA2RGB(img: torch.Tensor) -> torch.Tensor:
+    if img.shape[0] == 4:
+        rgb = img[:3]
+        alpha = img[3]
+        bg = torch.ones_like(rgb) * (1 - alpha)
+        return rgb * alpha + bg
+
+    return img
+
+
+def LA2RGB(img: torch.Tensor) -> torch.Tensor:
+    if img.shape[0] == 2:  # LA format
+        luminance, alpha = img[0], img[1]
+        # Convert to RGB by repeating the luminance channel
+        rgb = luminance.unsqueeze(0).repeat(3, 1, 1)
+        bg = torch.ones_like(rgb) * (1 - alpha)
+        return rgb * alpha + bg
+    return img
+
+
+def create_transform_pipeline(min_size: tuple, dataset_mean: list, dataset_std: list, normalize: bool = True):
+    # without normalization the pipeline stops at resized uint8 pixels, PrefetchLoader normalizes them per batch
+
+    return v2.Compose([
+        v2.ToImage(),
+        v2.Resize(min_size),
+        v2.Lambda(LA2RGB),
+        v2.RGB(),
+        v2.Lambda(RGBA2RGB),
+    ] + ([
+        v2.ToDtype(torch.float32, scale=True),
+        v2.Normalize(
+            mean=dataset_mean,
+            std=dataset_std
+        )
+    ] if normalize else []))
+
+
+class FastTransform:
+    """
+    Faster equivalent of `create_transform_pipeline` for PIL images that were opened but not decoded yet.
+
+    JPEGs are decoded directly at a reduced scale (DCT scaling via `Image.draft`, the result is never smaller
+    than the target size), large images are first reduced by an integer factor, the resize to the target size
+    happens on uint8 pixels and conversion to float with normalization is a single fused multiply add.
+    Images with alpha or a palette (RGBA, LA, PA, P) go through the exact pipeline, RGBA2RGB and LA2RGB
+    work on uint8 pixels and their output is not what compositing on a white background gives.
+    Outputs differ from the exact pipeline only by resampling differences (see ml.benchmarks.transform_benchmark).
+    Without `normalize` the resized uint8 pixels are returned.
+    """
+
+    def __init__(self, min_size: tuple, dataset_mean: list, dataset_std: list, normalize: bool = True):
+        self.height, self.width = min_size
+        self.normalize = normalize
+        self.exact = create_transform_pipeline(
+            min_size, dataset_mean, dataset_std, normalize=normalize)
+
+        # (x / 255 - mean) / std == x * scale + bias
+        std = torch.tensor(dataset_std, dtype=torch.float32).view(3, 1, 1)
+        mean = torch.tensor(dataset_mean, dtype=torch.float32).view(3, 1, 1)
+        self.scale = 1 / (255 * std)
+        self.bias = -mean / std
+
+    def __call__(self, image: Image.Image) -> torch.Tensor:
+        size = (self.width, self.height)
+
+        # rare in product photos, the exact pipeline keeps them identical to the training data
+        if image.mode in ("RGBA", "LA", "PA", "P"):
+            return self.exact(image).as_subclass(torch.Tensor)
+
+        if image.format == "JPEG":
+            image.draft("RGB", size)
+
+        image = image.convert("RGB")
+
+        if image.size != size:
+            # reducing_gap first shrinks by an integer factor with a cheap box filter while keeping the image
+            # at least 3 times larger than the target, the resampling filter then runs on the small image
+            image = image.resize(size, Image.BILINEAR, reducing_gap=3.0)
+
+        pixels = torch.frombuffer(bytearray(image.tobytes()), dtype=torch.uint8).view(
+            self.height, self.width, 3).permute(2, 0, 1)
+
+        if not self.normalize:
+            return pixels.contiguous()
+
+        tensor = torch.empty((3, self.height, self.width), dtype=torch.float32)
+        return torch.addcmul(self.bias, pixels, self.scale, out=tensor)